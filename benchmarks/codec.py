@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of AthenaQuery serialisation, comparing bin.codec with the previous dataclass based round trips:
+dataclasses.asdict + json.dumps for sqs bodies, AthenaQuery(**json.loads(body)) and filtered AthenaQuery(**item)
+for DynamoDB items. Reports microseconds per message and per-instance memory. Run from the repository root:
+    python -m benchmarks.codec
+"""
+
+import argparse
+import dataclasses
+import json
+import sys
+import timeit
+from decimal import Decimal
+
+from bin import codec
+from bin.model import AthenaQuery
+
+
+@dataclasses.dataclass
+class DataclassQuery:
+    start_date: str
+    start_timestamp: str
+    query_execution_id: str
+    query_state: str
+    executing_user: str
+    data_scanned: int = 0
+    query_sql: str = None
+
+
+DATACLASS_FIELDS = {field.name for field in dataclasses.fields(DataclassQuery)}
+VALUES = dict(
+    start_date="2019-01-21",
+    start_timestamp="2019-01-21 15:17:24",
+    query_execution_id="2bae702c-85a4-4944-974a-551a0ba4cc33",
+    query_state="SUCCEEDED",
+    executing_user="test",
+    data_scanned=329724698,
+    query_sql="SELECT * FROM foo.bar WHERE dt = '2019-01-21' AND country = 'us' LIMIT 100",
+)
+
+
+def cases():
+    dataclass_query = DataclassQuery(**VALUES)
+    query = AthenaQuery(**VALUES)
+    body = json.dumps(dataclasses.asdict(dataclass_query))
+    item = dict(VALUES, data_scanned=Decimal(VALUES["data_scanned"]), in_flight="1")
+    return [
+        ("sqs encode", lambda: json.dumps(dataclasses.asdict(dataclass_query)), lambda: codec.to_body(query)),
+        ("sqs decode", lambda: DataclassQuery(**json.loads(body)), lambda: codec.from_body(body)),
+        (
+            "dynamodb encode",
+            lambda: {key: value for key, value in dataclasses.asdict(dataclass_query).items() if value is not None},
+            lambda: codec.to_item(query),
+        ),
+        (
+            "dynamodb decode",
+            lambda: DataclassQuery(**{key: value for key, value in item.items() if key in DATACLASS_FIELDS}),
+            lambda: codec.from_item(item),
+        ),
+    ]
+
+
+def per_call_us(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def instance_size(instance):
+    size = sys.getsizeof(instance)
+    if hasattr(instance, "__dict__"):
+        size += sys.getsizeof(instance.__dict__)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="calls per measurement")
+    args = parser.parse_args()
+
+    print(f"json backend: {'orjson' if codec.orjson else 'json'}")
+    print(f"{'operation':<16} {'dataclass us':>13} {'codec us':>9} {'speedup':>8}")
+    for name, legacy, current in cases():
+        legacy_us = per_call_us(legacy, args.number)
+        current_us = per_call_us(current, args.number)
+        print(f"{name:<16} {legacy_us:>13.2f} {current_us:>9.2f} {legacy_us / current_us:>7.1f}x")
+    print(
+        f"instance size: dataclass {instance_size(DataclassQuery(**VALUES))} B, "
+        f"slots {instance_size(AthenaQuery(**VALUES))} B"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Cold start benchmark of the lambda entry points.
+
+Every run starts a fresh python process, which imports the entry point module and then invokes its lambda_handler
+twice with sample events - the first invocation is the one paying for lazy imports and client creation, the second
+one shows the warm cost. The second event is a different log or query, so it isn't dropped as a duplicate of the
+first one. AWS api calls are answered locally by a botocore before-send hook, so no credentials or
+network are needed and only the code in this repository is measured. Slack is never called, the sample events are
+below any notification threshold.
+
+Requires bin/settings.py, e.g. a copy of bin/settings.py.template. Run from the repository root:
+    python -m benchmarks.cold_start --runs 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ("cloudtrail_handler", "usage_update", "query_state_change", "notification")
+
+# executed in a fresh interpreter for every run, prints a json line with timings
+RUNNER = r"""
+import json, sys, time
+
+entry_point = sys.argv[1]
+modules_before = len(sys.modules)
+start = time.perf_counter()
+module = __import__("bin." + entry_point, fromlist=["lambda_handler"])
+imported = time.perf_counter()
+
+from benchmarks.cold_start import install_fake_aws, sample_event
+
+install_fake_aws()
+module.lambda_handler(sample_event(entry_point, 0), None)
+first = time.perf_counter()
+module.lambda_handler(sample_event(entry_point, 1), None)
+second = time.perf_counter()
+
+print(json.dumps(dict(
+    import_ms=(imported - start) * 1000,
+    first_invocation_ms=(first - imported) * 1000,
+    warm_invocation_ms=(second - first) * 1000,
+    modules=len(sys.modules) - modules_before,
+)))
+"""
+
+QUERY_EXECUTION_ID = "fda9a497-05e8-4c76-9734-561118eb362{}"
+
+
+def sample_event(entry_point, invocation=0):
+    """Sample event of the entry point, events of different invocations are about different logs or queries"""
+    query_execution_id = QUERY_EXECUTION_ID.format(invocation)
+    if entry_point == "cloudtrail_handler":
+        return dict(Records=[dict(s3=dict(bucket=dict(name="bucket"), object=dict(key=f"log-{invocation}.json.gz")))])
+    if entry_point == "query_state_change":
+        return dict(
+            source="aws.athena",
+            detail=dict(currentState="SUCCEEDED", queryExecutionId=query_execution_id, workgroupName="primary"),
+        )
+    if entry_point == "notification":
+        body = dict(
+            start_date="2019-01-21",
+            start_timestamp="2019-01-21 15:17:24",
+            query_execution_id=query_execution_id,
+            query_state="SUCCEEDED",
+            executing_user="benchmark",
+            data_scanned=0,
+            query_sql="select 1",
+        )
+        return dict(
+            Records=[
+                dict(
+                    messageId=str(invocation),
+                    body=json.dumps(body),
+                    eventSourceARN="arn:aws:sqs:us-east-1:1:athena-queries",
+                )
+            ]
+        )
+    return {}
+
+
+class _RawResponse:
+    """Minimal urllib3 response stand-in accepted by botocore, also for streaming bodies"""
+
+    def __init__(self, body):
+        import io
+
+        self._body = io.BytesIO(body)
+
+    def read(self, *args, **kwargs):
+        return self._body.read(*args, **kwargs)
+
+    def stream(self, chunk_size=1024, decode_content=False):
+        while True:
+            chunk = self._body.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _cloudtrail_log():
+    import gzip
+
+    with open(os.path.join(ROOT, "tests", "fixtures", "query_write_cloudtrail.json"), "rb") as f:
+        return gzip.compress(f.read())
+
+
+def _fake_response(operation, request):
+    if operation == "GetObject":
+        body = _cloudtrail_log()
+        return 200, {"Content-Length": str(len(body))}, body
+    if operation == "Query":
+        return 200, {}, b'{"Items": [], "Count": 0, "ScannedCount": 0}'
+    if operation in ("BatchWriteItem", "BatchGetItem"):
+        return 200, {}, b"{}"
+    if operation == "PutItem":
+        return 200, {}, b"{}"
+    if operation in ("SendMessageBatch", "PutMetricData"):
+        return 200, {}, b"<Response><ResponseMetadata><RequestId>1</RequestId></ResponseMetadata></Response>"
+    raise NotImplementedError(f"No fake response for {operation}")
+
+
+def install_fake_aws():
+    """Answer all api calls of clients created from now on locally, instead of sending them to AWS"""
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    if "boto3" not in sys.modules:
+        # the entry point doesn't use AWS at all, don't import boto3 on its behalf
+        return
+
+    import boto3
+    from botocore.awsrequest import AWSResponse
+
+    def before_send(request, **kwargs):
+        operation = kwargs["event_name"].rsplit(".", 1)[-1]
+        status, headers, body = _fake_response(operation, request)
+        return AWSResponse(request.url, status, headers, _RawResponse(body))
+
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register("before-send", before_send)
+
+
+def run(entry_point):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.run(
+        [sys.executable, "-c", RUNNER, entry_point], cwd=ROOT, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    # lambdas write embedded metrics to stdout as well, the result is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per entry point, medians are reported")
+    parser.add_argument("entry_points", nargs="*", help=f"any of {', '.join(ENTRY_POINTS)}, all by default")
+    args = parser.parse_args()
+    unknown = set(args.entry_points) - set(ENTRY_POINTS)
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(sorted(unknown))}")
+
+    print(f"{'entry point':<20} {'import ms':>10} {'1st call ms':>12} {'warm call ms':>13} {'modules':>8}")
+    for entry_point in args.entry_points or ENTRY_POINTS:
+        results = [run(entry_point) for _ in range(args.runs)]
+        medians = {key: statistics.median(result[key] for result in results) for key in results[0]}
+        print(
+            f"{entry_point:<20} {medians['import_ms']:>10.1f} {medians['first_invocation_ms']:>12.1f} "
+            f"{medians['warm_invocation_ms']:>13.1f} {medians['modules']:>8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+In-process stand-ins for the AWS services and slack used by the benchmarks.
+
+They implement only the calls made by the lambdas, keep data in memory and count every call in a shared Counter,
+so a benchmark can report how many api requests a given load would cost. They are not general purpose fakes:
+e.g. key conditions of DynamoDB queries are evaluated only for the in-flight index, otherwise the index a query reads
+decides what it returns.
+"""
+
+import random
+from collections import defaultdict
+from io import BytesIO
+
+from bin.query_dao import IN_FLIGHT_INDEX, QUERY_EXECUTION_ID_INDEX
+
+# DynamoDB returns up to 1 MB per query page, roughly this many query items
+QUERY_PAGE_SIZE = 1000
+
+
+class FakeS3:
+    def __init__(self, calls):
+        self.calls = calls
+        self.objects = {}
+
+    def put(self, bucket, key, body):
+        self.objects[(bucket, key)] = body
+
+    def Object(self, bucket, key):
+        return _FakeS3Object(self, bucket, key)
+
+
+class _FakeS3Object:
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+
+    def get(self):
+        self.s3.calls["s3.GetObject"] += 1
+        return dict(Body=BytesIO(self.s3.objects[(self.bucket, self.key)]))
+
+    def put(self, Body, **kwargs):
+        self.s3.calls["s3.PutObject"] += 1
+        self.s3.objects[(self.bucket, self.key)] = Body
+
+
+class FakeDynamoDB:
+    """Resource stand-in keeping a single dict of items per table, keyed by their primary key values"""
+
+    def __init__(self, calls, key_names=("start_date", "start_timestamp")):
+        self.calls = calls
+        self.key_names = key_names
+        self.tables = defaultdict(dict)
+
+    def Table(self, name):
+        return _FakeTable(self, name)
+
+    def key(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    def batch_write_item(self, RequestItems):
+        self.calls["dynamodb.BatchWriteItem"] += 1
+        for name, requests in RequestItems.items():
+            for request in requests:
+                item = request["PutRequest"]["Item"]
+                self.tables[name][self.key(item)] = dict(item)
+        return dict(UnprocessedItems={})
+
+    def batch_get_item(self, RequestItems):
+        self.calls["dynamodb.BatchGetItem"] += 1
+        responses = {}
+        for name, request in RequestItems.items():
+            items = (self.tables[name].get(self.key(key)) for key in request["Keys"])
+            responses[name] = [item for item in items if item]
+        return dict(Responses=responses, UnprocessedKeys={})
+
+
+class _FakeTable:
+    def __init__(self, dynamodb, name):
+        self.dynamodb = dynamodb
+        self.items = dynamodb.tables[name]
+
+    def put_item(self, Item, **kwargs):
+        self.dynamodb.calls["dynamodb.PutItem"] += 1
+        self.items[self.dynamodb.key(Item)] = dict(Item)
+
+    def get_item(self, Key, **kwargs):
+        self.dynamodb.calls["dynamodb.GetItem"] += 1
+        item = self.items.get(self.dynamodb.key(Key))
+        return dict(Item=item) if item else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, **kwargs):
+        """Supports the "set a = :a, b = :b remove c, d" expressions used by QueryDao, conditions are ignored"""
+        self.dynamodb.calls["dynamodb.UpdateItem"] += 1
+        item = self.items.setdefault(self.dynamodb.key(Key), dict(Key))
+        expression, _, removed = (" " + UpdateExpression).partition(" remove ")
+        for assignment in filter(None, expression[len(" set ") :].split(",")):
+            name, value = (part.strip() for part in assignment.split("="))
+            item[name] = ExpressionAttributeValues[value]
+        for name in filter(None, removed.split(",")):
+            item.pop(name.strip(), None)
+        return {}
+
+    def query(self, IndexName=None, ExclusiveStartKey=0, **kwargs):
+        self.dynamodb.calls["dynamodb.Query"] += 1
+        if IndexName == IN_FLIGHT_INDEX:
+            partition, due = _key_values(kwargs["KeyConditionExpression"])
+            items = [
+                item
+                for item in self.items.values()
+                if item.get("in_flight") == partition and item.get("next_check_at", due + 1) <= due
+            ]
+        elif IndexName == QUERY_EXECUTION_ID_INDEX:
+            raise NotImplementedError("Queries by execution id are not used by the benchmarks")
+        else:
+            items = list(self.items.values())
+        page = items[ExclusiveStartKey : ExclusiveStartKey + QUERY_PAGE_SIZE]
+        response = dict(Items=page)
+        if ExclusiveStartKey + QUERY_PAGE_SIZE < len(items):
+            response["LastEvaluatedKey"] = ExclusiveStartKey + QUERY_PAGE_SIZE
+        return response
+
+
+def _key_values(condition):
+    """Values of the hash and range keys in a boto3 key condition, e.g. Key("a").eq(1) & Key("b").lte(2) -> (1, 2)"""
+    hash_condition, range_condition = condition.get_expression()["values"]
+    return hash_condition.get_expression()["values"][1], range_condition.get_expression()["values"][1]
+
+
+class FakeAthena:
+    """Reports every query as succeeded, with data scanned drawn from a log-uniform distribution up to max_scanned"""
+
+    def __init__(self, calls, max_scanned=1024**4, seed=0):
+        self.calls = calls
+        self.max_scanned = max_scanned
+        self.rng = random.Random(seed)
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.calls["athena.BatchGetQueryExecution"] += 1
+        return dict(
+            QueryExecutions=[
+                dict(
+                    QueryExecutionId=query_execution_id,
+                    Query="SELECT * FROM foo.bar WHERE dt = '2019-01-17'",
+                    Status=dict(State="SUCCEEDED"),
+                    Statistics=dict(DataScannedInBytes=int(self.max_scanned ** self.rng.random())),
+                )
+                for query_execution_id in QueryExecutionIds
+            ],
+            UnprocessedQueryExecutionIds=[],
+        )
+
+
+class FakeSqs:
+    def __init__(self, calls):
+        self.calls = calls
+        self.bodies = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls["sqs.SendMessageBatch"] += 1
+        self.bodies.extend(entry["MessageBody"] for entry in Entries)
+        return dict(Successful=[dict(Id=entry["Id"]) for entry in Entries], Failed=[])
+
+
+class FakeCloudwatch:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def put_metric_data(self, **kwargs):
+        self.calls["cloudwatch.PutMetricData"] += 1
+
+
+class FakeSlackSession:
+    """Stand-in for the requests session used by SlackClient, answering the slack web api methods we call"""
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def post(self, url, json=None, data=None, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        self.calls[f"slack.{method}"] += 1
+        if method == "users.lookupByEmail":
+            return _FakeResponse(dict(ok=True, user=dict(id="U" + data["email"].split("@")[0])))
+        if method == "conversations.open":
+            return _FakeResponse(dict(ok=True, channel=dict(id="D" + json["users"])))
+        return _FakeResponse(dict(ok=True))
+
+
+class _FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
@@ -0,0 +1,190 @@
+"""
+Synthetic load benchmark of the whole ingest -> update -> notify pipeline.
+
+1. ingest - synthetic cloudtrail logs are processed by CloudtrailHandler.process_log, queries land in a fake DynamoDB,
+2. update - UsageUpdater.update_query_usage finalises all of them which are still polled (started in the last two
+   days) with fake athena responses and sends sqs events,
+3. notify - every sqs event body is handled by HardThresholdNotificator.handle_single_event with a fake slack.
+
+All AWS services and slack are in-process fakes (see benchmarks/fakes.py), so only the code in this repository is
+measured. For every stage records/s and time are reported, followed by the peak RSS of the whole run and the number of
+simulated api calls. RSS only ever grows, so it can't tell the stages apart - with --trace-memory the peak of memory
+allocated by each stage is measured with tracemalloc as well, which slows all stages down, so records/s of such a run
+are not comparable with the ones of a run without it. Use --json to get machine readable results, e.g. to compare them
+between commits.
+
+Requires bin/settings.py, e.g. a copy of bin/settings.py.template, as the lambda modules import it. The settings
+themselves are not used. Run from the repository root:
+    python -m benchmarks.pipeline --files 20 --records 20000 --athena-share 0.05
+"""
+
+import argparse
+import json
+import logging
+import resource
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from bin.cloudtrail_handler import CloudtrailHandler
+from bin.cloudwatch_metrics import CloudwatchMetrics
+from bin.notificators.hard_threshold_notificator import HardThresholdNotificator
+from bin.notificators.slack_cache import SlackIdentityCache
+from bin.notificators.slack_client import SlackClient
+from bin.poll_schedule import MAX_POLL_DELAY
+from bin.query_dao import QueryDao, key_schema
+from bin.usage_update import UsageUpdater
+from .fakes import FakeAthena, FakeCloudwatch, FakeDynamoDB, FakeS3, FakeSlackSession, FakeSqs
+from .synthetic import generate_log
+
+BUCKET = "cloudtrail"
+GB = 1024**3
+
+
+def benchmark_config(shards=None):
+    return SimpleNamespace(
+        QUERIES_TABLE="athena_queries",
+        QUERIES_TABLE_SHARDS=shards,
+        SQS_QUEUE_URL="https://sqs.us-east-1.amazonaws.com/123456789012/athena-queries",
+        CLOUDWATCH_METRIC_NAMESPACE="athena_alerter",
+        CLOUDWATCH_METRIC_NAME="athena_alerter_bytes_scanned",
+        SLACK_WEBHOOK_URL="https://hooks.slack.com/services/webhook",
+        SLACK_BOT_TOKEN="token",
+        SLACK_EMAIL_DOMAIN="example.com",
+        SLACK_CACHE_TABLE=None,
+        SLACK_ALERT_DATA_USER_THRESHOLD=100 * GB,
+        SLACK_ALERT_DATA_CHANNEL_THRESHOLD=400 * GB,
+        ATHENA_PRICE_PER_TB=5.0,
+        SLACK_HARD_THRESHOLD_MESSAGE="{user} your last query scanned {data_scanned_gb} GB",
+        SLACK_HARD_THRESHOLD_MESSAGE_ADDITIONAL_ADMIN_MAIN_CHANNEL="Runbook: <link>",
+        SLACK_HARD_THRESHOLD_MESSAGE_ADDITIONAL_PRIVATE_MESSAGE="Learn more: <link>",
+    )
+
+
+def peak_rss_mb():
+    """Peak RSS of the whole process so far"""
+    # kilobytes on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class PipelineBenchmark:
+
+    def __init__(self, files, records, athena_share, seed=0, shards=None, trace_memory=False):
+        self.files = files
+        self.trace_memory = trace_memory
+        self.records = records
+        self.athena_share = athena_share
+        self.seed = seed
+        self.config = benchmark_config(shards)
+        self.calls = Counter()
+        self.s3 = FakeS3(self.calls)
+        self.dynamodb = FakeDynamoDB(self.calls, key_schema(self.config).key_names)
+        self.sqs = FakeSqs(self.calls)
+        self.results = {}
+
+    def run(self):
+        now = datetime.now(timezone.utc)
+        for i in range(self.files):
+            # consecutive files cover consecutive time ranges
+            end_time = now - timedelta(seconds=i * self.records)
+            log = generate_log(self.records, athena_share=self.athena_share, seed=self.seed + i, end_time=end_time)
+            self.s3.put(BUCKET, f"log-{i}.json.gz", log)
+        self.stage("ingest", self.files * self.records, self.ingest)
+        # queries too old to be polled, see bin/poll_schedule.py, are stored without being scheduled
+        queries = sum("next_check_at" in item for item in self.dynamodb.tables[self.config.QUERIES_TABLE].values())
+        self.stage("update", queries, self.update)
+        self.stage("notify", len(self.sqs.bodies), self.notify)
+        self.results["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        self.results["api_calls"] = dict(sorted(self.calls.items()))
+        return self.results
+
+    def stage(self, name, count, function):
+        if self.trace_memory:
+            # tracing starts from scratch, so only memory allocated by this stage is counted
+            tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        self.results[name] = dict(
+            records=count,
+            seconds=round(elapsed, 3),
+            records_per_second=round(count / elapsed) if elapsed else None,
+        )
+        if self.trace_memory:
+            self.results[name]["peak_allocated_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+            tracemalloc.stop()
+
+    def ingest(self):
+        handler = CloudtrailHandler(self.config, self.s3, QueryDao(self.config, self.dynamodb))
+        for i in range(self.files):
+            event = dict(Records=[dict(s3=dict(bucket=dict(name=BUCKET), object=dict(key=f"log-{i}.json.gz")))])
+            handler.process_log(event)
+
+    def update(self):
+        query_dao = QueryDao(self.config, self.dynamodb)
+        updater = UsageUpdater(
+            self.config,
+            query_dao,
+            FakeAthena(self.calls, seed=self.seed),
+            self.sqs,
+            cloudwatch_metrics=CloudwatchMetrics(self.config, FakeCloudwatch(self.calls)),
+        )
+        # run the sweep when all queries are due
+        updater.now = lambda: time.time() + MAX_POLL_DELAY
+        updater.update_query_usage()
+
+    def notify(self):
+        SlackIdentityCache.clear()
+        with patch.object(SlackClient, "session", FakeSlackSession(self.calls)):
+            notificator = HardThresholdNotificator(self.config)
+            for body in self.sqs.bodies:
+                notificator.handle_single_event(body)
+
+
+def print_results(results):
+    traced = "peak_allocated_mb" in results["ingest"]
+    print(
+        f"{'stage':<8} {'records':>10} {'seconds':>9} {'records/s':>11}" + (f" {'peak alloc MB':>14}" if traced else "")
+    )
+    for name in ("ingest", "update", "notify"):
+        stage = results[name]
+        print(
+            f"{name:<8} {stage['records']:>10} {stage['seconds']:>9.3f} {stage['records_per_second'] or 0:>11}"
+            + (f" {stage['peak_allocated_mb']:>14.1f}" if traced else "")
+        )
+    print(f"\npeak RSS of the whole run: {results['peak_rss_mb']:.1f} MB")
+    print("\nsimulated api calls:")
+    for call, count in results["api_calls"].items():
+        print(f"  {call:<35} {count:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=10, help="number of cloudtrail log files")
+    parser.add_argument("--records", type=int, default=10000, help="records per log file")
+    parser.add_argument("--athena-share", type=float, default=0.05, help="share of athena events among records")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shards", type=int, default=0, help="QUERIES_TABLE_SHARDS, 0 for the date keyed schema")
+    parser.add_argument(
+        "--trace-memory", action="store_true", help="measure peak memory allocated by each stage, slows stages down"
+    )
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = PipelineBenchmark(
+        args.files, args.records, args.athena_share, args.seed, args.shards, args.trace_memory
+    ).run()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
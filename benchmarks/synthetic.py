@@ -0,0 +1,87 @@
+"""
+Generator of synthetic, gzipped cloudtrail logs.
+
+Logs are built from a weighted mix of event types resembling a real account trail: mostly non athena events, with
+StartQueryExecution records making up the requested share of athena events. Records are padded to a realistic size,
+so file sizes match what the cloudtrail handler processes in production.
+"""
+
+import gzip
+import json
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+
+# (event source, event name, weight) of non athena events
+OTHER_EVENTS = (
+    ("s3.amazonaws.com", "GetObject", 40),
+    ("s3.amazonaws.com", "PutObject", 20),
+    ("sts.amazonaws.com", "AssumeRole", 15),
+    ("ec2.amazonaws.com", "DescribeInstances", 10),
+    ("kms.amazonaws.com", "Decrypt", 10),
+    ("glue.amazonaws.com", "GetTable", 5),
+)
+# athena events other than query starts, e.g. generated by clients polling for query results
+OTHER_ATHENA_EVENTS = ("GetQueryExecution", "GetQueryResults", "ListWorkGroups")
+
+USERS = tuple(f"user{i}" for i in range(50))
+CLOUDTRAIL_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def _user_identity(rng):
+    user = rng.choice(USERS)
+    if rng.random() < 0.5:
+        return dict(type="IAMUser", arn=f"arn:aws:iam::123456789012:user/{user}", userName=user)
+    return dict(type="AssumedRole", arn=f"arn:aws:sts::123456789012:assumed-role/sso/{user}@example.com")
+
+
+def _record(rng, source, name, event_time, padding):
+    record = dict(
+        eventVersion="1.08",
+        userIdentity=_user_identity(rng),
+        eventTime=event_time,
+        eventSource=source,
+        eventName=name,
+        awsRegion="us-east-1",
+        sourceIPAddress="10.0.0.1",
+        userAgent="aws-sdk-java/1.11 " + padding,
+        requestID=str(uuid.UUID(int=rng.getrandbits(128))),
+        eventID=str(uuid.UUID(int=rng.getrandbits(128))),
+        readOnly=True,
+        eventType="AwsApiCall",
+        managementEvent=True,
+        recipientAccountId="123456789012",
+    )
+    if name == "StartQueryExecution":
+        record["requestParameters"] = dict(
+            queryString="SELECT * FROM foo.bar WHERE dt = '2019-01-17'", queryExecutionContext=dict(database="foo")
+        )
+        record["responseElements"] = dict(queryExecutionId=str(uuid.UUID(int=rng.getrandbits(128))))
+    return record
+
+
+def generate_records(count, athena_share=0.05, start_share=0.5, seed=0, end_time=None, record_size=1000):
+    """
+    Yield cloudtrail records. athena_share of them are athena events and start_share of those are query starts.
+    Records are a second apart and the last one happens at end_time (now by default), so that queries, which are
+    keyed by their start time, don't overwrite each other.
+    """
+    rng = random.Random(seed)
+    end_time = end_time or datetime.now(timezone.utc)
+    padding = "x" * max(0, record_size - 700)
+    sources = [(source, name) for source, name, _ in OTHER_EVENTS]
+    weights = [weight for _, _, weight in OTHER_EVENTS]
+    for i in range(count):
+        event_time = (end_time - timedelta(seconds=count - i)).strftime(CLOUDTRAIL_TIME_FORMAT)
+        if rng.random() < athena_share:
+            name = "StartQueryExecution" if rng.random() < start_share else rng.choice(OTHER_ATHENA_EVENTS)
+            yield _record(rng, "athena.amazonaws.com", name, event_time, padding)
+        else:
+            source, name = rng.choices(sources, weights)[0]
+            yield _record(rng, source, name, event_time, padding)
+
+
+def generate_log(count, **kwargs):
+    """Return a gzipped cloudtrail log with count records, see generate_records for the arguments"""
+    records = ",\n".join(json.dumps(record) for record in generate_records(count, **kwargs))
+    return gzip.compress(('{"Records": [' + records + "]}").encode("utf-8"), compresslevel=6)
@@ -0,0 +1,132 @@
+"""
+Athena clients for queries started in other accounts and regions, e.g. queries found in the logs of an organisation
+trail.
+
+Queries of the lambda's own account and region use its own client. Queries of other regions of the same account use a
+client created for that region. Queries of other accounts use credentials of the ATHENA_ROLE_NAME role assumed in
+that account, the role needs to allow athena:BatchGetQueryExecution (and athena:StopQueryExecution to cancel queries)
+and to trust the lambda role (see cloudformation/member_account_role.yaml). Assumed credentials and clients are cached
+in class attributes, so they survive warm lambda invocations, and are replaced REFRESH_MARGIN seconds before the
+credentials expire.
+
+The pool is used by several threads at once. Creating clients of boto3's default session isn't thread safe, so clients
+of other accounts and regions are created from their own session, and prepare() creates the shared clients before the
+threads start.
+"""
+
+import math
+import os
+import threading
+import time
+
+from . import clients
+from .metrics import NOOP_METRICS, STS_ASSUME_ROLE_TIME
+
+# seconds before the expiration of assumed credentials when they are replaced, longer than any lambda timeout
+REFRESH_MARGIN = 15 * 60
+SESSION_DURATION = 3600
+SESSION_NAME = "athena_alerter"
+
+
+class AthenaClientPool:
+
+    _clients = {}
+    _credentials = {}
+    _own_account = None
+    _lock = threading.Lock()
+
+    def __init__(self, config, athena=None, sts=None, metrics=NOOP_METRICS):
+        self.config = config
+        self.athena = athena
+        self.sts = sts
+        self.metrics = metrics
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._clients.clear()
+            cls._credentials.clear()
+            cls._own_account = None
+
+    @property
+    def role_name(self):
+        return getattr(self.config, "ATHENA_ROLE_NAME", None)
+
+    @staticmethod
+    def own_region():
+        return os.environ.get("AWS_REGION")
+
+    def _sts(self):
+        if self.sts is None:
+            self.sts = clients.client("sts")
+        return self.sts
+
+    def own_account(self):
+        if AthenaClientPool._own_account is None:
+            AthenaClientPool._own_account = self._sts().get_caller_identity()["Account"]
+        return AthenaClientPool._own_account
+
+    def prepare(self):
+        """Create the lambda's own clients and resolve its account, call it before using the pool from several threads"""
+        if self.athena is None:
+            self.athena = clients.client("athena")
+        if self.role_name:
+            self._sts()
+            self.own_account()
+
+    def client(self, account_id=None, region=None):
+        """
+        Athena client for queries started in account_id and region, None stands for the lambda's own account and
+        region. Without ATHENA_ROLE_NAME configured all queries are assumed to be started in the lambda's account.
+        """
+        if not self.role_name or (account_id and account_id == self.own_account()):
+            account_id = None
+        if region == self.own_region():
+            region = None
+        if account_id is None and region is None:
+            return self.athena or clients.client("athena")
+
+        key = (account_id, region)
+        now = time.time()
+        with self._lock:
+            cached = self._clients.get(key)
+        if cached and cached[1] - REFRESH_MARGIN > now:
+            return cached[0]
+        credentials, expires_at = self._assume_role(account_id, now) if account_id else ({}, math.inf)
+        client = self._create_client(region, credentials)
+        with self._lock:
+            self._clients[key] = (client, expires_at)
+        return client
+
+    @staticmethod
+    def _create_client(region, credentials):
+        # imported on first use, the same as in clients.py
+        import boto3.session
+
+        # a session of its own, the default one may be used by other threads at the same time
+        return boto3.session.Session().client("athena", region_name=region, **credentials)
+
+    def _assume_role(self, account_id, now):
+        """Credentials of the athena role in account_id as boto3.client arguments and their expiration timestamp"""
+        with self._lock:
+            cached = self._credentials.get(account_id)
+        if cached and cached[1] - REFRESH_MARGIN > now:
+            return cached
+        with self.metrics.timer(STS_ASSUME_ROLE_TIME):
+            response = self._sts().assume_role(
+                RoleArn=f"arn:aws:iam::{account_id}:role/{self.role_name}",
+                RoleSessionName=SESSION_NAME,
+                DurationSeconds=SESSION_DURATION,
+            )
+        credentials = response["Credentials"]
+        cached = (
+            dict(
+                aws_access_key_id=credentials["AccessKeyId"],
+                aws_secret_access_key=credentials["SecretAccessKey"],
+                aws_session_token=credentials["SessionToken"],
+            ),
+            credentials["Expiration"].timestamp(),
+        )
+        with self._lock:
+            self._credentials[account_id] = cached
+        return cached
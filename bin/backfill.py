@@ -0,0 +1,197 @@
+"""
+Rebuilds the queries table from archived cloudtrail logs, e.g. when onboarding a new account or after the s3 trigger
+of cloudtrail_handler was broken for a while.
+
+Logs are read from a local directory (searched recursively for .json.gz files, e.g. a copy made with aws s3 sync)
+or directly from an s3://bucket/prefix. They are parsed in a pool of processes, one per cpu by default, with the same
+record logic as cloudtrail_handler. Found queries already in the table are dropped, so re-running a backfill is safe
+and never overwrites live data. Final state, data scanned and sql of the rest are fetched from athena where it still
+knows them (it keeps about 45 days of history) and they are written with batch writes. No sqs events are sent, so
+backfilled queries don't trigger notifications. Queries athena doesn't know anymore are stored as running, the same
+as cloudtrail_handler stores them.
+
+Every processed log is appended to a checkpoint file once its queries are written, an interrupted backfill started
+again with the same checkpoint continues where it stopped:
+    python -m bin.backfill s3://my-cloudtrail/AWSLogs/123456789012/CloudTrail/ --checkpoint backfill.checkpoint
+"""
+
+import argparse
+import logging
+import os
+import time
+from multiprocessing import Pool
+
+from . import clients, settings
+from .athena_clients import AthenaClientPool
+from .cloudtrail_handler import CloudtrailHandler
+from .model import QueryState
+from .query_dao import QueryDao
+from .sql_store import SqlStore
+from .usage_update import ATHENA_BATCH_SIZE, UsageUpdater
+
+LOG_SUFFIX = ".json.gz"
+# queries collected from finished logs are written once there is this many of them
+WRITE_BATCH_SIZE = 10 * ATHENA_BATCH_SIZE
+PROGRESS_INTERVAL = 10
+
+logger = logging.getLogger()
+
+
+def list_logs(source):
+    """Yield paths of all cloudtrail logs in a local directory or s3:// urls of all logs under a prefix"""
+    if source.startswith("s3://"):
+        bucket, _, prefix = source[len("s3://") :].partition("/")
+        paginator = clients.client("s3").get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                if item["Key"].endswith(LOG_SUFFIX):
+                    yield f"s3://{bucket}/{item['Key']}"
+    else:
+        for directory, _, files in os.walk(source):
+            for name in sorted(files):
+                if name.endswith(LOG_SUFFIX):
+                    yield os.path.join(directory, name)
+
+
+def _init_worker():
+    # clients created by the parent process must not be shared with forked workers
+    clients._clients.clear()
+    clients._resources.clear()
+
+
+def read_log(path):
+    """Return the path, size and queries of a single log, run in worker processes"""
+    handler = CloudtrailHandler(settings, s3=None, query_dao=None)
+    if path.startswith("s3://"):
+        bucket, _, key = path[len("s3://") :].partition("/")
+        response = clients.client("s3").get_object(Bucket=bucket, Key=key)
+        body, size = response["Body"], response["ContentLength"]
+    else:
+        body, size = open(path, "rb"), os.path.getsize(path)
+    try:
+        queries = list(handler.read_queries(body, path))
+    finally:
+        body.close()
+    return path, size, queries
+
+
+class Checkpoint:
+    """Append only file with paths of logs which have been fully written to the table"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.strip() for line in f if line.strip()}
+        self.file = open(path, "a") if path else None
+
+    def add(self, paths):
+        self.done.update(paths)
+        if self.file:
+            self.file.writelines(f"{path}\n" for path in paths)
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class Backfill:
+
+    def __init__(self, config, query_dao, updater=None, checkpoint=None, workers=None):
+        self.config = config
+        self.query_dao = query_dao
+        self.updater = updater
+        self.checkpoint = checkpoint or Checkpoint(None)
+        self.workers = workers or os.cpu_count()
+        self.queries = []
+        self.pending_logs = []
+        self.stats = dict(logs=0, bytes=0, queries=0, finalised=0)
+
+    def run(self, paths):
+        paths = [path for path in paths if path not in self.checkpoint.done]
+        logger.info(f"Backfilling {len(paths)} logs using {self.workers} processes")
+        self.start = time.perf_counter()
+        if self.workers == 1:
+            self._consume(map(read_log, paths), len(paths))
+        else:
+            with Pool(self.workers, initializer=_init_worker) as pool:
+                self._consume(pool.imap_unordered(read_log, paths, chunksize=4), len(paths))
+        self.flush()
+        self.report(len(paths))
+        return self.stats
+
+    def _consume(self, results, total):
+        for path, size, queries in results:
+            self.queries.extend(queries)
+            self.pending_logs.append(path)
+            self.stats["logs"] += 1
+            self.stats["bytes"] += size
+            if len(self.queries) >= WRITE_BATCH_SIZE:
+                self.flush()
+            if self.stats["logs"] % PROGRESS_INTERVAL == 0:
+                self.report(total)
+
+    def flush(self):
+        """
+        Write collected queries and mark logs they came from as done. Queries already in the table are left untouched,
+        so replaying old logs never overwrites queries which have been finalised since, and they are dropped before
+        their details are fetched and long texts offloaded to s3.
+        """
+        queries = self.query_dao.new_queries(self.queries)
+        if self.updater and queries:
+            details = self.updater.get_details(queries)
+            for query in queries:
+                if query.query_execution_id in details:
+                    self.updater.apply_details(query, details[query.query_execution_id])
+                    if query.query_state != QueryState.RUNNING.value:
+                        self.stats["finalised"] += 1
+        self.query_dao.insert_queries(queries)
+        self.stats["queries"] += len(self.queries)
+        self.checkpoint.add(self.pending_logs)
+        self.queries = []
+        self.pending_logs = []
+
+    def report(self, total):
+        elapsed = time.perf_counter() - self.start
+        stats = self.stats
+        logger.info(
+            f"{stats['logs']}/{total} logs, {stats['queries']} queries found, {stats['finalised']} finalised, "
+            f"{stats['logs'] / elapsed:.1f} logs/s, {stats['bytes'] / elapsed / 1024 / 1024:.1f} MB/s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="local directory or s3://bucket/prefix with cloudtrail logs")
+    parser.add_argument("--checkpoint", help="file with already processed logs, created if it doesn't exist")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of parsing processes")
+    parser.add_argument(
+        "--no-athena-details", action="store_true", help="store queries as parsed, without asking athena for details"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    query_dao = QueryDao(settings, clients.resource("dynamodb"))
+    updater = None
+    if not args.no_athena_details:
+        # sqs is never used, the backfill doesn't send query finished events
+        athena = clients.client("athena")
+        updater = UsageUpdater(
+            settings,
+            query_dao,
+            athena,
+            sqs=None,
+            sql_store=SqlStore(settings),
+            athena_clients=AthenaClientPool(settings, athena),
+        )
+    checkpoint = Checkpoint(args.checkpoint)
+    try:
+        Backfill(settings, query_dao, updater, checkpoint, args.workers).run(list(list_logs(args.source)))
+    finally:
+        checkpoint.close()
+
+
+if __name__ == "__main__":
+    main()
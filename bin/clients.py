@@ -0,0 +1,26 @@
+"""
+boto3 clients and resources shared by all invocations of a lambda container.
+
+Creating a client loads and parses the service model, which is one of the most expensive parts of a cold start, so
+each one is created on first use and reused by warm invocations. boto3 itself is imported only when the first client
+is needed, so entry points which don't talk to AWS, like the notification lambda, don't pay for it.
+"""
+
+_clients = {}
+_resources = {}
+
+
+def client(service_name):
+    if service_name not in _clients:
+        import boto3
+
+        _clients[service_name] = boto3.client(service_name)
+    return _clients[service_name]
+
+
+def resource(service_name):
+    if service_name not in _resources:
+        import boto3
+
+        _resources[service_name] = boto3.resource(service_name)
+    return _resources[service_name]
@@ -1,59 +1,123 @@
 """
 This file contains a lambda function reacting to cloudtrail events that a new athena query has been started.
-It adds new entries to a dynamodb table containing all queries
+It adds new entries to a dynamodb table containing all queries. Queries which have already finished by the time their
+log is delivered, and whose state change event has left a marker (see query_state_change.py), are finalised right away.
 """
 
-import gzip
 import json
 import logging
+import zlib
 from datetime import datetime, timezone
-from io import BytesIO
 
-import boto3
-
-from . import settings
+from . import clients, settings
+from .cloudtrail_reader import LogPrefilter, decompress, iter_records, read_chunks
+from .dedup import NO_DEDUP, DedupStore, file_key, finished_key
+from .metrics import (
+    DECOMPRESS_TIME,
+    FILES_PARSED,
+    FILES_SKIPPED,
+    NOOP_METRICS,
+    PARSE_TIME,
+    PREFILTER_TIME,
+    QUERIES_INSERTED,
+    S3_DOWNLOAD_TIME,
+    S3_GET_OBJECT_TIME,
+    EmbeddedMetrics,
+)
 from .model import AthenaQuery, QueryState, TIMESTAMP_FORMAT
 from .query_dao import QueryDao
 
 CLOUDTRAIL_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# only records containing this text are decoded, the rest of the log is skipped without parsing
+START_QUERY_EXECUTION_MARKER = '"StartQueryExecution"'
+# number of queries collected from a log before they are written to dynamodb in a single batch
+INSERT_BATCH_SIZE = 25
 
 logger = logging.getLogger()
 
 
 def lambda_handler(event, context):
-    s3 = boto3.resource("s3")
-    dynamodb = boto3.resource("dynamodb")
+    s3 = clients.resource("s3")
+    dynamodb = clients.resource("dynamodb")
+    metrics = EmbeddedMetrics(settings.CLOUDWATCH_METRIC_NAMESPACE, dict(Function="cloudtrail_handler"))
+
+    query_dao = QueryDao(settings, dynamodb, metrics)
+    dedup = DedupStore(settings, dynamodb, metrics)
+
+    def finalise_queries(queries):
+        # imported and created only when needed, so the clients of the updater don't slow down every cold start
+        from .query_state_change import create_handler
 
-    query_dao = QueryDao(settings, dynamodb)
+        create_handler(metrics).finalise_queries(queries)
 
-    writer = CloudtrailHandler(settings, s3, query_dao)
+    writer = CloudtrailHandler(settings, s3, query_dao, metrics, dedup, finalise_queries)
 
-    writer.process_log(event)
+    try:
+        writer.process_log(event)
+    finally:
+        metrics.flush()
 
 
 class CloudtrailHandler:
 
-    def __init__(self, config, s3, query_dao):
+    def __init__(self, config, s3, query_dao, metrics=NOOP_METRICS, dedup=NO_DEDUP, finalise_queries=None):
         self.config = config
         self.s3 = s3
         self.query_dao = query_dao
+        self.metrics = metrics
+        self.dedup = dedup
+        self.finalise_queries = finalise_queries
+        self.prefilter = LogPrefilter()
 
     def process_log(self, event):
-        """Process the CloudTrail log event for Athena queries."""
+        """Process the CloudTrail log event for Athena queries, logs which have already been processed are skipped"""
         s3_record = event["Records"][0]["s3"]
         bucket = s3_record["bucket"]["name"]
         key = s3_record["object"]["key"]
-        object = self.s3.Object(bucket, key).get()
-        stream = BytesIO(object["Body"].read())
-        with gzip.GzipFile(None, "rb", fileobj=stream) as file:
-            try:
-                data = json.load(file)
-            except json.JSONDecodeError:
-                logger.warning(f"Not a valid cloudtrail json file {bucket}/{key}", exc_info=True)
+        self.dedup.run_once(file_key(bucket, key), lambda: self.process_object(bucket, key))
+
+    def process_object(self, bucket, key):
+        with self.metrics.timer(S3_GET_OBJECT_TIME):
+            object = self.s3.Object(bucket, key).get()
+        queries = []
+        for query in self.read_queries(object["Body"], f"{bucket}/{key}"):
+            queries.append(query)
+            if len(queries) >= INSERT_BATCH_SIZE:
+                self.insert_queries(queries)
+                queries = []
+        # queries collected before a malformed part of the log are still written
+        if queries:
+            self.insert_queries(queries)
+
+    def read_queries(self, body, name):
+        """Yield queries started in a gzipped cloudtrail log read from a file-like body, e.g. s3 StreamingBody"""
+        try:
+            with self.metrics.timer(PREFILTER_TIME):
+                chunks = self.prefilter.filter(self.metrics.timed(S3_DOWNLOAD_TIME, read_chunks(body)))
+            if chunks is None:
+                logger.debug(f"No athena queries started in {name}, skipping")
+                self.metrics.count(FILES_SKIPPED)
                 return
-            for record in data.get("Records", []):
+            self.metrics.count(FILES_PARSED)
+            chunks = self.metrics.timed(DECOMPRESS_TIME, decompress(chunks))
+            records = self.metrics.timed(PARSE_TIME, iter_records(chunks, marker=START_QUERY_EXECUTION_MARKER))
+            for record in records:
                 if record.get("eventName") == "StartQueryExecution":
-                    self.process_query_record(record)
+                    query = self.process_query_record(record)
+                    if query:
+                        yield query
+        except (json.JSONDecodeError, zlib.error):
+            logger.warning(f"Not a valid cloudtrail json file {name}", exc_info=True)
+
+    def insert_queries(self, queries):
+        # a log delivered again after its queries have been finalised must not reset them to running
+        inserted = self.query_dao.insert_queries(queries, skip_existing=True)
+        self.metrics.count(QUERIES_INSERTED, inserted)
+        if self.finalise_queries:
+            marked = self.dedup.marked([finished_key(query.query_execution_id) for query in queries])
+            finished = [query for query in queries if finished_key(query.query_execution_id) in marked]
+            if finished:
+                self.finalise_queries(finished)
 
     def extract_user_from_arn(self, arn):
         """Extract the user identifier from an ARN."""
@@ -79,16 +143,16 @@ class CloudtrailHandler:
         return "API"
 
     def process_query_record(self, record):
-        """Process an Athena query record from CloudTrail."""
+        """Build an AthenaQuery from a CloudTrail record, returns None if the record can't be processed."""
         try:
             if not (record.get("responseElements") and record.get("userIdentity") and record.get("eventTime")):
                 logger.warning("Missing required fields in CloudTrail record")
-                return
+                return None
 
             time = datetime.strptime(record["eventTime"], CLOUDTRAIL_TIME_FORMAT).replace(tzinfo=timezone.utc)
             inferred_executing_user = self.infer_executing_user(record["userIdentity"])
 
-            query = AthenaQuery(
+            return AthenaQuery(
                 start_date=datetime.strftime(time, "%Y-%m-%d"),
                 start_timestamp=datetime.strftime(time, TIMESTAMP_FORMAT),
                 query_execution_id=record["responseElements"]["queryExecutionId"],
@@ -96,11 +160,13 @@ class CloudtrailHandler:
                 executing_user=inferred_executing_user,
                 data_scanned=0,
                 query_sql=None,
+                # the account the query was started in, records of an organisation trail come from all its accounts
+                account_id=record.get("recipientAccountId") or record["userIdentity"].get("accountId"),
+                region=record.get("awsRegion"),
             )
 
-            self.query_dao.insert_query(query)
-
         except (ValueError, KeyError) as e:
             logger.warning(f"Error processing CloudTrail record: {str(e)}")
         except Exception as e:
             logger.error("Unexpected error processing record", exc_info=True)
+        return None
@@ -0,0 +1,153 @@
+"""
+Streaming reader for gzipped cloudtrail log files.
+
+A cloudtrail log is a single json document of the form {"Records": [{...}, {...}]} which may be hundreds of megabytes
+once decompressed. Instead of loading it as a whole, the body is decompressed in chunks and the "Records" array is
+scanned element by element, so memory usage is bounded by the size of a single record.
+"""
+
+import codecs
+import json
+import re
+import tempfile
+import zlib
+from itertools import chain
+
+CHUNK_SIZE = 256 * 1024
+# compressed data read by the prefilter is kept in memory up to this size and spilled to a temporary file above it
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+ATHENA_MARKERS = (b'"athena.amazonaws.com"', b'"StartQueryExecution"')
+
+# consumes everything up to the next bracket which is not a part of a json string
+_FILLER = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+_RECORDS_KEY = re.compile(r'"Records"\s*:\s*$')
+
+
+def read_chunks(body, chunk_size=CHUNK_SIZE):
+    """Yield raw chunks from a file-like object (e.g. s3 StreamingBody) until it is exhausted."""
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def decompress(chunks):
+    """Gunzip a stream of byte chunks. Concatenated gzip members are supported."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+class LogPrefilter:
+    """
+    Fast path dropping cloudtrail logs which can't contain athena query starts before any json decoding happens.
+    The decompressed stream is searched for all the markers and the compressed chunks read in the meantime are kept
+    in a spooled temporary file, so the log doesn't have to be downloaded again if it needs to be parsed.
+    """
+
+    def __init__(self, markers=ATHENA_MARKERS, spool_max_size=SPOOL_MAX_SIZE):
+        self.markers = markers
+        self.spool_max_size = spool_max_size
+
+    def filter(self, chunks):
+        """
+        Return an iterator over all compressed chunks of the log if it contains every marker, None otherwise.
+        """
+        chunks = iter(chunks)
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+        missing = set(self.markers)
+        overlap = max(len(marker) for marker in self.markers) - 1
+        tail = b""
+        for data in decompress(self._spool(chunks, spool)):
+            window = tail + data
+            missing = {marker for marker in missing if marker not in window}
+            if not missing:
+                break
+            tail = window[-overlap:]
+
+        if missing:
+            spool.close()
+            return None
+        return chain(self._replay(spool), chunks)
+
+    @staticmethod
+    def _spool(chunks, spool):
+        for chunk in chunks:
+            spool.write(chunk)
+            yield chunk
+
+    @staticmethod
+    def _replay(spool):
+        with spool:
+            spool.seek(0)
+            yield from read_chunks(spool)
+
+
+def iter_records(chunks, marker=None):
+    """
+    Yield elements of the top level "Records" array from a stream of decompressed json chunks.
+    If marker is given, only records whose raw json text contains it are decoded, others are skipped unparsed.
+    Raises json.JSONDecodeError if the document is not a valid cloudtrail log.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    # start of the text between the last bracket and the current position, used to find the "Records" key
+    filler_start = 0
+    depth = 0
+    started = False
+    records_depth = None
+    record_start = None
+
+    for chunk in chunks:
+        # drop already consumed text, so the buffer never holds much more than the current record and a chunk
+        cut = record_start if record_start is not None else filler_start
+        buffer = buffer[cut:] + decoder.decode(chunk)
+        position -= cut
+        filler_start -= cut
+        if record_start is not None:
+            record_start = 0
+
+        while True:
+            position = _FILLER.match(buffer, position).end()
+            if position == len(buffer) or buffer[position] == '"':
+                # a json string continues in the next chunk
+                break
+            bracket = buffer[position]
+            if bracket in "[{":
+                depth += 1
+                started = True
+                if records_depth is None and depth == 2 and bracket == "[":
+                    if _RECORDS_KEY.search(buffer, filler_start, position):
+                        records_depth = depth
+                elif records_depth is not None and depth == records_depth + 1 and bracket == "{":
+                    record_start = position
+            else:
+                depth -= 1
+                if depth < 0:
+                    raise json.JSONDecodeError("Unexpected closing bracket", buffer, position)
+                if record_start is not None and depth == records_depth:
+                    raw_record = buffer[record_start : position + 1]
+                    record_start = None
+                    if marker is None or marker in raw_record:
+                        yield json.loads(raw_record)
+                elif records_depth is not None and depth < records_depth:
+                    # "Records" array is closed, ignore whatever comes after it
+                    records_depth = -1
+            position += 1
+            filler_start = position
+
+    buffer += decoder.decode(b"", final=True)
+    if not started or depth != 0 or record_start is not None or buffer[position:].strip():
+        raise json.JSONDecodeError("Unexpected end of cloudtrail log", buffer, position)
@@ -1,33 +1,65 @@
-import boto3
+from collections import Counter, defaultdict
 
-from . import settings
+from .metrics import bytes_scanned_metric
 
 """
 This class sends metrics about finished athena queries to Cloudwatch
 """
 
+# limits of a single put_metric_data call and of a single metric datum
+MAX_METRICS_PER_CALL = 1000
+MAX_VALUES_PER_CALL = 10000
+MAX_VALUES_PER_METRIC = 150
+
 
 class CloudwatchMetrics:
-    cloudwatch = boto3.client("cloudwatch")
+    """
+    Per user scanned size datapoints are buffered during an invocation and sent on flush() as Values/Counts arrays,
+    so all queries finished in an invocation cost as few put_metric_data calls as possible
+    """
+
+    def __init__(self, config, cloudwatch):
+        self.config = config
+        self.cloudwatch = cloudwatch
+        self.values = defaultdict(Counter)
 
-    @classmethod
-    def report_query_metric(cls, metric_value, user):
+    def report_query_metric(self, metric_value, user):
         """
-        Send metric to cloudwatch about the scanned size for the particular query
+        Buffer the scanned size of a particular query until flush()
         You just need to submit scanned size and the name of the user, who submitted the query
         """
-        metric_data = cls._prepare_metric_dict(metric_value, user)
-        cls.cloudwatch.put_metric_data(MetricData=metric_data, Namespace=settings.CLOUDWATCH_METRIC_NAMESPACE)
-
-    @classmethod
-    def _prepare_metric_dict(cls, value, user):
-        return [
-            {
-                "MetricName": settings.CLOUDWATCH_METRIC_NAME,
+        self.values[user][metric_value] += 1
+
+    def flush(self):
+        metric_data = []
+        values_count = 0
+        for user, counts in self.values.items():
+            for metric_dict in self._prepare_metric_dicts(counts, user):
+                values_in_call = values_count + len(metric_dict["Values"])
+                if len(metric_data) >= MAX_METRICS_PER_CALL or values_in_call > MAX_VALUES_PER_CALL:
+                    self._put_metric_data(metric_data)
+                    metric_data = []
+                    values_count = 0
+                metric_data.append(metric_dict)
+                values_count += len(metric_dict["Values"])
+        self.values.clear()
+        if metric_data:
+            self._put_metric_data(metric_data)
+
+    def _put_metric_data(self, metric_data):
+        self.cloudwatch.put_metric_data(MetricData=metric_data, Namespace=self.config.CLOUDWATCH_METRIC_NAMESPACE)
+
+    def _prepare_metric_dicts(self, counts, user):
+        metric = bytes_scanned_metric(self.config)
+        values = sorted(counts.items())
+        for i in range(0, len(values), MAX_VALUES_PER_METRIC):
+            chunk = values[i : i + MAX_VALUES_PER_METRIC]
+            yield {
+                "MetricName": metric.name,
                 "Dimensions": [
                     {"Name": "athena_user", "Value": user},
                 ],
-                "Unit": "Bytes",
-                "Value": value,
-            },
-        ]
+                "Unit": metric.unit,
+                "Values": [value for value, _ in chunk],
+                "Counts": [count for _, count in chunk],
+            }
@@ -0,0 +1,91 @@
+"""
+Conversions of AthenaQuery to and from DynamoDB items and sqs message bodies.
+
+Message bodies are json objects with the query fields and a "version" field with CODEC_VERSION, so consumers can
+tell formats apart. Bodies written before versioning have no version field and the same fields as version 1.
+Version 2 added query_sql_ref and query_sql_hash: query_sql is null if the query text has been moved to s3, consumers
+needing it fetch it with sql_store.SqlStore.get_sql. Version 3 added query_fingerprint, see fingerprint.py.
+Version 4 added account_id and region. Version 5 added auto_cancelled, bodies of queries still running (query_state
+RUNNING) are sent as live alerts.
+Unknown fields - e.g. attributes added to DynamoDB items by other features, or fields of newer message versions - are
+ignored instead of failing, missing optional fields get their defaults.
+
+orjson is used for json if it's installed (e.g. from a lambda layer), it's a few times faster than the json module.
+"""
+
+from decimal import Decimal
+
+from .model import AthenaQuery
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+    import json
+
+CODEC_VERSION = 5
+VERSION_FIELD = "version"
+FIELDS = AthenaQuery.__slots__
+
+
+if orjson:
+
+    def dumps(value):
+        return orjson.dumps(value).decode("utf-8")
+
+    loads = orjson.loads
+
+else:
+
+    def dumps(value):
+        return json.dumps(value, separators=(",", ":"))
+
+    loads = json.loads
+
+
+def from_dict(values):
+    """Build a query from a mapping, ignoring fields which are not a part of the model"""
+    return AthenaQuery(
+        values["start_date"],
+        values["start_timestamp"],
+        values["query_execution_id"],
+        values["query_state"],
+        values["executing_user"],
+        values.get("data_scanned", 0),
+        values.get("query_sql"),
+        values.get("query_sql_ref"),
+        values.get("query_sql_hash"),
+        values.get("query_fingerprint"),
+        values.get("account_id"),
+        values.get("region"),
+        values.get("auto_cancelled"),
+    )
+
+
+def to_item(query):
+    """DynamoDB item of a query, DynamoDB does not support empty strings, so None values are dropped"""
+    item = {}
+    for field in FIELDS:
+        value = getattr(query, field)
+        if value is not None:
+            item[field] = value
+    return item
+
+
+def from_item(item):
+    query = from_dict(item)
+    # the DynamoDB resource returns all numbers as Decimal
+    if isinstance(query.data_scanned, Decimal):
+        query.data_scanned = int(query.data_scanned)
+    return query
+
+
+def to_body(query):
+    """sqs message body of a query"""
+    values = {field: getattr(query, field) for field in FIELDS}
+    values[VERSION_FIELD] = CODEC_VERSION
+    return dumps(values)
+
+
+def from_body(body):
+    return from_dict(loads(body))
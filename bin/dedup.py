@@ -0,0 +1,177 @@
+"""
+Suppression of duplicated work caused by at-least-once delivery of s3 event notifications and sqs messages.
+
+A key of a unit of work, e.g. a cloudtrail log or a query notified by a notificator, is claimed before the work is
+started and completed once it's done, further deliveries of the same key are dropped before any other api call.
+Claims are leases which expire after CLAIM_TTL seconds, longer than any lambda timeout and shorter than the s3 and sqs
+retry delays, so work which crashed or timed out is picked up by the retry. Failed work releases its claim right away.
+Completed keys are remembered for DONE_TTL seconds.
+
+The same store keeps markers of events which arrived too early to be handled, e.g. a query finished before it was
+inserted (see query_state_change.py). They are looked up by whoever can handle the event later and removed once it has
+been handled.
+
+The in memory tier is a class attribute, so it survives warm lambda invocations and drops duplicates within a batch
+without any api call. The persistent tier is an optional DynamoDB table with TTL enabled on the expires_at attribute
+(DEDUP_TABLE in settings), shared by all containers. Claims are conditional puts, so only one of concurrent deliveries
+gets to do the work.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from . import clients
+from .metrics import DUPLICATES_SKIPPED, NOOP_METRICS
+
+MAX_MEMORY_ENTRIES = 4096
+CLAIM_TTL = 60
+DONE_TTL = 7 * 24 * 3600
+MARK_TTL = 24 * 3600
+# maximum number of keys in a single BatchGetItem request
+BATCH_GET_SIZE = 100
+
+logger = logging.getLogger()
+
+
+def file_key(bucket, key):
+    return f"file#{bucket}/{key}"
+
+
+def notification_key(notificator, event_id):
+    return f"notified#{notificator}#{event_id}"
+
+
+def finished_key(query_execution_id):
+    return f"finished#{query_execution_id}"
+
+
+class Dedup:
+    """No-op deduplication, every key is processed. Used by default, e.g. by backfills and in tests"""
+
+    def run_once(self, key, function):
+        """Call function unless key has already been processed, returns False if the call was skipped"""
+        if not self.claim(key):
+            logger.info(f"Skipping {key}, it has already been processed")
+            return False
+        try:
+            function()
+        except Exception:
+            self.release(key)
+            raise
+        self.complete(key)
+        return True
+
+    def claim(self, key):
+        return True
+
+    def complete(self, key):
+        pass
+
+    def release(self, key):
+        pass
+
+    def mark(self, key):
+        pass
+
+    def marked(self, keys):
+        """Returns the subset of keys which are marked"""
+        return set()
+
+
+NO_DEDUP = Dedup()
+
+
+class DedupStore(Dedup):
+
+    _memory = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, config, dynamodb=None, metrics=NOOP_METRICS):
+        self.config = config
+        self.dynamodb = dynamodb
+        self.metrics = metrics
+        self._table = None
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._memory.clear()
+
+    @property
+    def table(self):
+        table_name = getattr(self.config, "DEDUP_TABLE", None)
+        if not table_name:
+            return None
+        if self._table is None:
+            if self.dynamodb is None:
+                self.dynamodb = clients.resource("dynamodb")
+            self._table = self.dynamodb.Table(table_name)
+        return self._table
+
+    def claim(self, key):
+        """Returns False if key is completed or claimed by someone else, otherwise claims it"""
+        now = int(time.time())
+        with self._lock:
+            expires_at = self._memory.get(key)
+            if expires_at and expires_at > now:
+                self.metrics.count(DUPLICATES_SKIPPED)
+                return False
+        if self.table:
+            try:
+                self.table.put_item(
+                    Item={"cache_key": key, "expires_at": now + CLAIM_TTL},
+                    # expired items may still be present as TTL deletion is not immediate
+                    ConditionExpression="attribute_not_exists(cache_key) OR expires_at < :now",
+                    ExpressionAttributeValues={":now": now},
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                    self.metrics.count(DUPLICATES_SKIPPED)
+                    return False
+                raise
+        self._remember(key, now + CLAIM_TTL)
+        return True
+
+    def complete(self, key):
+        expires_at = int(time.time()) + DONE_TTL
+        self._remember(key, expires_at)
+        if self.table:
+            self.table.put_item(Item={"cache_key": key, "expires_at": expires_at})
+
+    def release(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+        if self.table:
+            self.table.delete_item(Key={"cache_key": key})
+
+    def mark(self, key):
+        expires_at = int(time.time()) + MARK_TTL
+        self._remember(key, expires_at)
+        if self.table:
+            self.table.put_item(Item={"cache_key": key, "expires_at": expires_at})
+
+    def marked(self, keys):
+        now = int(time.time())
+        with self._lock:
+            found = {key for key in keys if self._memory.get(key, 0) > now}
+        keys = [key for key in dict.fromkeys(keys) if key not in found]
+        if not self.table or not keys:
+            return found
+        for i in range(0, len(keys), BATCH_GET_SIZE):
+            request = {self.table.name: dict(Keys=[dict(cache_key=key) for key in keys[i : i + BATCH_GET_SIZE]])}
+            # unprocessed keys are not retried, a marker is only a shortcut for work which is done later anyway
+            response = self.dynamodb.batch_get_item(RequestItems=request)
+            items = response.get("Responses", {}).get(self.table.name, [])
+            found.update(item["cache_key"] for item in items if item["expires_at"] > now)
+        return found
+
+    def _remember(self, key, expires_at):
+        with self._lock:
+            self._memory[key] = expires_at
+            self._memory.move_to_end(key)
+            while len(self._memory) > MAX_MEMORY_ENTRIES:
+                self._memory.popitem(last=False)
@@ -0,0 +1,265 @@
+"""
+Exports the queries table to date partitioned files for offline analysis, e.g. with athena itself or pandas.
+
+Files are written to an output directory in hive style partitions, start_date=<YYYY-MM-DD>/part-<worker>-<n>.<ext>,
+as Parquet if pyarrow is installed or as gzipped csv otherwise. start_date is not repeated in the files, it's the
+partition column.
+
+A full export reads the table with a parallel scan, its segments are read by a pool of threads. Rows are buffered per
+day and written to a new file once a worker holds MAX_BUFFERED_ROWS of them, so memory use doesn't depend on the table
+size. An incremental export only reads the partitions of days since the last exported one, one query per day (and
+shard), and replaces their files. The last REEXPORT_DAYS exported days are read again, as queries of those days may
+have been still running or not inserted yet when they were exported. Files are written to a temporary directory in
+the output directory first, the partition of a day is replaced only once the day has been exported (by all segments for
+a full export), so a failed export leaves the previously exported files in place. A nightly refresh of a local copy:
+    python -m bin.export athena_export --incremental
+    aws s3 sync --delete athena_export s3://my-bucket/athena_export
+"""
+
+import argparse
+import csv
+import gzip
+import logging
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from . import clients, codec, settings
+from .poll_schedule import MAX_POLL_AGE
+from .query_dao import QueryDao
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover - depends on the environment
+    pyarrow = None
+
+PARQUET = "parquet"
+CSV = "csv"
+DEFAULT_SEGMENTS = 8
+MAX_BUFFERED_ROWS = 50000
+REEXPORT_DAYS = math.ceil(MAX_POLL_AGE / (24 * 3600))
+DATE_FORMAT = "%Y-%m-%d"
+PARTITION_PATTERN = re.compile(r"^start_date=(\d{4}-\d{2}-\d{2})$")
+# start_date is the partition column
+COLUMNS = tuple(field for field in codec.FIELDS if field != "start_date")
+# columns which are not strings, by their parquet type
+INT_COLUMNS = ("data_scanned",)
+BOOL_COLUMNS = ("auto_cancelled",)
+
+logger = logging.getLogger()
+
+
+def write_csv(path, rows):
+    with gzip.open(path, "wt", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        writer.writerows(rows)
+
+
+def parquet_type(name):
+    if name in INT_COLUMNS:
+        return pyarrow.int64()
+    if name in BOOL_COLUMNS:
+        return pyarrow.bool_()
+    return pyarrow.string()
+
+
+def write_parquet(path, rows):
+    columns = list(zip(*rows))
+    schema = pyarrow.schema([(name, parquet_type(name)) for name in COLUMNS])
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema
+    )
+    pyarrow.parquet.write_table(table, path, compression="snappy")
+
+
+WRITERS = {PARQUET: (write_parquet, ".parquet"), CSV: (write_csv, ".csv.gz")}
+
+
+def default_format():
+    return PARQUET if pyarrow else CSV
+
+
+def exported_dates(output):
+    """Dates of all partitions in the output directory, sorted"""
+    if not os.path.isdir(output):
+        return []
+    matches = (PARTITION_PATTERN.match(name) for name in os.listdir(output))
+    return sorted(match.group(1) for match in matches if match)
+
+
+class PartitionWriter:
+    """Buffers rows of a single worker per day, writing each day to new files once too many rows are buffered"""
+
+    def __init__(self, output, name, file_format):
+        self.output = output
+        self.name = name
+        self.write, self.extension = WRITERS[file_format]
+        self.buffers = {}
+        self.buffered = 0
+        self.files = 0
+        self.rows = 0
+
+    def add(self, queries):
+        for query in queries:
+            self.buffers.setdefault(query.start_date, []).append(tuple(getattr(query, name) for name in COLUMNS))
+        self.buffered += len(queries)
+        while self.buffered >= MAX_BUFFERED_ROWS:
+            self.flush(max(self.buffers, key=lambda day: len(self.buffers[day])))
+
+    def flush(self, day):
+        rows = self.buffers.pop(day)
+        directory = os.path.join(self.output, f"start_date={day}")
+        os.makedirs(directory, exist_ok=True)
+        self.write(os.path.join(directory, f"part-{self.name}-{self.files:05d}{self.extension}"), rows)
+        self.buffered -= len(rows)
+        self.files += 1
+        self.rows += len(rows)
+
+    def close(self):
+        for day in list(self.buffers):
+            self.flush(day)
+
+
+class QueryExport:
+
+    def __init__(self, query_dao, output, file_format=None, segments=DEFAULT_SEGMENTS):
+        self.query_dao = query_dao
+        self.output = output
+        self.file_format = file_format or default_format()
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.stats = dict(rows=0, files=0, days=0)
+
+    def run(self, since=None, until=None):
+        """
+        Export queries started since the given date until the given one, both included and in the YYYY-MM-DD format,
+        or the whole table if since is None. Files of the exported days are replaced.
+        """
+        self.start = time.perf_counter()
+        os.makedirs(self.output, exist_ok=True)
+        # next to the partitions, so they are replaced by renames, hidden from exported_dates by its name
+        self.staging = tempfile.mkdtemp(prefix=".export-", dir=self.output)
+        try:
+            if since is None:
+                logger.info(f"Exporting {self.query_dao.config.QUERIES_TABLE} in {self.segments} segments")
+                self._run_workers(self.export_segment, range(self.segments))
+                # days are complete only once all segments have been exported
+                for day in set(exported_dates(self.output)) | set(exported_dates(self.staging)):
+                    self._replace_partition(day)
+            else:
+                until = until or datetime.now(timezone.utc).strftime(DATE_FORMAT)
+                logger.info(f"Exporting queries started from {since} to {until}")
+                self._run_workers(self.export_day, list(days_between(since, until)))
+        finally:
+            shutil.rmtree(self.staging, ignore_errors=True)
+        self.stats["days"] = len(exported_dates(self.output))
+        self.report()
+        return self.stats
+
+    def _run_workers(self, work, items):
+        with ThreadPoolExecutor(max_workers=self.segments) as executor:
+            # consume the results, so that errors of the workers are raised
+            list(executor.map(work, items))
+
+    def incremental_since(self):
+        """First day of an incremental export, None if nothing has been exported yet"""
+        dates = exported_dates(self.output)
+        if not dates:
+            return None
+        last = datetime.strptime(dates[-1], DATE_FORMAT).date()
+        return (last - timedelta(days=REEXPORT_DAYS)).strftime(DATE_FORMAT)
+
+    def _replace_partition(self, day):
+        """Replace the partition of a day with its staged files, or remove it if no queries of the day were exported"""
+        partition = f"start_date={day}"
+        target = os.path.join(self.output, partition)
+        staged = os.path.join(self.staging, partition)
+        replaced = os.path.join(self.staging, f"replaced-{day}")
+        # a directory can't be renamed over a non-empty one, so the old partition is moved aside first
+        if os.path.isdir(target):
+            os.rename(target, replaced)
+        if os.path.isdir(staged):
+            os.rename(staged, target)
+        shutil.rmtree(replaced, ignore_errors=True)
+
+    def export_segment(self, segment):
+        writer = PartitionWriter(self.staging, str(segment), self.file_format)
+        for queries in self.query_dao.scan_segment(segment, self.segments):
+            writer.add(queries)
+        writer.close()
+        self._add_stats(writer)
+        logger.info(f"Segment {segment} exported")
+
+    def export_day(self, day):
+        writer = PartitionWriter(self.staging, "0", self.file_format)
+        writer.add(self.query_dao.get_day_queries(day))
+        writer.close()
+        self._replace_partition(day)
+        self._add_stats(writer)
+
+    def _add_stats(self, writer):
+        with self.lock:
+            self.stats["rows"] += writer.rows
+            self.stats["files"] += writer.files
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        stats = self.stats
+        logger.info(
+            f"{stats['rows']} queries exported to {stats['files']} {self.file_format} files, "
+            f"{stats['days']} days in {self.output}, {stats['rows'] / elapsed:.0f} queries/s"
+        )
+
+
+def days_between(since, until):
+    """Yield YYYY-MM-DD strings of all days from since to until, both included"""
+    day = datetime.strptime(since, DATE_FORMAT).date()
+    last = datetime.strptime(until, DATE_FORMAT).date()
+    while day <= last:
+        yield day.strftime(DATE_FORMAT)
+        day += timedelta(days=1)
+
+
+def date_argument(value):
+    """A YYYY-MM-DD date argument"""
+    return datetime.strptime(value, DATE_FORMAT).strftime(DATE_FORMAT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", help="directory to write the partitions to")
+    parser.add_argument(
+        "--format",
+        choices=(PARQUET, CSV),
+        default=default_format(),
+        help="file format, parquet needs pyarrow to be installed",
+    )
+    parser.add_argument("--since", type=date_argument, help="export only queries started since this YYYY-MM-DD date")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=f"export only days since the last exported one, re-exporting the last {REEXPORT_DAYS} days",
+    )
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS, help="number of parallel workers")
+    args = parser.parse_args()
+    if args.format == PARQUET and not pyarrow:
+        parser.error("pyarrow needs to be installed to export to parquet")
+    if args.since and args.incremental:
+        parser.error("--since and --incremental are exclusive")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    export = QueryExport(QueryDao(settings, clients.resource("dynamodb")), args.output, args.format, args.segments)
+    since = export.incremental_since() if args.incremental else args.since
+    export.run(since)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Fingerprints of query texts, identifying runs of the same query with different literals, e.g. a dashboard query run
+every few minutes for a different date range.
+
+A text is normalised before it's hashed: comments are dropped, string and number literals are replaced with ?, lists
+of literals like IN (1, 2, 3) are collapsed to (?), whitespace is collapsed and the text is lowercased. Quoted
+identifiers are kept as they are, athena identifiers are case insensitive, so they are lowercased as well.
+"""
+
+import hashlib
+import re
+
+FINGERPRINT_LENGTH = 16
+
+_TOKENS = re.compile(
+    r"""
+    (?P<string>'(?:[^']|'')*')
+    |(?P<identifier>"(?:[^"]|"")*")
+    |(?P<comment>--[^\n]*|/\*.*?\*/)
+    |(?P<number>\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+_SPACES = re.compile(r"\s+")
+_PUNCTUATION_SPACE = re.compile(r"\s*([(),=<>!+*/%;\[\]|-])\s*")
+_LITERAL_LIST = re.compile(r"\(\?(?:,\?)+\)")
+
+
+def _replace_token(match):
+    kind = match.lastgroup
+    if kind in ("string", "number"):
+        return "?"
+    if kind == "comment":
+        return " "
+    return match.group()
+
+
+def normalise(sql):
+    """Text of a query with literals, comments and formatting removed"""
+    text = _SPACES.sub(" ", _TOKENS.sub(_replace_token, sql)).lower()
+    text = _PUNCTUATION_SPACE.sub(r"\1", text)
+    text = _LITERAL_LIST.sub("(?)", text)
+    return text.strip().rstrip(";")
+
+
+def fingerprint(sql):
+    """Fingerprint of a query text, the same for texts differing only in literals, comments and formatting"""
+    return hashlib.sha256(normalise(sql).encode("utf-8")).hexdigest()[:FINGERPRINT_LENGTH]
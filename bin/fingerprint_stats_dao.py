@@ -0,0 +1,155 @@
+"""
+Per fingerprint counters of finished queries, kept per day, see fingerprint.py.
+
+Every finished query is added to the item of its fingerprint and start date with an atomic ADD update, so concurrent
+lambdas never lose an update. Items of a day share a partition, so the most expensive repeated queries of the last days
+are reported by reading a partition per day rather than scanning the queries table. Items are removed by DynamoDB TTL
+after RETENTION_DAYS. Cost is derived from data scanned with ATHENA_PRICE_PER_TB, the same as in notifications.
+
+The report is printed by:
+    python -m bin.fingerprint_stats_dao --days 7 --limit 20
+"""
+
+import argparse
+import calendar
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+from boto3.dynamodb.conditions import Key
+
+from . import clients, settings
+from .fingerprint import normalise
+from .metrics import DYNAMODB_READ_TIME, DYNAMODB_WRITE_TIME, NOOP_METRICS
+from .query_dao import QueryDao
+from .sql_store import SqlStore
+
+RETENTION_DAYS = 90
+DATE_FORMAT = "%Y-%m-%d"
+TB = 1024**4
+
+
+@dataclass
+class FingerprintStats:
+    query_fingerprint: str
+    query_count: int = 0
+    data_scanned: int = 0
+    executing_users: set = field(default_factory=set)
+    sample_query_execution_id: str = None
+
+    def cost(self, price_per_tb):
+        return self.data_scanned / TB * price_per_tb
+
+    def add(self, other):
+        self.query_count += other.query_count
+        self.data_scanned += other.data_scanned
+        self.executing_users |= other.executing_users
+        self.sample_query_execution_id = self.sample_query_execution_id or other.sample_query_execution_id
+
+
+class FingerprintStatsDao:
+
+    def __init__(self, config, dynamodb=None, metrics=NOOP_METRICS):
+        self.config = config
+        self.dynamodb = dynamodb
+        self.metrics = metrics
+
+    @property
+    def table_name(self):
+        return getattr(self.config, "FINGERPRINT_STATS_TABLE", None)
+
+    def _table(self):
+        if self.dynamodb is None:
+            self.dynamodb = clients.resource("dynamodb")
+        return self.dynamodb.Table(self.table_name)
+
+    def add_query(self, query):
+        """Add a finished query to the counters of its fingerprint, queries without a fingerprint are skipped"""
+        if not self.table_name or not query.query_fingerprint:
+            return
+        day_start = calendar.timegm(time.strptime(query.start_date, DATE_FORMAT))
+        with self.metrics.timer(DYNAMODB_WRITE_TIME):
+            self._table().update_item(
+                Key=dict(start_date=query.start_date, query_fingerprint=query.query_fingerprint),
+                UpdateExpression=(
+                    "ADD query_count :one, data_scanned :data_scanned, executing_users :users "
+                    "SET sample_query_execution_id = if_not_exists(sample_query_execution_id, :id), "
+                    "expires_at = :expires_at"
+                ),
+                ExpressionAttributeValues={
+                    ":one": 1,
+                    ":data_scanned": query.data_scanned,
+                    ":users": {query.executing_user},
+                    ":id": query.query_execution_id,
+                    ":expires_at": day_start + RETENTION_DAYS * 24 * 3600,
+                },
+            )
+
+    def get_day(self, date):
+        """Counters of all fingerprints of queries started on date"""
+        kwargs = dict(KeyConditionExpression=Key("start_date").eq(date))
+        table = self._table()
+        stats = []
+        while True:
+            with self.metrics.timer(DYNAMODB_READ_TIME):
+                response = table.query(**kwargs)
+            stats.extend(self._to_stats(item) for item in response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                return stats
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def get_top(self, dates, limit, order_by="data_scanned"):
+        """
+        Fingerprints of queries started on dates with the highest order_by counter, data_scanned or query_count.
+        Counters are summed over the days.
+        """
+        totals = {}
+        for date in dates:
+            for stats in self.get_day(date):
+                if stats.query_fingerprint in totals:
+                    totals[stats.query_fingerprint].add(stats)
+                else:
+                    totals[stats.query_fingerprint] = stats
+        return sorted(totals.values(), key=lambda stats: getattr(stats, order_by), reverse=True)[:limit]
+
+    @staticmethod
+    def _to_stats(item):
+        # the DynamoDB resource returns all numbers as Decimal
+        return FingerprintStats(
+            query_fingerprint=item["query_fingerprint"],
+            query_count=int(item.get("query_count", 0)),
+            data_scanned=int(item.get("data_scanned", 0)),
+            executing_users=set(item.get("executing_users", ())),
+            sample_query_execution_id=item.get("sample_query_execution_id"),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=7, help="number of days to report, including today")
+    parser.add_argument("--limit", type=int, default=20, help="number of fingerprints to report")
+    parser.add_argument(
+        "--order-by", choices=("data_scanned", "query_count"), default="data_scanned", help="counter to rank by"
+    )
+    args = parser.parse_args()
+    if not getattr(settings, "FINGERPRINT_STATS_TABLE", None):
+        parser.error("FINGERPRINT_STATS_TABLE is not configured in settings")
+
+    today = datetime.now(timezone.utc).date()
+    dates = [(today - timedelta(days=days)).strftime(DATE_FORMAT) for days in range(args.days)]
+    dynamodb = clients.resource("dynamodb")
+    query_dao = QueryDao(settings, dynamodb)
+    sql_store = SqlStore(settings)
+    print(f"{'fingerprint':<17} {'runs':>7} {'GB scanned':>11} {'cost $':>9} {'users':>5}  query")
+    for stats in FingerprintStatsDao(settings, dynamodb).get_top(dates, args.limit, args.order_by):
+        sample = query_dao.get_query(stats.sample_query_execution_id) if stats.sample_query_execution_id else None
+        sql = sql_store.get_sql(sample) if sample else None
+        print(
+            f"{stats.query_fingerprint:<17} {stats.query_count:>7} {stats.data_scanned / 1024**3:>11.1f} "
+            f"{stats.cost(settings.ATHENA_PRICE_PER_TB):>9.2f} {len(stats.executing_users):>5}  "
+            f"{normalise(sql)[:80] if sql else ''}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Per-stage latency and throughput instrumentation shared by all lambdas.
+
+Timings and counters collected during an invocation are written on flush as a CloudWatch Embedded Metric Format
+log line, which CloudWatch turns into metrics asynchronously, so no API calls are made on the hot path.
+The base Metrics class is a no-op backend used by default, e.g. in tests.
+"""
+
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import ContextDecorator
+from dataclasses import dataclass
+
+MILLISECONDS = "Milliseconds"
+COUNT = "Count"
+BYTES = "Bytes"
+
+# EMF limits values of a single metric and number of metrics in a single log line to 100
+MAX_EMF_VALUES = 100
+MAX_EMF_METRICS = 100
+
+
+@dataclass(frozen=True)
+class MetricDefinition:
+    name: str
+    unit: str
+
+
+S3_GET_OBJECT_TIME = MetricDefinition("S3GetObjectTime", MILLISECONDS)
+S3_DOWNLOAD_TIME = MetricDefinition("S3DownloadTime", MILLISECONDS)
+S3_PUT_OBJECT_TIME = MetricDefinition("S3PutObjectTime", MILLISECONDS)
+PREFILTER_TIME = MetricDefinition("PrefilterTime", MILLISECONDS)
+DECOMPRESS_TIME = MetricDefinition("DecompressTime", MILLISECONDS)
+PARSE_TIME = MetricDefinition("ParseTime", MILLISECONDS)
+DYNAMODB_READ_TIME = MetricDefinition("DynamoDBReadTime", MILLISECONDS)
+DYNAMODB_WRITE_TIME = MetricDefinition("DynamoDBWriteTime", MILLISECONDS)
+ATHENA_CALL_TIME = MetricDefinition("AthenaCallTime", MILLISECONDS)
+SQS_SEND_TIME = MetricDefinition("SQSSendTime", MILLISECONDS)
+SLACK_CALL_TIME = MetricDefinition("SlackCallTime", MILLISECONDS)
+STS_ASSUME_ROLE_TIME = MetricDefinition("STSAssumeRoleTime", MILLISECONDS)
+
+FILES_PARSED = MetricDefinition("FilesParsed", COUNT)
+FILES_SKIPPED = MetricDefinition("FilesSkipped", COUNT)
+QUERIES_INSERTED = MetricDefinition("QueriesInserted", COUNT)
+QUERIES_POLLED = MetricDefinition("QueriesPolled", COUNT)
+QUERIES_FINALISED = MetricDefinition("QueriesFinalised", COUNT)
+QUERIES_CANCELLED = MetricDefinition("QueriesCancelled", COUNT)
+LIVE_ALERTS_SENT = MetricDefinition("LiveAlertsSent", COUNT)
+EVENTS_PUBLISHED = MetricDefinition("EventsPublished", COUNT)
+NOTIFICATIONS_SENT = MetricDefinition("NotificationsSent", COUNT)
+MESSAGES_FAILED = MetricDefinition("MessagesFailed", COUNT)
+DUPLICATES_SKIPPED = MetricDefinition("DuplicatesSkipped", COUNT)
+SLACK_CACHE_HITS = MetricDefinition("SlackCacheHits", COUNT)
+SLACK_CACHE_MISSES = MetricDefinition("SlackCacheMisses", COUNT)
+
+
+def bytes_scanned_metric(config):
+    """Per user data scanned metric, its name is configurable in settings"""
+    return MetricDefinition(config.CLOUDWATCH_METRIC_NAME, BYTES)
+
+
+class Metrics:
+    """
+    No-op metrics backend. Subclasses override record, count and flush.
+    Timers report exclusive time - time spent in nested timers is reported by those timers only - so stages
+    pulling data from each other (e.g. parsing a stream which is being decompressed) are measured separately.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def timer(self, metric):
+        """Context manager or decorator reporting the time spent in the block"""
+        return _Timer(self, metric)
+
+    def timed(self, metric, iterable):
+        """Wrap an iterable, reporting the total time spent producing its items as a single value"""
+        iterator = iter(iterable)
+        total = 0.0
+        try:
+            while True:
+                timer = _Timer(self, metric, report=False)
+                with timer:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                total += timer.exclusive
+                yield item
+            total += timer.exclusive
+        finally:
+            self.record(metric, total * 1000)
+
+    def record(self, metric, value):
+        pass
+
+    def count(self, metric, value=1):
+        pass
+
+    def flush(self):
+        pass
+
+    def _timers(self):
+        if not hasattr(self._local, "timers"):
+            self._local.timers = []
+        return self._local.timers
+
+
+NOOP_METRICS = Metrics()
+
+
+class _Timer(ContextDecorator):
+
+    def __init__(self, metrics, metric, report=True):
+        self.metrics = metrics
+        self.metric = metric
+        self.report = report
+        self.exclusive = 0.0
+
+    def _recreate_cm(self):
+        # each decorated call needs its own timer
+        return _Timer(self.metrics, self.metric, self.report)
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.start = time.perf_counter()
+        self.metrics._timers().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        timers = self.metrics._timers()
+        timers.pop()
+        if timers:
+            timers[-1].nested += elapsed
+        self.exclusive = elapsed - self.nested
+        if self.report:
+            self.metrics.record(self.metric, self.exclusive * 1000)
+
+
+class EmbeddedMetrics(Metrics):
+    """
+    Collects metrics in memory and writes them as CloudWatch Embedded Metric Format json lines on flush.
+    Timer values are reported individually, so CloudWatch statistics (count, average, percentiles) are available,
+    counters are summed up.
+    """
+
+    def __init__(self, namespace, dimensions, stream=None):
+        super().__init__()
+        self.namespace = namespace
+        self.dimensions = dimensions
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.values = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    def record(self, metric, value):
+        with self.lock:
+            self.values[metric].append(value)
+
+    def count(self, metric, value=1):
+        with self.lock:
+            self.counters[metric] += value
+
+    def flush(self):
+        with self.lock:
+            values = dict(self.values)
+            values.update({metric: [value] for metric, value in self.counters.items()})
+            self.values.clear()
+            self.counters.clear()
+
+        stream = self.stream or sys.stdout
+        while values:
+            document = self._document(values)
+            stream.write(json.dumps(document) + "\n")
+        stream.flush()
+
+    def _document(self, values):
+        """Build a single EMF document, removing the values it contains from the given dict"""
+        metrics = list(values)[:MAX_EMF_METRICS]
+        document = dict(
+            _aws=dict(
+                Timestamp=int(time.time() * 1000),
+                CloudWatchMetrics=[
+                    dict(
+                        Namespace=self.namespace,
+                        Dimensions=[list(self.dimensions)],
+                        Metrics=[dict(Name=metric.name, Unit=metric.unit) for metric in metrics],
+                    )
+                ],
+            ),
+            **self.dimensions,
+        )
+        for metric in metrics:
+            document[metric.name] = values[metric][:MAX_EMF_VALUES]
+            values[metric] = values[metric][MAX_EMF_VALUES:]
+            if not values[metric]:
+                del values[metric]
+        return document
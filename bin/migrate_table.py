@@ -0,0 +1,94 @@
+"""
+Copies all queries from one queries table to another, e.g. from a table with the original date keyed schema to a new
+table with sharded keys (see QUERIES_TABLE_SHARDS in settings).
+
+The source table is read with a parallel scan, its segments are copied by a pool of threads. Items are converted to
+queries and written with the key schema of the target table using batch writes which skip queries already present in the
+target, carrying over storage only attributes like the live alert marker, so the lambdas may already be writing to the
+new table while the copy runs and re-running an interrupted migration is safe. To migrate without downtime:
+1. create the new table, e.g. by deploying the cloudformation stack with a new DynamoDBTableName and QueriesTableShards,
+2. switch the lambdas over: deploy them with QUERIES_TABLE set to the new table and QUERIES_TABLE_SHARDS configured,
+3. copy the old table right away, queries still in flight are finalised by usage_update once they are copied:
+    python -m bin.migrate_table athena_queries
+4. delete the old table.
+The target table and its number of shards are taken from settings unless given as arguments.
+"""
+
+import argparse
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from . import clients, settings
+from .metrics import NOOP_METRICS
+from .query_dao import QueryDao
+
+DEFAULT_SEGMENTS = 8
+
+logger = logging.getLogger()
+
+
+class TableMigration:
+
+    def __init__(self, dynamodb, source_table, query_dao, segments=DEFAULT_SEGMENTS, metrics=NOOP_METRICS):
+        self.source_table = source_table
+        # only scanned, so the key schema of the source doesn't matter
+        self.source_dao = QueryDao(SimpleNamespace(QUERIES_TABLE=source_table), dynamodb, metrics)
+        self.query_dao = query_dao
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.stats = dict(scanned=0, copied=0)
+
+    def run(self):
+        logger.info(f"Copying {self.source_table} to {self.query_dao.config.QUERIES_TABLE} in {self.segments} segments")
+        self.start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.segments) as executor:
+            # consume the results, so that errors of the segments are raised
+            list(executor.map(self.copy_segment, range(self.segments)))
+        self.report()
+        return self.stats
+
+    def copy_segment(self, segment):
+        """Scan a segment of the source table page by page, writing the queries of every page to the target"""
+        for items in self.source_dao.scan_segment_items(segment, self.segments):
+            copied = self.query_dao.copy_items(items)
+            with self.lock:
+                self.stats["scanned"] += len(items)
+                self.stats["copied"] += copied
+        logger.info(f"Segment {segment} copied")
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        stats = self.stats
+        logger.info(
+            f"{stats['scanned']} queries scanned, {stats['copied']} copied, "
+            f"{stats['scanned'] - stats['copied']} already present in the target, "
+            f"{stats['scanned'] / elapsed:.0f} queries/s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="name of the table to copy queries from")
+    parser.add_argument("--target", default=settings.QUERIES_TABLE, help="name of the table to copy queries to")
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=getattr(settings, "QUERIES_TABLE_SHARDS", None),
+        help="number of shards of the target table, 0 for the original date keyed schema",
+    )
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS, help="number of parallel scan segments")
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error("source and target tables must differ")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    dynamodb = clients.resource("dynamodb")
+    query_dao = QueryDao(SimpleNamespace(QUERIES_TABLE=args.target, QUERIES_TABLE_SHARDS=args.shards), dynamodb)
+    TableMigration(dynamodb, args.source, query_dao, args.segments).run()
+
+
+if __name__ == "__main__":
+    main()
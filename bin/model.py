@@ -1,4 +1,3 @@
-from dataclasses import dataclass
 from enum import Enum
 
 TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -12,16 +11,87 @@ class QueryState(Enum):
     CANCELLED = "CANCELLED"
 
 
-@dataclass
 class AthenaQuery:
-    start_date: str
-    start_timestamp: str
-    query_execution_id: str
-    query_state: str
-    executing_user: str
-    data_scanned: int = 0
-    query_sql: str = None
+    """
+    A single athena query execution. A plain class with __slots__ rather than a dataclass, as many of them are
+    created per invocation, see codec.py for conversions to DynamoDB items and sqs message bodies.
+    Long query texts may be stored in s3 instead of query_sql, query_sql_ref and query_sql_hash point to them then,
+    see sql_store.py. query_fingerprint identifies runs of the same query with different literals, see fingerprint.py.
+    account_id and region are those the query was started in, None for queries of the alerter's own account and region
+    stored before they were recorded. auto_cancelled is True for queries stopped by the alerter for scanning too much
+    data while running.
+    """
+
+    __slots__ = (
+        "start_date",
+        "start_timestamp",
+        "query_execution_id",
+        "query_state",
+        "executing_user",
+        "data_scanned",
+        "query_sql",
+        "query_sql_ref",
+        "query_sql_hash",
+        "query_fingerprint",
+        "account_id",
+        "region",
+        "auto_cancelled",
+    )
+
+    def __init__(
+        self,
+        start_date: str,
+        start_timestamp: str,
+        query_execution_id: str,
+        query_state: str,
+        executing_user: str,
+        data_scanned: int = 0,
+        query_sql: str = None,
+        query_sql_ref: str = None,
+        query_sql_hash: str = None,
+        query_fingerprint: str = None,
+        account_id: str = None,
+        region: str = None,
+        auto_cancelled: bool = None,
+    ):
+        self.start_date = start_date
+        self.start_timestamp = start_timestamp
+        self.query_execution_id = query_execution_id
+        self.query_state = query_state
+        self.executing_user = executing_user
+        self.data_scanned = data_scanned
+        self.query_sql = query_sql
+        self.query_sql_ref = query_sql_ref
+        self.query_sql_hash = query_sql_hash
+        self.query_fingerprint = query_fingerprint
+        self.account_id = account_id
+        self.region = region
+        self.auto_cancelled = auto_cancelled
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        values = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"AthenaQuery({values})"
 
 
 class UnknownEventException(Exception):
     pass
+
+
+class UnprocessedItemsException(Exception):
+    pass
+
+
+class MessagesNotSentException(Exception):
+    pass
+
+
+class SqlIntegrityException(Exception):
+    pass
@@ -9,26 +9,64 @@ import logging
 from typing import Sequence
 
 from . import settings
+from .dedup import NO_DEDUP, DedupStore, notification_key
+from .metrics import MESSAGES_FAILED, EmbeddedMetrics
 from .model import UnknownEventException
 from .notificators.notificator import Notificator
 
 logger = logging.getLogger()
 
+# notificators, their metrics and the deduplication store are created once per lambda container and reused by warm
+# invocations
+_metrics = None
+_dedup = NO_DEDUP
+_notificators: Sequence[Notificator] = ()
+
+
+def get_notificators():
+    global _metrics, _dedup, _notificators
+    if not _notificators:
+        _metrics = EmbeddedMetrics(settings.CLOUDWATCH_METRIC_NAMESPACE, dict(Function="notification"))
+        _dedup = DedupStore(settings, metrics=_metrics)
+        _notificators = [notificator(config=settings, metrics=_metrics) for notificator in settings.NOTIFICATORS]
+    return _notificators
+
 
 def lambda_handler(event, context):
     """
     This handles events and may handle more than one event type.
     If you have more events that you'd like to be notified on,
     register them in settings.py under NOTIFICATORS
+
+    Records are handled one by one and the ids of the failed ones are returned as batchItemFailures,
+    so that only these messages are redelivered by SQS. Events already handled by a notificator, e.g. redelivered
+    messages, are not passed to it again
     """
-    notificators: Sequence[Notificator] = [notificator(config=settings) for notificator in settings.NOTIFICATORS]
-
-    for record in event["Records"]:
-        for notificator in notificators:
-            if notificator.is_record_type_handled(record):
-                notificator.handle_single_event(body=record["body"])
-                break
-        else:
-            logging.error("ERROR! Unknown event type!")
-            logging.debug(json.dumps(event))
-            raise UnknownEventException("ERROR! Unknown event type!")
+    notificators = get_notificators()
+    failures = []
+    try:
+        for record in event["Records"]:
+            try:
+                handle_record(notificators, record, _dedup)
+            except Exception:
+                logger.exception(f"Failed to handle message {record.get('messageId')}")
+                _metrics.count(MESSAGES_FAILED)
+                failures.append(dict(itemIdentifier=record["messageId"]))
+    finally:
+        _metrics.flush()
+    return dict(batchItemFailures=failures)
+
+
+def handle_record(notificators, record, dedup=NO_DEDUP):
+    """Pass the record to every notificator handling its type, e.g. both single query and spend window alerts"""
+    handled = False
+    body = record["body"]
+    for notificator in notificators:
+        if notificator.is_record_type_handled(record):
+            key = notification_key(notificator.__class__.__name__, notificator.event_id(body))
+            dedup.run_once(key, lambda: notificator.handle_single_event(body=body))
+            handled = True
+    if not handled:
+        logging.error("ERROR! Unknown event type!")
+        logging.debug(json.dumps(record))
+        raise UnknownEventException("ERROR! Unknown event type!")
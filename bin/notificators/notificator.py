@@ -1,9 +1,19 @@
 import logging
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from typing import Mapping
 
 import requests
 
+from .. import codec
+from ..model import QueryState
+from ..metrics import NOOP_METRICS
+from .slack_cache import CHANNEL_TTL, NEGATIVE_TTL, USER_TTL, SlackIdentityCache, channel_key, user_key
+from .slack_client import SlackClient
+
+# shared across warm invocations, used to send independent slack messages at the same time
+_executor = ThreadPoolExecutor(max_workers=4)
+
 
 class Notificator(ABC):
     """
@@ -11,8 +21,11 @@ class Notificator(ABC):
     Handles incoming queue messages and sends slack notifications to appropriate users/channels when applicable
     """
 
-    def __init__(self, config):
+    def __init__(self, config, metrics=NOOP_METRICS):
         self.config = config
+        self.metrics = metrics
+        self.slack = SlackClient(config, metrics)
+        self.slack_cache = SlackIdentityCache(config, metrics=metrics)
 
     @classmethod
     @abstractmethod
@@ -29,34 +42,93 @@ class Notificator(ABC):
         """
         pass
 
+    def event_id(self, body) -> str:
+        """
+        Id of the event in a message body, a message with the id of an event which has already been handled by this
+        notificator is a duplicate and is dropped. By default events are queries and their execution id is used, the
+        live alert of a running query gets its own id so that it doesn't suppress the event of the finished query
+        """
+        query = codec.from_body(body)
+        if query.query_state in (QueryState.QUEUED.value, QueryState.RUNNING.value):
+            return f"{query.query_execution_id}#live"
+        return query.query_execution_id
+
+    @staticmethod
+    def send_concurrently(*calls):
+        """
+        Runs the given callables at the same time and waits for all of them, re-raising the first error
+        """
+        futures = [_executor.submit(call) for call in calls]
+        for future in futures:
+            future.result()
+
+    def get_slack_user_id(self, username):
+        if hasattr(self.config, "SLACK_USER_MAPPINGS"):
+            slack_user = self.config.SLACK_USER_MAPPINGS.get(username)
+            if slack_user:
+                return slack_user
+
+        email = username
+        if "@" not in username:
+            email = f"{username}@{self.config.SLACK_EMAIL_DOMAIN}"
+
+        try:
+            return self.slack_cache.lookup(
+                user_key(email), lambda: self.lookup_slack_user(email), USER_TTL, negative_ttl=NEGATIVE_TTL
+            )
+        except Exception as e:
+            logging.error(f"Error calling Slack API: {str(e)}")
+
+        return None
+
+    def lookup_slack_user(self, email):
+        """
+        Returns id of the slack user with the given email or None if there is no such user.
+        Raises an exception on unexpected api errors, so that they are not cached as a missing user.
+        """
+        response = self.slack.api_call("users.lookupByEmail", data={"email": email})
+        if response.status_code != 200:
+            raise RuntimeError(f"Slack API error ({response.status_code}): {response.text}")
+
+        data = response.json()
+        if data.get("ok") and data.get("user"):
+            return data["user"]["id"]
+        logging.warning(f"Failed to find Slack user for email {email}: {data.get('error')}")
+        if data.get("error") != "users_not_found":
+            raise RuntimeError(f"Slack API error: {data.get('error')}")
+        return None
+
     def send_slack_to_channel(self, text):
         """
         Sends slack notification to a channel defined in config
         """
-        requests.post(self.config.SLACK_WEBHOOK_URL, json={"text": text, "link_names": 1})
+        self.slack.post(self.config.SLACK_WEBHOOK_URL, json={"text": text, "link_names": 1})
 
     def send_slack_to_user(self, user_id, text):
         """
         Sends slack notification to the user with submitted user_id
         """
-        response = requests.post(
-            "https://slack.com/api/conversations.open",
-            headers={"Authorization": f"Bearer {self.config.SLACK_BOT_TOKEN}"},
-            json={"users": user_id},
-        )
+        channel_id = self.slack_cache.lookup(channel_key(user_id), lambda: self.open_conversation(user_id), CHANNEL_TTL)
+        if not channel_id:
+            return
+        response = self.slack.api_call("chat.postMessage", json={"channel": channel_id, "text": text})
+        if response.status_code != requests.codes.ok:
+            logging.error(f"Unexpected response from slack api when sending message: {response}")
+        elif response.json().get("error") == "channel_not_found":
+            logging.warning(f"Cached conversation with user {user_id} not found, it will be opened again next time")
+            self.slack_cache.invalidate(channel_key(user_id))
+
+    def open_conversation(self, user_id):
+        """
+        Returns id of the direct message channel with the user with submitted user_id
+        """
+        response = self.slack.api_call("conversations.open", json={"users": user_id})
         response.raise_for_status()
 
         if response.status_code == requests.codes.ok:
             j = response.json()
             if j.get("channel"):
-                channel_id = j["channel"]["id"]
-                response = requests.post(
-                    "https://slack.com/api/chat.postMessage",
-                    headers={"Authorization": f"Bearer {self.config.SLACK_BOT_TOKEN}"},
-                    json={"channel": channel_id, "text": text},
-                )
-                if response.status_code != requests.codes.ok:
-                    logging.error(f"Unexpected response from slack api when sending message: {response}")
+                return j["channel"]["id"]
             else:
                 logging.error(
                     f"Unexpected response content from slack api when "
@@ -66,3 +138,4 @@ class Notificator(ABC):
             logging.error(
                 f"Unexpected response code from slack api when opening conversation with user {user_id}: {response}"
             )
+        return None
@@ -0,0 +1,150 @@
+"""
+Cache of slack user ids and direct message channel ids used by notificators.
+
+The in memory LRU tier is a class attribute, so it survives warm lambda invocations. The persistent tier is an optional
+DynamoDB table with TTL enabled on the expires_at attribute (SLACK_CACHE_TABLE in settings), shared by all containers.
+Failed user lookups are cached too, so unknown users don't hit the slack api on every notification.
+
+The cache may be warmed up with all slack users by running:
+    python -m bin.notificators.slack_cache
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .. import clients
+from ..metrics import NOOP_METRICS, SLACK_CACHE_HITS, SLACK_CACHE_MISSES
+
+MAX_MEMORY_ENTRIES = 1024
+USER_TTL = 7 * 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+CHANNEL_TTL = 30 * 24 * 3600
+USERS_LIST_PAGE_SIZE = 200
+
+logger = logging.getLogger()
+
+
+def user_key(email):
+    return f"user#{email.lower()}"
+
+
+def channel_key(user_id):
+    return f"dm#{user_id}"
+
+
+class SlackIdentityCache:
+
+    _memory = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, config, dynamodb=None, metrics=NOOP_METRICS):
+        self.config = config
+        self.dynamodb = dynamodb
+        self.metrics = metrics
+        self._table = None
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._memory.clear()
+
+    @property
+    def table(self):
+        table_name = getattr(self.config, "SLACK_CACHE_TABLE", None)
+        if not table_name:
+            return None
+        if self._table is None:
+            if self.dynamodb is None:
+                self.dynamodb = clients.resource("dynamodb")
+            self._table = self.dynamodb.Table(table_name)
+        return self._table
+
+    def lookup(self, key, fetch, ttl, negative_ttl=None):
+        """
+        Return the cached value of key, calling fetch() on a miss. A None returned by fetch is cached for negative_ttl
+        seconds, or not at all if it's not given. Exceptions raised by fetch are never cached.
+        """
+        found, value = self._get(key)
+        if found:
+            self.metrics.count(SLACK_CACHE_HITS)
+            return value
+        self.metrics.count(SLACK_CACHE_MISSES)
+        value = fetch()
+        if value is not None:
+            self.put(key, value, ttl)
+        elif negative_ttl:
+            self.put(key, None, negative_ttl)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+        if self.table:
+            self.table.delete_item(Key={"cache_key": key})
+
+    def put(self, key, value, ttl, writer=None):
+        expires_at = int(time.time()) + ttl
+        self._remember(key, value, expires_at)
+        writer = writer or self.table
+        if writer:
+            item = {"cache_key": key, "expires_at": expires_at}
+            if value is not None:
+                item["value"] = value
+            writer.put_item(Item=item)
+
+    def warm_up(self, slack):
+        """Store user ids of all slack users with an email, reading the paginated users.list"""
+        if not self.table:
+            raise ValueError("SLACK_CACHE_TABLE needs to be configured to warm up the cache")
+        cursor = None
+        count = 0
+        with self.table.batch_writer() as writer:
+            while True:
+                params = {"limit": USERS_LIST_PAGE_SIZE}
+                if cursor:
+                    params["cursor"] = cursor
+                data = slack.api_call("users.list", data=params).json()
+                if not data.get("ok"):
+                    raise RuntimeError(f"Unexpected response from slack users.list: {data.get('error')}")
+                for member in data.get("members", []):
+                    email = member.get("profile", {}).get("email")
+                    if email and not member.get("deleted"):
+                        self.put(user_key(email), member["id"], USER_TTL, writer)
+                        count += 1
+                cursor = data.get("response_metadata", {}).get("next_cursor")
+                if not cursor:
+                    return count
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[1] > now:
+                self._memory.move_to_end(key)
+                return True, entry[0]
+        if self.table:
+            item = self.table.get_item(Key={"cache_key": key}).get("Item")
+            # expired items may still be returned as TTL deletion is not immediate
+            if item and item["expires_at"] > now:
+                value = item.get("value")
+                self._remember(key, value, int(item["expires_at"]))
+                return True, value
+        return False, None
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._memory[key] = (value, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > MAX_MEMORY_ENTRIES:
+                self._memory.popitem(last=False)
+
+
+if __name__ == "__main__":
+    from .. import settings
+    from .slack_client import SlackClient
+
+    logging.basicConfig(level=logging.INFO)
+    cached = SlackIdentityCache(settings).warm_up(SlackClient(settings))
+    logger.info(f"Cached {cached} slack users")
@@ -0,0 +1,45 @@
+import logging
+import time
+
+import requests
+
+from ..metrics import NOOP_METRICS, SLACK_CALL_TIME
+
+SLACK_API_URL = "https://slack.com/api/"
+# seconds, each notification needs to fit in the 10 s notification lambda timeout
+REQUEST_TIMEOUT = 3
+MAX_ATTEMPTS = 3
+MAX_RETRY_AFTER = 3
+
+logger = logging.getLogger()
+
+
+class SlackClient:
+    """
+    Slack client shared by notificators.
+    The keep-alive session is a class attribute, so connections to slack are reused across warm lambda invocations.
+    Rate limited (429) calls are retried after the time slack asks for in the Retry-After header.
+    """
+
+    session = requests.Session()
+
+    def __init__(self, config, metrics=NOOP_METRICS):
+        self.config = config
+        self.metrics = metrics
+
+    def post(self, url, **kwargs):
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            with self.metrics.timer(SLACK_CALL_TIME):
+                response = self.session.post(url, timeout=REQUEST_TIMEOUT, **kwargs)
+            if response.status_code != requests.codes.too_many_requests or attempt == MAX_ATTEMPTS:
+                return response
+            retry_after = float(response.headers.get("Retry-After", 1))
+            if retry_after > MAX_RETRY_AFTER:
+                logger.warning(f"Slack asked to retry {url} after {retry_after}s, giving up")
+                return response
+            time.sleep(retry_after)
+
+    def api_call(self, method, **kwargs):
+        """Call a slack web api method authorized with the bot token"""
+        headers = {"Authorization": f"Bearer {self.config.SLACK_BOT_TOKEN}"}
+        return self.post(SLACK_API_URL + method, headers=headers, **kwargs)
@@ -0,0 +1,69 @@
+import logging
+import time
+from typing import Mapping
+
+from .. import clients, codec
+from ..metrics import NOOP_METRICS, NOTIFICATIONS_SENT
+from ..model import QueryState
+from ..spend_window_dao import SpendWindowDao
+from .notificator import Notificator
+
+logger = logging.getLogger()
+
+
+class SpendWindowNotificator(Notificator):
+    """
+    Notifies about users whose queries scanned too much data in total over a period of time, e.g. many medium sized
+    queries which never cross the HardThresholdNotificator thresholds on their own.
+    Windows and their thresholds are configured in SPEND_WINDOW_THRESHOLDS. Each event adds the query to the user's
+    counters, so checking a window doesn't depend on how many queries the user has run.
+    """
+
+    def __init__(self, config, metrics=NOOP_METRICS, dynamodb=None):
+        super().__init__(config, metrics)
+        self.dao = SpendWindowDao(config, dynamodb or clients.resource("dynamodb"), metrics)
+
+    def is_record_type_handled(self, record: Mapping) -> bool:
+        return "eventSourceARN" in record and "athena-queries" in record["eventSourceARN"]
+
+    def handle_single_event(self, body):
+        query = codec.from_body(body)
+        # live alerts of running queries would be counted again once the query finishes
+        if not query.data_scanned or query.query_state in (QueryState.QUEUED.value, QueryState.RUNNING.value):
+            return
+        thresholds = self.config.SPEND_WINDOW_THRESHOLDS
+        now = time.time()
+        spends = self.dao.add_spend(
+            query.executing_user, query.query_execution_id, query.data_scanned, sorted(thresholds), now
+        )
+        for spend in spends:
+            threshold = thresholds[spend.length]
+            # only the query which crosses the threshold triggers a notification, not every query after it
+            if spend.estimate_before(now) < threshold <= spend.estimate(now):
+                if self.dao.mark_alerted(query.executing_user, spend):
+                    self.send_slack_notification(query.executing_user, spend.estimate(now), spend.length)
+                    self.metrics.count(NOTIFICATIONS_SENT)
+
+    @staticmethod
+    def format_window(length):
+        if length % 3600 == 0:
+            return f"{length // 3600} h"
+        return f"{length // 60} min"
+
+    def send_slack_notification(self, user, data_scanned, length):
+        slack_user = self.get_slack_user_id(user)
+        params = dict(
+            data_scanned_bytes=int(data_scanned),
+            data_scanned_gb=int(data_scanned / (1024 * 1024 * 1024)),
+            data_scanned_cost=round((data_scanned / (1024 * 1024 * 1024 * 1024)) * self.config.ATHENA_PRICE_PER_TB, 2),
+            slack_user_id=slack_user,
+            user=user,
+            window=self.format_window(length),
+        )
+        text = self.config.SLACK_SPEND_WINDOW_MESSAGE.format(**params)
+        calls = [lambda: self.send_slack_to_channel(text)]
+        if not slack_user:
+            logger.warning(f"Couldn't find slack user mapping for user {user}")
+        else:
+            calls.append(lambda: self.send_slack_to_user(slack_user, text))
+        self.send_concurrently(*calls)
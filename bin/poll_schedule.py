@@ -0,0 +1,55 @@
+"""
+Schedule of athena polls of queries which are still running.
+
+Every query in flight has a next_check_at epoch timestamp and usage_update polls only the queries which are due.
+A query is due as soon as it's inserted - its age is then mostly the cloudtrail delivery delay, and short queries
+have usually finished by that time. After the first poll the delay before the next check grows with the age of the
+query, so a query is checked at exponentially growing intervals: queries which finish in seconds are checked on the next usage_update run, while multi-hour ETL queries are
+checked about once an hour. Queries with a data scanned budget - a live alert or auto cancel threshold they haven't
+crossed yet - are checked at least every BUDGET_POLL_DELAY seconds, and sooner if they scan fast enough to reach the
+budget before that. Queries still running after MAX_POLL_AGE are not polled anymore, e.g. queries athena
+doesn't know because they come from backfilled logs older than its history.
+"""
+
+import calendar
+import time
+
+from .model import TIMESTAMP_FORMAT
+
+MIN_POLL_DELAY = 60
+MAX_POLL_DELAY = 3600
+BUDGET_POLL_DELAY = 300
+# delay before the next check as a share of the query age
+POLL_BACKOFF = 0.5
+MAX_POLL_AGE = 2 * 24 * 3600
+
+
+def start_time(query):
+    """Epoch timestamp of the query start, start timestamps are in UTC"""
+    return calendar.timegm(time.strptime(query.start_timestamp, TIMESTAMP_FORMAT))
+
+
+def first_check_at(query, now):
+    """Epoch timestamp of the first check of a query inserted while running, None if it's not to be polled at all"""
+    if max(0, now - start_time(query)) > MAX_POLL_AGE:
+        return None
+    return int(now)
+
+
+def next_check_at(query, now, budget=None):
+    """
+    Epoch timestamp of the next check of a query which is still running, None if it's not to be polled anymore.
+    budget is the data scanned in bytes at which the query needs to be checked, if any.
+    """
+    age = max(0, now - start_time(query))
+    if age > MAX_POLL_AGE:
+        return None
+    delay = min(MAX_POLL_DELAY, max(MIN_POLL_DELAY, age * POLL_BACKOFF))
+    if budget is not None:
+        delay = min(delay, BUDGET_POLL_DELAY)
+        data_scanned = query.data_scanned or 0
+        if data_scanned and age:
+            # time to reach the budget at the query's average scan rate so far, with the same margin as the backoff
+            remaining = (budget - data_scanned) / (data_scanned / age)
+            delay = min(delay, max(MIN_POLL_DELAY, remaining * POLL_BACKOFF))
+    return int(now + delay)
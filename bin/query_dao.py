@@ -1,40 +1,387 @@
-from dataclasses import asdict
-from datetime import datetime
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
-from .model import AthenaQuery, TIMESTAMP_FORMAT
+from . import codec
+from .metrics import DYNAMODB_READ_TIME, DYNAMODB_WRITE_TIME, NOOP_METRICS
+from .model import QueryState, UnprocessedItemsException
+from .poll_schedule import first_check_at
+from .retry import backoff
+
+# maximum number of items in a single BatchWriteItem and BatchGetItem request
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+MAX_BATCH_WRITE_ATTEMPTS = 8
+SCAN_PAGE_SIZE = 500
+
+# sparse global secondary index containing only queries which are not finished yet, sorted by the time they are due
+# to be polled. The in_flight and next_check_at attributes are set when a query is inserted and removed once it's
+# finalised, so the index stays small no matter the table size.
+IN_FLIGHT_INDEX = "in_flight_next_check_index"
+IN_FLIGHT = "1"
+IN_FLIGHT_STATES = (QueryState.QUEUED.value, QueryState.RUNNING.value)
+
+# storage only attributes of a query, which are not a part of the model, copied along with it to another table
+CARRIED_ATTRIBUTES = ("live_alerted",)
+
+# global secondary index used to find a query when only its execution id is known
+QUERY_EXECUTION_ID_INDEX = "query_execution_id_index"
+
+# shared across warm invocations, used to read all shards of the table at the same time
+_executor = ThreadPoolExecutor(max_workers=16)
+
+
+class DateKeySchema:
+    """
+    The original key schema: start_date (HASH) + start_timestamp (RANGE). All queries of a day are written to a single
+    partition and only one query per second can be stored, queries started in the same second overwrite each other.
+    """
+
+    key_names = ("start_date", "start_timestamp")
+
+    def key(self, query):
+        return dict(start_date=query.start_date, start_timestamp=query.start_timestamp)
+
+    def in_flight(self, query):
+        return IN_FLIGHT
+
+    def in_flight_partitions(self):
+        return [IN_FLIGHT]
+
+    def day_conditions(self, date, timestamp):
+        """Key conditions of queries started on date since timestamp, one per partition"""
+        return [Key("start_date").eq(date) & Key("start_timestamp").gte(timestamp)]
+
+
+class ShardedKeySchema:
+    """
+    date_shard (HASH) "<start_date>#<shard>" + query_key (RANGE) "<start_timestamp>#<query_execution_id>".
+    Queries of a day are spread over shards partitions by a hash of their execution id and queries started in the same
+    second have different keys. The in-flight index is sharded the same way. Queries stay sorted by their start time
+    within a shard, so reading a time range costs one query per shard.
+    """
+
+    key_names = ("date_shard", "query_key")
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def shard(self, query_execution_id):
+        return zlib.crc32(query_execution_id.encode("utf-8")) % self.shards
+
+    def key(self, query):
+        return dict(
+            date_shard=f"{query.start_date}#{self.shard(query.query_execution_id)}",
+            query_key=f"{query.start_timestamp}#{query.query_execution_id}",
+        )
+
+    def in_flight(self, query):
+        return str(self.shard(query.query_execution_id))
+
+    def in_flight_partitions(self):
+        return [str(shard) for shard in range(self.shards)]
+
+    def day_conditions(self, date, timestamp):
+        # "<start_timestamp>#<id>" sorts after "<start_timestamp>", so queries started at timestamp are included
+        return [
+            Key("date_shard").eq(f"{date}#{shard}") & Key("query_key").gte(timestamp) for shard in range(self.shards)
+        ]
+
+
+def key_schema(config):
+    """Key schema of the queries table, sharded if QUERIES_TABLE_SHARDS is configured"""
+    shards = getattr(config, "QUERIES_TABLE_SHARDS", None)
+    return ShardedKeySchema(shards) if shards else DateKeySchema()
 
 
 class QueryDao:
 
-    def __init__(self, config, dynamodb):
+    def __init__(self, config, dynamodb, metrics=NOOP_METRICS):
         self.config = config
         self.dynamodb = dynamodb
+        self.metrics = metrics
+        self.keys = key_schema(config)
 
     def insert_query(self, query):
-        # DynamoDB does not support empty strings, so we need to drop such attributes
-        query_dict = {key: value for key, value in asdict(query).items() if value is not None}
-        self.dynamodb.Table(self.config.QUERIES_TABLE).put_item(Item=query_dict)
-
-    def get_running_queries(self, partition_timestamp, start_timestamp):
-        date_str = datetime.strftime(partition_timestamp, "%Y-%m-%d")
-        timestamp_str = datetime.strftime(start_timestamp, TIMESTAMP_FORMAT)
-        response = self.dynamodb.Table(self.config.QUERIES_TABLE).query(
-            KeyConditionExpression=Key("start_date").eq(date_str) & Key("start_timestamp").gte(timestamp_str),
-            FilterExpression=Attr("query_state").eq("RUNNING"),
+        """
+        Insert a query unless it's already in the table, e.g. inserted again from a redelivered log after it has been
+        finalised. Returns False if the query was already there.
+        """
+        return self._put_new_item(self._to_item(query))
+
+    def _put_new_item(self, item):
+        """Put an item unless the same query is stored under its key, another query stored there is overwritten"""
+        try:
+            with self.metrics.timer(DYNAMODB_WRITE_TIME):
+                self.dynamodb.Table(self.config.QUERIES_TABLE).put_item(
+                    Item=item,
+                    ConditionExpression="attribute_not_exists(query_execution_id) OR query_execution_id <> :id",
+                    ExpressionAttributeValues={":id": item["query_execution_id"]},
+                )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def insert_queries(self, queries, skip_existing=False):
+        """
+        Insert queries using BatchWriteItem requests of up to 25 items, retrying unprocessed items with backoff.
+        A batch can't contain the same key twice, so for duplicated keys only the last query is written,
+        the same as it would be with consecutive puts.
+        With skip_existing queries already present in the table are left untouched, so replaying old logs never
+        overwrites queries which have been finalised since. The same as with insert_query, only the same query is
+        skipped: a query stored under the key of another one, i.e. started in the same second with the date keyed
+        schema, is overwritten with a conditional put, so it's not overwritten by a concurrent write of the same query.
+        Returns the number of written queries.
+        """
+        now = time.time()
+        return self._insert_items([self._to_item(query, now) for query in queries], skip_existing)
+
+    def new_queries(self, queries):
+        """
+        Return the queries which are not in the table yet, i.e. the ones insert_queries with skip_existing would write,
+        so that only those are prepared for insertion.
+        """
+        keys = [tuple(self.keys.key(query)[name] for name in self.keys.key_names) for query in queries]
+        existing = self._get_existing_ids(list(set(keys)))
+        return [query for query, key in zip(queries, keys) if existing.get(key) != query.query_execution_id]
+
+    def copy_items(self, source_items):
+        """
+        Insert queries read from another queries table, e.g. one with a different key schema, unless they are already
+        present. Storage only attributes of the source items, like the live alert marker, are carried over, so a query
+        copied while it's running isn't alerted about twice. Returns the number of written queries.
+        """
+        now = time.time()
+        items = []
+        for source_item in source_items:
+            item = self._to_item(self._to_query(source_item), now)
+            item.update((name, source_item[name]) for name in CARRIED_ATTRIBUTES if name in source_item)
+            items.append(item)
+        return self._insert_items(items, skip_existing=True)
+
+    def _insert_items(self, items, skip_existing):
+        items = {tuple(item[name] for name in self.keys.key_names): item for item in items}
+        conditional = []
+        if skip_existing:
+            existing = self._get_existing_ids(list(items))
+            conditional = [
+                item for key, item in items.items() if key in existing and existing[key] != item["query_execution_id"]
+            ]
+            items = {key: item for key, item in items.items() if key not in existing}
+        items = list(items.values())
+        for i in range(0, len(items), BATCH_WRITE_SIZE):
+            self._batch_write([dict(PutRequest=dict(Item=item)) for item in items[i : i + BATCH_WRITE_SIZE]])
+        return len(items) + sum(self._put_new_item(item) for item in conditional)
+
+    def _batch_write(self, requests):
+        table = self.config.QUERIES_TABLE
+        for attempt in range(MAX_BATCH_WRITE_ATTEMPTS):
+            if attempt:
+                backoff(attempt - 1)
+            with self.metrics.timer(DYNAMODB_WRITE_TIME):
+                response = self.dynamodb.batch_write_item(RequestItems={table: requests})
+            requests = response.get("UnprocessedItems", {}).get(table)
+            if not requests:
+                return
+        raise UnprocessedItemsException(f"{len(requests)} items left unprocessed after batch writes to {table}")
+
+    def _get_existing_ids(self, keys):
+        """
+        Return a dict of key tuples, in the order of the key schema key_names, present in the table to the execution
+        id of the query stored under them
+        """
+        table = self.config.QUERIES_TABLE
+        key_names = self.keys.key_names
+        existing = {}
+        for i in range(0, len(keys), BATCH_GET_SIZE):
+            request = {
+                table: dict(
+                    Keys=[dict(zip(key_names, key)) for key in keys[i : i + BATCH_GET_SIZE]],
+                    ProjectionExpression=", ".join(key_names + ("query_execution_id",)),
+                )
+            }
+            for attempt in range(MAX_BATCH_WRITE_ATTEMPTS):
+                if attempt:
+                    backoff(attempt - 1)
+                with self.metrics.timer(DYNAMODB_READ_TIME):
+                    response = self.dynamodb.batch_get_item(RequestItems=request)
+                existing.update(
+                    (tuple(item[name] for name in key_names), item.get("query_execution_id"))
+                    for item in response.get("Responses", {}).get(table, [])
+                )
+                request = response.get("UnprocessedKeys")
+                if not request:
+                    break
+            else:
+                raise UnprocessedItemsException(f"Keys left unprocessed after batch gets from {table}")
+        return existing
+
+    def _to_item(self, query, now=None):
+        item = codec.to_item(query)
+        item.update(self.keys.key(query))
+        if query.query_state in IN_FLIGHT_STATES:
+            check_at = first_check_at(query, now or time.time())
+            # queries too old to be polled, e.g. from backfilled logs, are stored without being scheduled
+            if check_at:
+                item["in_flight"] = self.keys.in_flight(query)
+                item["next_check_at"] = check_at
+        return item
+
+    @staticmethod
+    def _to_query(item):
+        # items carry storage only attributes, like the in-flight marker, which are ignored by the codec
+        return codec.from_item(item)
+
+    def get_day_queries(self, date):
+        """Return all queries started on date, a YYYY-MM-DD string, reading only the partitions of that day"""
+        requests = [
+            dict(KeyConditionExpression=condition) for condition in self.keys.day_conditions(date, f"{date} 00:00:00")
+        ]
+        return [self._to_query(item) for item in self._query_partitions(requests)]
+
+    def scan_segment(self, segment, segments):
+        """Yield pages of queries of a segment of a parallel scan of the whole table, split into segments"""
+        for items in self.scan_segment_items(segment, segments):
+            yield [self._to_query(item) for item in items]
+
+    def scan_segment_items(self, segment, segments):
+        """Yield pages of raw items, including storage only attributes, of a segment of a parallel scan"""
+        table = self.dynamodb.Table(self.config.QUERIES_TABLE)
+        kwargs = dict(Segment=segment, TotalSegments=segments, Limit=SCAN_PAGE_SIZE)
+        while True:
+            with self.metrics.timer(DYNAMODB_READ_TIME):
+                response = table.scan(**kwargs)
+            yield response.get("Items", [])
+            if "LastEvaluatedKey" not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def get_due_queries(self, now):
+        """
+        Return queries which are not finished yet and are due to be checked at the epoch timestamp now, no matter when
+        they started. Reads the sparse in-flight index, so finished and not yet due queries don't cost any read capacity.
+        """
+        requests = [
+            dict(
+                IndexName=IN_FLIGHT_INDEX,
+                KeyConditionExpression=Key("in_flight").eq(partition) & Key("next_check_at").lte(int(now)),
+            )
+            for partition in self.keys.in_flight_partitions()
+        ]
+        return [self._to_query(item) for item in self._query_partitions(requests)]
+
+    def schedule_check(self, query, check_at):
+        """
+        Store data scanned so far by a query which is still running and set the epoch timestamp of its next check,
+        None stops polling it. Queries finalised in the meantime are left untouched.
+        """
+        values = {":data_scanned": query.data_scanned}
+        if check_at is None:
+            update_expression = "set data_scanned = :data_scanned remove in_flight, next_check_at"
+        else:
+            update_expression = "set data_scanned = :data_scanned, next_check_at = :next_check_at"
+            values[":next_check_at"] = check_at
+        self._update_in_flight(query, update_expression, values)
+
+    def mark_live_alerted(self, query):
+        """
+        Mark a running query as alerted about while it's running. Returns False if it was already marked, e.g. by a
+        previous run, or if it's finished, so the live alert is sent at most once per query.
+        """
+        return self._update_in_flight(
+            query, "set live_alerted = :alerted", {":alerted": True}, "attribute_not_exists(live_alerted)"
         )
-        return [AthenaQuery(**item) for item in response.get("Items", [])]
+
+    def mark_auto_cancelled(self, query):
+        """Store that a running query has been cancelled by the alerter, so its finished event tells so"""
+        return self._update_in_flight(query, "set auto_cancelled = :cancelled", {":cancelled": True})
+
+    def _update_in_flight(self, query, update_expression, values, condition=None):
+        """Update a query only if it's not finalised yet, returns False if the condition failed"""
+        condition_expression = "attribute_exists(in_flight)"
+        if condition:
+            condition_expression += f" AND {condition}"
+        try:
+            with self.metrics.timer(DYNAMODB_WRITE_TIME):
+                self.dynamodb.Table(self.config.QUERIES_TABLE).update_item(
+                    Key=self.keys.key(query),
+                    UpdateExpression=update_expression,
+                    ExpressionAttributeValues=values,
+                    ConditionExpression=condition_expression,
+                )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def get_query(self, query_execution_id):
+        """Return the query with the given execution id or None if it hasn't been inserted yet"""
+        items = self._query_all(
+            IndexName=QUERY_EXECUTION_ID_INDEX, KeyConditionExpression=Key("query_execution_id").eq(query_execution_id)
+        )
+        item = next(items, None)
+        return self._to_query(item) if item else None
+
+    def _query_partitions(self, requests):
+        """Run a query per partition, following all their pages, in parallel and return the found items"""
+        if len(requests) == 1:
+            return list(self._query_all(**requests[0]))
+        futures = [_executor.submit(lambda kwargs: list(self._query_all(**kwargs)), request) for request in requests]
+        return [item for future in futures for item in future.result()]
+
+    def _query_all(self, **kwargs):
+        """Run a query following LastEvaluatedKey until all pages are read"""
+        table = self.dynamodb.Table(self.config.QUERIES_TABLE)
+        while True:
+            with self.metrics.timer(DYNAMODB_READ_TIME):
+                response = table.query(**kwargs)
+            yield from response.get("Items", [])
+            if "LastEvaluatedKey" not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
 
     def update_query(self, query):
-        self.dynamodb.Table(self.config.QUERIES_TABLE).update_item(
-            Key={"start_date": query.start_date, "start_timestamp": query.start_timestamp},
-            UpdateExpression="set query_state = :query_state, data_scanned = :data_scanned, "
-            "executing_user = :executing_user, query_sql = :query_sql",
-            ExpressionAttributeValues={
-                ":query_state": query.query_state,
-                ":executing_user": query.executing_user,
-                ":data_scanned": query.data_scanned,
-                ":query_sql": query.query_sql,
-            },
+        """
+        Store the current state of a query. A query is finalised only once: if it's already finished in the table,
+        e.g. finalised by both the state change handler and the reconciliation sweep, nothing is written and False
+        is returned, so the caller can skip sending its event again.
+        """
+        update_expression = (
+            "set query_state = :query_state, data_scanned = :data_scanned, "
+            "executing_user = :executing_user, query_sql = :query_sql, "
+            "query_sql_ref = :query_sql_ref, query_sql_hash = :query_sql_hash, "
+            "query_fingerprint = :query_fingerprint"
         )
+        values = {
+            ":query_state": query.query_state,
+            ":executing_user": query.executing_user,
+            ":data_scanned": query.data_scanned,
+            ":query_sql": query.query_sql,
+            ":query_sql_ref": query.query_sql_ref,
+            ":query_sql_hash": query.query_sql_hash,
+            ":query_fingerprint": query.query_fingerprint,
+        }
+        kwargs = {}
+        if query.query_state not in IN_FLIGHT_STATES:
+            update_expression += " remove in_flight, next_check_at"
+            kwargs["ConditionExpression"] = "query_state IN (:queued, :running)"
+            values[":queued"], values[":running"] = IN_FLIGHT_STATES
+        try:
+            with self.metrics.timer(DYNAMODB_WRITE_TIME):
+                self.dynamodb.Table(self.config.QUERIES_TABLE).update_item(
+                    Key=self.keys.key(query),
+                    UpdateExpression=update_expression,
+                    ExpressionAttributeValues=values,
+                    **kwargs,
+                )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
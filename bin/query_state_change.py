@@ -0,0 +1,97 @@
+"""
+This file contains a lambda function reacting to athena query state change events from EventBridge.
+It finalises a query as soon as it reaches a terminal state and sends the same sqs event as usage_update does.
+
+Cloudtrail logs are delivered with a delay of several minutes, so most fast queries finish before they have been
+inserted by cloudtrail_handler. Such events are remembered as a marker in the dedup store and cloudtrail_handler
+finalises the marked queries right after inserting them. Without DEDUP_TABLE the marker is only visible to this lambda
+container, and the query is finalised by the usage_update reconciliation sweep on its first run after the insert.
+"""
+
+import logging
+
+from . import clients, settings
+from .athena_clients import AthenaClientPool
+from .cloudwatch_metrics import CloudwatchMetrics
+from .dedup import NO_DEDUP, DedupStore, finished_key
+from .fingerprint_stats_dao import FingerprintStatsDao
+from .metrics import EmbeddedMetrics
+from .model import QueryState
+from .query_dao import QueryDao, IN_FLIGHT_STATES
+from .sql_store import SqlStore
+from .usage_update import UsageUpdater
+
+TERMINAL_STATES = (QueryState.SUCCEEDED.value, QueryState.FAILED.value, QueryState.CANCELLED.value)
+
+logger = logging.getLogger()
+
+
+def lambda_handler(event, context):
+    metrics = EmbeddedMetrics(settings.CLOUDWATCH_METRIC_NAMESPACE, dict(Function="query_state_change"))
+    handler = create_handler(metrics)
+    try:
+        handler.process_event(event)
+    finally:
+        metrics.flush()
+
+
+def create_handler(metrics):
+    """The handler with all its dependencies, also used by cloudtrail_handler to finalise marked queries"""
+    athena = clients.client("athena")
+    sqs = clients.client("sqs")
+    dynamodb = clients.resource("dynamodb")
+    query_dao = QueryDao(settings, dynamodb, metrics)
+    cloudwatch_metrics = CloudwatchMetrics(settings, clients.client("cloudwatch"))
+    sql_store = SqlStore(settings, metrics=metrics)
+    fingerprint_stats = FingerprintStatsDao(settings, dynamodb, metrics)
+    athena_clients = AthenaClientPool(settings, athena, metrics=metrics)
+    updater = UsageUpdater(
+        settings, query_dao, athena, sqs, metrics, cloudwatch_metrics, sql_store, fingerprint_stats, athena_clients
+    )
+    return QueryStateChangeHandler(query_dao, updater, DedupStore(settings, dynamodb, metrics))
+
+
+class QueryStateChangeHandler:
+
+    def __init__(self, query_dao, updater, dedup=NO_DEDUP):
+        self.query_dao = query_dao
+        self.updater = updater
+        self.dedup = dedup
+
+    def process_event(self, event):
+        """Process an "Athena Query State Change" event"""
+        detail = event.get("detail", {})
+        if detail.get("currentState") not in TERMINAL_STATES:
+            return
+
+        query_execution_id = detail["queryExecutionId"]
+        query = self.query_dao.get_query(query_execution_id)
+        if query is None:
+            self.dedup.mark(finished_key(query_execution_id))
+            # the query may have been inserted before cloudtrail_handler could see the marker
+            query = self.query_dao.get_query(query_execution_id)
+        if query is None:
+            logger.info(f"Query {query_execution_id} not inserted yet, it's finalised once it is")
+            return
+        if query.query_state not in IN_FLIGHT_STATES:
+            logger.info(f"Query {query_execution_id} already finalised")
+            return
+
+        # state change events don't carry statistics, hence data scanned needs to be fetched from athena
+        details = self.updater.get_details([query]).get(query_execution_id)
+        if not details or details["query_state"] not in TERMINAL_STATES:
+            logger.warning(f"Unexpected details of query {query_execution_id}: {details}")
+            return
+        with self.updater:
+            self.updater.finalise_query(query, details)
+        self.dedup.release(finished_key(query_execution_id))
+
+    def finalise_queries(self, queries):
+        """Finalise just inserted queries whose terminal state change event arrived before them"""
+        details = self.updater.get_details(queries)
+        with self.updater:
+            for query in queries:
+                query_details = details.get(query.query_execution_id)
+                if query_details and query_details["query_state"] in TERMINAL_STATES:
+                    self.updater.finalise_query(query, query_details)
+                    self.dedup.release(finished_key(query.query_execution_id))
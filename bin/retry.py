@@ -0,0 +1,38 @@
+"""
+Helpers for retrying throttled or partially processed AWS API calls
+"""
+
+import random
+import time
+
+BASE_DELAY = 0.05
+MAX_DELAY = 5.0
+
+
+def backoff(attempt, base=BASE_DELAY, cap=MAX_DELAY):
+    """
+    Sleep before the given retry attempt (counted from 0) using exponential backoff with full jitter
+    """
+    time.sleep(random.uniform(0, min(cap, base * 2**attempt)))
+
+
+class AdaptiveDelay:
+    """
+    Delay between consecutive calls to a service which doubles every time we get throttled
+    and decays back to no delay at all as calls succeed
+    """
+
+    def __init__(self, base=BASE_DELAY, cap=MAX_DELAY):
+        self.base = base
+        self.cap = cap
+        self.delay = 0
+
+    def wait(self):
+        if self.delay:
+            time.sleep(self.delay)
+
+    def throttled(self):
+        self.delay = min(self.cap, max(self.base, self.delay * 2))
+
+    def succeeded(self):
+        self.delay = self.delay / 2 if self.delay > self.base else 0
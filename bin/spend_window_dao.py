@@ -0,0 +1,172 @@
+"""
+Per user data scanned counters kept in fixed time buckets, one bucket per window length.
+
+Every finished query is added to the current bucket of each window with an atomic ADD update, so concurrent lambdas
+never lose an update and nothing has to be read back from the queries table. The updates are written in a transaction
+with a marker item of the query, conditional on the marker not being there yet, so a query redelivered by sqs, e.g.
+after a failed slack call, is never added twice. The spend over the last `length`
+seconds is estimated from the current and the previous bucket only, weighting the previous one by the part of the
+window it still covers. This makes every event cost the same number of requests, however many queries a user runs.
+"""
+
+import logging
+from dataclasses import dataclass
+
+from botocore.exceptions import ClientError
+
+from .metrics import DYNAMODB_READ_TIME, DYNAMODB_WRITE_TIME, NOOP_METRICS
+from .model import UnprocessedItemsException
+from .retry import backoff
+
+MAX_BATCH_GET_ATTEMPTS = 8
+# buckets are removed by DynamoDB TTL once they can't be a part of any window
+EXPIRY_MARGIN = 3600
+
+logger = logging.getLogger()
+
+
+@dataclass
+class WindowSpend:
+    length: int
+    bucket_start: int
+    current: int
+    previous: int
+    added: int
+
+    def estimate(self, now):
+        """Data scanned in the last `length` seconds, assuming the previous bucket was spread evenly over time"""
+        previous_weight = max(0.0, 1 - (now - self.bucket_start) / self.length)
+        return self.current + self.previous * previous_weight
+
+    def estimate_before(self, now):
+        return self.estimate(now) - self.added
+
+
+class SpendWindowDao:
+
+    def __init__(self, config, dynamodb, metrics=NOOP_METRICS):
+        self.config = config
+        self.dynamodb = dynamodb
+        self.metrics = metrics
+
+    @property
+    def table_name(self):
+        return self.config.SPEND_WINDOWS_TABLE
+
+    @staticmethod
+    def bucket_key(length, bucket_start):
+        return f"{length}#{bucket_start}"
+
+    @staticmethod
+    def query_key(query_execution_id):
+        return f"query#{query_execution_id}"
+
+    def add_spend(self, user, query_execution_id, data_scanned, lengths, now):
+        """
+        Add data scanned by a query to the current buckets of all windows, unless it has already been added, and
+        return their WindowSpend. Costs one transaction and a single BatchGetItem for all current and previous buckets.
+        """
+        bucket_starts = [int(now) // length * length for length in lengths]
+        marker = dict(
+            Put=dict(
+                TableName=self.table_name,
+                Item=dict(
+                    user=dict(S=user),
+                    bucket=dict(S=self.query_key(query_execution_id)),
+                    expires_at=dict(N=str(int(now) + 2 * max(lengths) + EXPIRY_MARGIN)),
+                ),
+                ConditionExpression="attribute_not_exists(#bucket)",
+                ExpressionAttributeNames={"#bucket": "bucket"},
+            )
+        )
+        updates = [
+            dict(
+                Update=dict(
+                    TableName=self.table_name,
+                    Key=dict(user=dict(S=user), bucket=dict(S=self.bucket_key(length, bucket_start))),
+                    UpdateExpression="ADD data_scanned :data_scanned, query_count :one SET expires_at = :expires_at",
+                    ExpressionAttributeValues={
+                        ":data_scanned": dict(N=str(data_scanned)),
+                        ":one": dict(N="1"),
+                        ":expires_at": dict(N=str(bucket_start + 2 * length + EXPIRY_MARGIN)),
+                    },
+                )
+            )
+            for length, bucket_start in zip(lengths, bucket_starts)
+        ]
+        try:
+            with self.metrics.timer(DYNAMODB_WRITE_TIME):
+                self.dynamodb.meta.client.transact_write_items(TransactItems=[marker] + updates)
+        except ClientError as e:
+            if not self._is_marker_conflict(e):
+                raise
+            logger.info(f"Query {query_execution_id} has already been added to the spend of {user}")
+
+        buckets = self._get_buckets(
+            user,
+            [self.bucket_key(length, start) for length, start in zip(lengths, bucket_starts)]
+            + [self.bucket_key(length, start - length) for length, start in zip(lengths, bucket_starts)],
+        )
+        return [
+            WindowSpend(
+                length,
+                bucket_start,
+                current=buckets.get(self.bucket_key(length, bucket_start), 0),
+                previous=buckets.get(self.bucket_key(length, bucket_start - length), 0),
+                added=data_scanned,
+            )
+            for length, bucket_start in zip(lengths, bucket_starts)
+        ]
+
+    @staticmethod
+    def _is_marker_conflict(error):
+        """True if a transaction was cancelled because the marker of the query, its first item, already exists"""
+        if error.response["Error"]["Code"] != "TransactionCanceledException":
+            return False
+        reasons = error.response.get("CancellationReasons")
+        if reasons:
+            return reasons[0].get("Code") == "ConditionalCheckFailed"
+        # older botocore versions only list the reasons in the message
+        return "[ConditionalCheckFailed" in error.response["Error"].get("Message", "")
+
+    def _get_buckets(self, user, buckets):
+        # consistent reads, as the current buckets have just been updated. bucket is a reserved word in expressions
+        request = {
+            self.table_name: dict(
+                Keys=[dict(user=user, bucket=bucket) for bucket in buckets],
+                ProjectionExpression="#bucket, data_scanned",
+                ExpressionAttributeNames={"#bucket": "bucket"},
+                ConsistentRead=True,
+            )
+        }
+        values = {}
+        for attempt in range(MAX_BATCH_GET_ATTEMPTS):
+            if attempt:
+                backoff(attempt - 1)
+            with self.metrics.timer(DYNAMODB_READ_TIME):
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get("Responses", {}).get(self.table_name, []):
+                values[item["bucket"]] = int(item["data_scanned"])
+            request = response.get("UnprocessedKeys")
+            if not request:
+                return values
+        raise UnprocessedItemsException(f"Spend of user {user} left unread after batch gets from {self.table_name}")
+
+    def mark_alerted(self, user, spend):
+        """
+        Mark the current bucket of a window as alerted. Returns False if it was already marked, e.g. by a concurrent
+        invocation, so the alert is sent at most once per bucket.
+        """
+        try:
+            with self.metrics.timer(DYNAMODB_WRITE_TIME):
+                self.dynamodb.Table(self.table_name).update_item(
+                    Key=dict(user=user, bucket=self.bucket_key(spend.length, spend.bucket_start)),
+                    UpdateExpression="SET alerted = :alerted",
+                    ConditionExpression="attribute_not_exists(alerted)",
+                    ExpressionAttributeValues={":alerted": True},
+                )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
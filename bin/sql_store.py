@@ -0,0 +1,103 @@
+"""
+Claim-check storage of long query texts.
+
+Generated BI queries may be hundreds of KB long, copying them into every DynamoDB item and sqs message inflates write
+units and message sizes and may exceed the 400 KB item and 256 KB message limits. Texts longer than
+QUERY_SQL_INLINE_LIMIT bytes are gzipped and stored in the QUERY_SQL_BUCKET s3 bucket instead. The query keeps only
+query_sql_ref, the s3:// url of the text, and query_sql_hash, its sha256. Objects are keyed by the hash, so a query run
+many times is stored once.
+
+Texts are fetched lazily with get_sql, only by consumers which need them. Fetched texts are cached in memory by their
+hash, the cache is a class attribute, so it survives warm lambda invocations.
+"""
+
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from . import clients
+from .metrics import NOOP_METRICS, S3_GET_OBJECT_TIME, S3_PUT_OBJECT_TIME
+from .model import SqlIntegrityException
+
+DEFAULT_INLINE_LIMIT = 4096
+KEY_PREFIX = "query_sql/"
+MAX_MEMORY_ENTRIES = 64
+
+
+def sql_hash(sql):
+    return hashlib.sha256(sql.encode("utf-8")).hexdigest()
+
+
+class SqlStore:
+
+    _memory = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, config, s3=None, metrics=NOOP_METRICS):
+        self.config = config
+        self.s3 = s3
+        self.metrics = metrics
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._memory.clear()
+
+    @property
+    def bucket(self):
+        return getattr(self.config, "QUERY_SQL_BUCKET", None)
+
+    @property
+    def inline_limit(self):
+        return getattr(self.config, "QUERY_SQL_INLINE_LIMIT", DEFAULT_INLINE_LIMIT)
+
+    def _s3(self):
+        if self.s3 is None:
+            self.s3 = clients.resource("s3")
+        return self.s3
+
+    def offload(self, query):
+        """Move the text of query to s3 if it's longer than the inline limit and a bucket is configured"""
+        sql = query.query_sql
+        if not self.bucket or sql is None or len(sql.encode("utf-8")) <= self.inline_limit:
+            return
+        digest = sql_hash(sql)
+        key = f"{KEY_PREFIX}{digest}.sql.gz"
+        with self._lock:
+            stored = digest in self._memory
+        # a text seen by this container has already been stored, objects are never modified
+        if not stored:
+            with self.metrics.timer(S3_PUT_OBJECT_TIME):
+                self._s3().Object(self.bucket, key).put(
+                    Body=gzip.compress(sql.encode("utf-8")), ContentType="text/plain", ContentEncoding="gzip"
+                )
+            self._remember(digest, sql)
+        query.query_sql = None
+        query.query_sql_ref = f"s3://{self.bucket}/{key}"
+        query.query_sql_hash = digest
+
+    def get_sql(self, query):
+        """Return the text of query, fetching it from s3 if it has been offloaded"""
+        if query.query_sql is not None or not query.query_sql_ref:
+            return query.query_sql
+        with self._lock:
+            sql = self._memory.get(query.query_sql_hash)
+            if sql is not None:
+                self._memory.move_to_end(query.query_sql_hash)
+                return sql
+        bucket, _, key = query.query_sql_ref[len("s3://") :].partition("/")
+        with self.metrics.timer(S3_GET_OBJECT_TIME):
+            body = self._s3().Object(bucket, key).get()["Body"].read()
+        sql = gzip.decompress(body).decode("utf-8")
+        if sql_hash(sql) != query.query_sql_hash:
+            raise SqlIntegrityException(f"Text of query {query.query_execution_id} doesn't match its hash")
+        self._remember(query.query_sql_hash, sql)
+        return sql
+
+    def _remember(self, digest, sql):
+        with self._lock:
+            self._memory[digest] = sql
+            self._memory.move_to_end(digest)
+            while len(self._memory) > MAX_MEMORY_ENTRIES:
+                self._memory.popitem(last=False)
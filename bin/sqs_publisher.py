@@ -0,0 +1,69 @@
+"""
+Buffered publisher sending sqs messages in SendMessageBatch calls
+"""
+
+import logging
+
+from .metrics import EVENTS_PUBLISHED, NOOP_METRICS, SQS_SEND_TIME
+from .model import MessagesNotSentException
+from .retry import backoff
+
+# limits of a single SendMessageBatch call
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+MAX_SEND_ATTEMPTS = 5
+
+logger = logging.getLogger()
+
+
+class SqsBatchPublisher:
+    """
+    Collects messages and sends them in batches of up to 10 entries and 256 KB.
+    Only entries which failed on the sqs side are retried. Remaining messages are sent by flush(),
+    which must be called before the lambda returns - the publisher can be used as a context manager for that.
+    """
+
+    def __init__(self, sqs, queue_url, metrics=NOOP_METRICS):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.metrics = metrics
+        self.bodies = []
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def publish(self, body):
+        size = len(body.encode("utf-8"))
+        if self.bodies and self.size + size > MAX_BATCH_BYTES:
+            self.flush()
+        self.bodies.append(body)
+        self.size += size
+        if len(self.bodies) >= MAX_BATCH_ENTRIES:
+            self.flush()
+
+    def flush(self):
+        entries = {str(i): body for i, body in enumerate(self.bodies)}
+        self.bodies = []
+        self.size = 0
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            if not entries:
+                return
+            if attempt:
+                backoff(attempt - 1)
+            with self.metrics.timer(SQS_SEND_TIME):
+                response = self.sqs.send_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[dict(Id=entry_id, MessageBody=body) for entry_id, body in entries.items()],
+                )
+            failed = response.get("Failed", [])
+            self.metrics.count(EVENTS_PUBLISHED, len(entries) - len(failed))
+            sender_faults = [entry for entry in failed if entry.get("SenderFault")]
+            if sender_faults:
+                raise MessagesNotSentException(f"SQS rejected messages: {sender_faults}")
+            entries = {entry["Id"]: entries[entry["Id"]] for entry in failed}
+        if entries:
+            raise MessagesNotSentException(f"{len(entries)} messages not sent to {self.queue_url}")
@@ -1,75 +1,301 @@
 """
 This file contains a lambda function which cyclically checks for recent athena queries and updates their data usage.
-It sends sqs events when a query is finished.
+It sends sqs events and per user cloudwatch metrics when a query is finished.
+Only queries which are due are polled, queries still running are checked less and less often as they get older
+(see poll_schedule.py).
 
+Queries are normally finalised as soon as athena reports a state change (see query_state_change.py),
+so this function acts as a low frequency reconciliation sweep for queries which were missed there.
+
+Data scanned by queries which are still running is stored on every poll. A query crossing LIVE_ALERT_DATA_THRESHOLD
+while running is sent to sqs as a live alert once, a query crossing AUTO_CANCEL_DATA_THRESHOLD in one of the
+AUTO_CANCEL_ALLOWED_WORKGROUPS is stopped. Queries below these thresholds are polled often enough to catch them
+crossing it, see poll_schedule.py.
 """
 
-import dataclasses
-import json
-from datetime import datetime, timedelta
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
+from botocore.exceptions import ClientError
 
-from . import settings
+from . import clients, codec, settings
+from .athena_clients import AthenaClientPool
+from .cloudwatch_metrics import CloudwatchMetrics
+from .fingerprint import fingerprint
+from .fingerprint_stats_dao import FingerprintStatsDao
+from .metrics import (
+    ATHENA_CALL_TIME,
+    DUPLICATES_SKIPPED,
+    NOOP_METRICS,
+    LIVE_ALERTS_SENT,
+    QUERIES_CANCELLED,
+    QUERIES_FINALISED,
+    QUERIES_POLLED,
+    EmbeddedMetrics,
+)
 from .model import QueryState
+from .poll_schedule import next_check_at
 from .query_dao import QueryDao
+from .retry import AdaptiveDelay, backoff
+from .sql_store import SqlStore
+from .sqs_publisher import SqsBatchPublisher
+
+# maximum number of ids accepted by a single BatchGetQueryExecution call
+ATHENA_BATCH_SIZE = 50
+MAX_ATHENA_ATTEMPTS = 6
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException"}
+# unprocessed query ids failing with these codes will not succeed on retry, e.g. queries from another account
+PERMANENT_ERROR_CODES = {"INVALID_INPUT", "InvalidRequestException"}
+
+# shared across warm invocations, used to fetch details of queries of all accounts and regions at the same time
+_executor = ThreadPoolExecutor(max_workers=8)
+
+logger = logging.getLogger()
 
 
 def lambda_handler(event, context):
-    athena = boto3.client("athena")
-    sqs = boto3.client("sqs")
-    dynamodb = boto3.resource("dynamodb")
-    query_dao = QueryDao(settings, dynamodb)
+    athena = clients.client("athena")
+    sqs = clients.client("sqs")
+    dynamodb = clients.resource("dynamodb")
+    metrics = EmbeddedMetrics(settings.CLOUDWATCH_METRIC_NAMESPACE, dict(Function="usage_update"))
+    query_dao = QueryDao(settings, dynamodb, metrics)
+    cloudwatch_metrics = CloudwatchMetrics(settings, clients.client("cloudwatch"))
+    sql_store = SqlStore(settings, metrics=metrics)
+    fingerprint_stats = FingerprintStatsDao(settings, dynamodb, metrics)
+    athena_clients = AthenaClientPool(settings, athena, metrics=metrics)
 
-    updater = UsageUpdater(settings, query_dao, athena, sqs)
-    updater.update_query_usage()
+    updater = UsageUpdater(
+        settings, query_dao, athena, sqs, metrics, cloudwatch_metrics, sql_store, fingerprint_stats, athena_clients
+    )
+    try:
+        updater.update_query_usage()
+    finally:
+        metrics.flush()
 
 
 class UsageUpdater:
 
-    def __init__(self, config, query_dao, athena, sqs):
+    def __init__(
+        self,
+        config,
+        query_dao,
+        athena,
+        sqs,
+        metrics=NOOP_METRICS,
+        cloudwatch_metrics=None,
+        sql_store=None,
+        fingerprint_stats=None,
+        athena_clients=None,
+    ):
         self.config = config
         self.athena = athena
         self.sqs = sqs
         self.query_dao = query_dao
+        self.metrics = metrics
+        self.cloudwatch_metrics = cloudwatch_metrics
+        self.sql_store = sql_store
+        self.fingerprint_stats = fingerprint_stats
+        self.athena_clients = athena_clients
+        self.publisher = SqsBatchPublisher(sqs, config.SQS_QUEUE_URL, metrics)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Send events and metrics buffered while finalising queries"""
+        try:
+            self.publisher.flush()
+        finally:
+            if self.cloudwatch_metrics:
+                self.cloudwatch_metrics.flush()
 
     def update_query_usage(self):
-        queries = self.get_queries()
+        with self:
+            self._update_query_usage()
+
+    def _update_query_usage(self):
+        now = self.now()
+        queries = self.get_queries(now)
         queries = [query for query in queries if query.query_state == QueryState.RUNNING.value]
+        self.metrics.count(QUERIES_POLLED, len(queries))
+        queries_details = self.get_details(queries)
         for query in queries:
-            details = self.get_query_details(query_execution_id=query.query_execution_id)
-            if details.get("query_state") not in [QueryState.QUEUED.value, QueryState.RUNNING.value]:
-                query.query_state = details["query_state"]
-                query.data_scanned = details["data_scanned"]
-                query.query_sql = details["query"]
-                if hasattr(self.config, "USER_MAPPING_FUNCTION"):
-                    mapped_user = self.config.USER_MAPPING_FUNCTION(details["query"])
-                    if mapped_user:
-                        query.executing_user = mapped_user
-                self.query_dao.update_query(query)
-                self.send_event_query_updated(query)
+            # queries we couldn't get details for are checked again later, the same as the ones still running
+            details = queries_details.get(query.query_execution_id, {})
+            if details.get("query_state") in [None, QueryState.QUEUED.value, QueryState.RUNNING.value]:
+                budget = None
+                if details:
+                    self.check_running_query(query, details)
+                    budget = self.data_scanned_budget(query, details)
+                check_at = next_check_at(query, now, budget)
+                if check_at is None:
+                    logger.warning(
+                        f"Query {query.query_execution_id} has been in flight for too long, it won't be polled anymore"
+                    )
+                self.query_dao.schedule_check(query, check_at)
+            else:
+                self.finalise_query(query, details)
+
+    def cancel_threshold(self, query, details):
+        """Data scanned above which the query is stopped, None if it's not to be stopped"""
+        threshold = getattr(self.config, "AUTO_CANCEL_DATA_THRESHOLD", None)
+        if not threshold or query.auto_cancelled:
+            return None
+        allowed_workgroups = getattr(self.config, "AUTO_CANCEL_ALLOWED_WORKGROUPS", None) or ()
+        return threshold if details.get("workgroup") in allowed_workgroups else None
+
+    def data_scanned_budget(self, query, details):
+        """The lowest live threshold the running query hasn't crossed yet, None if there is none"""
+        thresholds = [getattr(self.config, "LIVE_ALERT_DATA_THRESHOLD", None), self.cancel_threshold(query, details)]
+        return min(
+            (threshold for threshold in thresholds if threshold and threshold > query.data_scanned), default=None
+        )
+
+    def check_running_query(self, query, details):
+        """Record data scanned so far by a running query, cancel it above the hard limit and send its live alert"""
+        query.query_state = details["query_state"]
+        query.data_scanned = details["data_scanned"]
+        cancel_threshold = self.cancel_threshold(query, details)
+        if cancel_threshold and query.data_scanned > cancel_threshold:
+            self.cancel_query(query)
+        alert_threshold = getattr(self.config, "LIVE_ALERT_DATA_THRESHOLD", None)
+        if alert_threshold and query.data_scanned > alert_threshold and self.query_dao.mark_live_alerted(query):
+            # the live alert is a query event with the running state, notificators tell it from the finished one
+            self.send_event_query_updated(query)
+            self.metrics.count(LIVE_ALERTS_SENT)
+
+    def cancel_query(self, query):
+        athena = self.athena_clients.client(query.account_id, query.region) if self.athena_clients else self.athena
+        try:
+            with self.metrics.timer(ATHENA_CALL_TIME):
+                athena.stop_query_execution(QueryExecutionId=query.query_execution_id)
+        except ClientError:
+            # e.g. the query has just finished, or the role of its account isn't allowed to stop queries
+            logger.warning(f"Can't cancel query {query.query_execution_id}", exc_info=True)
+            return
+        logger.warning(f"Query {query.query_execution_id} cancelled after scanning {query.data_scanned} bytes")
+        query.auto_cancelled = True
+        self.query_dao.mark_auto_cancelled(query)
+        self.metrics.count(QUERIES_CANCELLED)
+
+    def finalise_query(self, query, details):
+        """Store the final state of a finished query and send the query finished event"""
+        self.apply_details(query, details)
+        if not self.query_dao.update_query(query):
+            logger.info(f"Query {query.query_execution_id} has already been finalised, not sending its event again")
+            self.metrics.count(DUPLICATES_SKIPPED)
+            return
+        self.send_event_query_updated(query)
+        if self.cloudwatch_metrics:
+            self.cloudwatch_metrics.report_query_metric(query.data_scanned, query.executing_user)
+        if self.fingerprint_stats:
+            self.fingerprint_stats.add_query(query)
+        self.metrics.count(QUERIES_FINALISED)
+
+    def apply_details(self, query, details):
+        """
+        Copy details returned by get_queries_details to the query, mapping its user if configured and fingerprinting
+        its text. A long query text is moved to s3 if the updater has a sql store, see sql_store.py
+        """
+        query.query_state = details["query_state"]
+        query.data_scanned = details["data_scanned"]
+        query.query_sql = details["query"]
+        query.query_fingerprint = fingerprint(details["query"])
+        if hasattr(self.config, "USER_MAPPING_FUNCTION"):
+            mapped_user = self.config.USER_MAPPING_FUNCTION(details["query"])
+            if mapped_user:
+                query.executing_user = mapped_user
+        if self.sql_store:
+            self.sql_store.offload(query)
 
     # For easier mocking
     def now(self):
-        return datetime.now()
-
-    def get_queries(self):
-        current_timestamp = self.now()
-        since_timestamp = current_timestamp - timedelta(hours=1)
-        items = self.query_dao.get_running_queries(current_timestamp.date(), since_timestamp)
-        # we keep data in daily partitions so we may need to query a range of two partitions
-        if current_timestamp.day != since_timestamp.day:
-            items.extend(self.query_dao.get_running_queries(since_timestamp.date(), since_timestamp))
-        return items
-
-    def get_query_details(self, query_execution_id):
-        response = self.athena.get_query_execution(QueryExecutionId=query_execution_id)
-        execution = response["QueryExecution"]
+        return time.time()
+
+    def get_queries(self, now):
+        """Queries due to be checked, no matter how long they have been running"""
+        return self.query_dao.get_due_queries(now)
+
+    def get_details(self, queries):
+        """
+        Fetch details of queries, grouped by the account and region they were started in. Groups are fetched in
+        parallel, each with an athena client from the client pool, see athena_clients.py.
+        Returns a dict of query execution id -> details, queries which couldn't be fetched are missing from it.
+        """
+        if not self.athena_clients:
+            return self.get_queries_details([query.query_execution_id for query in queries])
+        groups = {}
+        for query in queries:
+            groups.setdefault((query.account_id, query.region), []).append(query.query_execution_id)
+        if len(groups) == 1:
+            return self._get_group_details(*groups.popitem())
+        self.athena_clients.prepare()
+        futures = [_executor.submit(self._get_group_details, location, ids) for location, ids in groups.items()]
+        details = {}
+        for future in futures:
+            details.update(future.result())
+        return details
+
+    def _get_group_details(self, location, query_execution_ids):
+        try:
+            return self.get_queries_details(query_execution_ids, self.athena_clients.client(*location))
+        except ClientError:
+            # e.g. the role is missing in a new account or isn't allowed to read athena queries, or the region is
+            # disabled. Other groups are still handled, queries of this one are checked again later
+            logger.warning(f"Can't get details of queries of account and region {location}", exc_info=True)
+            return {}
+
+    def get_queries_details(self, query_execution_ids, athena=None):
+        """
+        Fetch details of queries of a single account and region using BatchGetQueryExecution calls of up to 50 ids,
+        with the updater's own athena client unless another one is given.
+        Unprocessed ids are retried and calls are slowed down adaptively when athena throttles us.
+        Returns a dict of query execution id -> details, queries which couldn't be fetched are missing from it.
+        """
+        athena = athena or self.athena
+        details = {}
+        delay = AdaptiveDelay()
+        pending = list(dict.fromkeys(query_execution_ids))
+        for attempt in range(MAX_ATHENA_ATTEMPTS):
+            if not pending:
+                break
+            if attempt:
+                backoff(attempt - 1)
+            retry = []
+            for i in range(0, len(pending), ATHENA_BATCH_SIZE):
+                batch = pending[i : i + ATHENA_BATCH_SIZE]
+                delay.wait()
+                try:
+                    with self.metrics.timer(ATHENA_CALL_TIME):
+                        response = athena.batch_get_query_execution(QueryExecutionIds=batch)
+                except ClientError as e:
+                    if e.response.get("Error", {}).get("Code") not in THROTTLING_ERROR_CODES:
+                        raise
+                    delay.throttled()
+                    retry.extend(batch)
+                    continue
+                delay.succeeded()
+                for execution in response.get("QueryExecutions", []):
+                    details[execution["QueryExecutionId"]] = self.get_execution_details(execution)
+                for unprocessed in response.get("UnprocessedQueryExecutionIds", []):
+                    if unprocessed.get("ErrorCode") in PERMANENT_ERROR_CODES:
+                        logger.warning(f"Can't get details of query {unprocessed}")
+                    else:
+                        retry.append(unprocessed["QueryExecutionId"])
+            pending = retry
+        if pending:
+            logger.warning(f"Details of {len(pending)} queries are still unavailable, will retry on the next run")
+        return details
+
+    @staticmethod
+    def get_execution_details(execution):
         return dict(
             query_state=execution["Status"]["State"],
             data_scanned=execution.get("Statistics", {}).get("DataScannedInBytes", 0),
             query=execution["Query"],
+            workgroup=execution.get("WorkGroup"),
         )
 
     def send_event_query_updated(self, query):
-        self.sqs.send_message(QueueUrl=self.config.SQS_QUEUE_URL, MessageBody=json.dumps(dataclasses.asdict(query)))
+        self.publisher.publish(codec.to_body(query))
@@ -1,20 +1,24 @@
+import json
 import unittest
 from unittest.mock import patch
 
 from bin.notificators.hard_threshold_notificator import HardThresholdNotificator
+from bin.notificators.slack_cache import SlackIdentityCache
 from .. import utils
 from ..test_notification import NotificationTest
 
 
 class TestHardThresholdNotificator(unittest.TestCase):
 
-    @patch("bin.notificators.notificator.requests")
-    def test_handle_batch_event_user_and_channel_value_above_threshold(self, requests):
+    def setUp(self):
+        SlackIdentityCache.clear()
+
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_handle_batch_event_user_and_channel_value_above_threshold(self, session):
         config = NotificationTest.get_mocked_config(user_threshold=100, channel_threshold=100)
         body = utils.get_content("fixtures/notification_sqs_event.json")
 
-        requests.post.side_effect = NotificationTest.requests_side_effect
-        requests.codes.ok = 200
+        session.post.side_effect = NotificationTest.requests_side_effect
 
         events = dict(Records=[dict(body=body)])
 
@@ -22,60 +26,126 @@ class TestHardThresholdNotificator(unittest.TestCase):
         sut.handle_batch_event(events)
 
         # assert channel message happened
-        requests.post.assert_any_call(
-            "url", json={"text": "tests message\ntext message admin channel", "link_names": 1}
+        session.post.assert_any_call(
+            "url", json={"text": "tests message\ntext message admin channel", "link_names": 1}, timeout=3
         )
 
         # assert private message was sent
         # assert POST to Slack with conversation start request was sent
-        requests.post.assert_any_call(
+        session.post.assert_any_call(
             "https://slack.com/api/conversations.open",
             headers={"Authorization": "Bearer token"},
             json={"users": "mapped_user"},
+            timeout=3,
         )
         # assert message to user was sent
-        requests.post.assert_any_call(
+        session.post.assert_any_call(
             "https://slack.com/api/chat.postMessage",
             headers={"Authorization": "Bearer token"},
             json={"channel": "test_channel", "text": "tests message\ntext message private user"},
+            timeout=3,
         )
 
-    @patch("bin.notificators.notificator.requests")
-    def test_handle_batch_event_test_separate_thresholds_channel_only(self, requests):
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_handle_batch_event_test_separate_thresholds_channel_only(self, session):
         # we should get only one API call as user threshold is above the actual value and channel threshold is below
         # please be advised that if slack API will change in the future...
         # ...this tests may start to fail (as more than one requests may be needed)
         config = NotificationTest.get_mocked_config(user_threshold=10000000000000000, channel_threshold=100)
         body = utils.get_content("fixtures/notification_sqs_event.json")
 
-        requests.post.side_effect = NotificationTest.requests_side_effect
-        requests.codes.ok = 200
+        session.post.side_effect = NotificationTest.requests_side_effect
 
         events = dict(Records=[dict(body=body)])
 
         sut = HardThresholdNotificator(config)
         sut.handle_batch_event(events)
 
-        requests.post.assert_any_call(
-            "url", json={"text": "tests message\ntext message admin channel", "link_names": 1}
+        session.post.assert_any_call(
+            "url", json={"text": "tests message\ntext message admin channel", "link_names": 1}, timeout=3
         )
-        requests.post.assert_called_once()
+        session.post.assert_called_once()
 
-    @patch("bin.notificators.notificator.requests")
-    def test_handle_batch_event_user_and_channel_value_below_threshold(self, requests):
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_handle_batch_event_user_and_channel_value_below_threshold(self, session):
         # we should have no API calls as user and channel thresholds are above the actual value
         config = NotificationTest.get_mocked_config(user_threshold=10000000000000000, channel_threshold=10000000000000)
         body = utils.get_content("fixtures/notification_sqs_event.json")
 
-        requests.post.side_effect = NotificationTest.requests_side_effect
-        requests.codes.ok = 200
+        session.post.side_effect = NotificationTest.requests_side_effect
 
         events = dict(Records=[dict(body=body)])
 
         sut = HardThresholdNotificator(config)
         sut.handle_batch_event(events)
 
-        requests.post.assert_not_called()
+        session.post.assert_not_called()
+
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_handle_batch_event_reuses_cached_conversation(self, session):
+        config = NotificationTest.get_mocked_config(user_threshold=100, channel_threshold=10000000000000)
+        body = utils.get_content("fixtures/notification_sqs_event.json")
+
+        session.post.side_effect = NotificationTest.requests_side_effect
+
+        events = dict(Records=[dict(body=body)])
+
+        HardThresholdNotificator(config).handle_batch_event(events)
+        HardThresholdNotificator(config).handle_batch_event(events)
+
+        urls = [call.args[0] for call in session.post.call_args_list]
+        self.assertEqual(
+            urls,
+            [
+                "https://slack.com/api/conversations.open",
+                "https://slack.com/api/chat.postMessage",
+                "https://slack.com/api/chat.postMessage",
+            ],
+        )
+
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_handle_batch_event_live_alert_of_running_query(self, session):
+        # thresholds of finished queries don't apply, the live alert is sent to both the user and the channel
+        config = NotificationTest.get_mocked_config(user_threshold=10000000000000000, channel_threshold=10000000000000)
+        config.SLACK_LIVE_ALERT_MESSAGE = "{user} query {query_id} still running"
+        body = json.loads(utils.get_content("fixtures/notification_sqs_event.json"))
+        body["query_state"] = "RUNNING"
+
+        session.post.side_effect = NotificationTest.requests_side_effect
+
+        sut = HardThresholdNotificator(config)
+        sut.handle_batch_event(dict(Records=[dict(body=json.dumps(body))]))
+
+        text = "test query 2bae702c-85a4-4944-974a-551a0ba4cc33 still running"
+        session.post.assert_any_call("url", json={"text": text, "link_names": 1}, timeout=3)
+        session.post.assert_any_call(
+            "https://slack.com/api/chat.postMessage",
+            headers={"Authorization": "Bearer token"},
+            json={"channel": "test_channel", "text": text},
+            timeout=3,
+        )
+        self.assertEqual(sut.event_id(json.dumps(body)), "2bae702c-85a4-4944-974a-551a0ba4cc33#live")
+
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_handle_batch_event_auto_cancelled_query(self, session):
+        config = NotificationTest.get_mocked_config(user_threshold=10000000000000000, channel_threshold=10000000000000)
+        config.SLACK_AUTO_CANCEL_MESSAGE = "cancelled"
+        body = json.loads(utils.get_content("fixtures/notification_sqs_event.json"))
+        body.update(query_state="CANCELLED", auto_cancelled=True, version=5)
+
+        session.post.side_effect = NotificationTest.requests_side_effect
+
+        HardThresholdNotificator(config).handle_batch_event(dict(Records=[dict(body=json.dumps(body))]))
+
+        session.post.assert_any_call(
+            "url", json={"text": "tests message\ncancelled\ntext message admin channel", "link_names": 1}, timeout=3
+        )
+        session.post.assert_any_call(
+            "https://slack.com/api/chat.postMessage",
+            headers={"Authorization": "Bearer token"},
+            json={"channel": "test_channel", "text": "tests message\ncancelled\ntext message private user"},
+            timeout=3,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,119 @@
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+from bin.notificators import slack_cache
+from bin.notificators.slack_cache import SlackIdentityCache, user_key
+
+
+class TestSlackIdentityCache(unittest.TestCase):
+
+    def setUp(self):
+        SlackIdentityCache.clear()
+
+    @staticmethod
+    def get_sut(table_name=None):
+        config = Mock()
+        config.SLACK_CACHE_TABLE = table_name
+        dynamodb = Mock()
+        dynamodb.Table.return_value.get_item.return_value = {}
+        return SlackIdentityCache(config, dynamodb), dynamodb.Table.return_value
+
+    def test_lookup_caches_values_in_memory(self):
+        sut, _ = self.get_sut()
+        fetch = Mock(return_value="U1")
+
+        self.assertEqual(sut.lookup(user_key("A@example.com"), fetch, 60), "U1")
+        self.assertEqual(sut.lookup(user_key("a@example.com"), fetch, 60), "U1")
+        fetch.assert_called_once()
+
+    def test_lookup_caches_missing_values_only_with_negative_ttl(self):
+        sut, _ = self.get_sut()
+        fetch = Mock(return_value=None)
+
+        sut.lookup("dm#U1", fetch, 60)
+        sut.lookup("dm#U1", fetch, 60)
+        self.assertEqual(fetch.call_count, 2)
+
+        sut.lookup("user#a", fetch, 60, negative_ttl=60)
+        self.assertIsNone(sut.lookup("user#a", fetch, 60, negative_ttl=60))
+        self.assertEqual(fetch.call_count, 3)
+
+    @patch("bin.notificators.slack_cache.time")
+    def test_lookup_expires_values(self, time):
+        sut, _ = self.get_sut()
+        fetch = Mock(side_effect=["U1", "U2"])
+        time.time.return_value = 1000
+
+        sut.lookup("user#a", fetch, 60)
+        time.time.return_value = 1060
+
+        self.assertEqual(sut.lookup("user#a", fetch, 60), "U2")
+
+    @patch.object(slack_cache, "MAX_MEMORY_ENTRIES", 2)
+    def test_memory_is_bounded(self):
+        sut, _ = self.get_sut()
+        sut.put("a", "1", 60)
+        sut.put("b", "2", 60)
+        sut.lookup("a", Mock(), 60)
+        sut.put("c", "3", 60)
+
+        self.assertEqual(list(SlackIdentityCache._memory), ["a", "c"])
+
+    def test_persistent_tier(self):
+        sut, table = self.get_sut("slack_cache")
+        table.get_item.return_value = {"Item": {"cache_key": "user#a", "value": "U1", "expires_at": 2**40}}
+        fetch = Mock()
+
+        self.assertEqual(sut.lookup("user#a", fetch, 60), "U1")
+        self.assertEqual(sut.lookup("user#a", fetch, 60), "U1")
+
+        fetch.assert_not_called()
+        table.get_item.assert_called_once_with(Key={"cache_key": "user#a"})
+
+    def test_persistent_tier_stores_missing_values_without_value(self):
+        sut, table = self.get_sut("slack_cache")
+
+        sut.lookup("user#a", Mock(return_value=None), 60, negative_ttl=30)
+
+        item = table.put_item.call_args.kwargs["Item"]
+        self.assertEqual(set(item), {"cache_key", "expires_at"})
+
+    def test_invalidate(self):
+        sut, table = self.get_sut("slack_cache")
+        sut.put("dm#U1", "D1", 60)
+
+        sut.invalidate("dm#U1")
+
+        self.assertNotIn("dm#U1", SlackIdentityCache._memory)
+        table.delete_item.assert_called_once_with(Key={"cache_key": "dm#U1"})
+
+    def test_warm_up_reads_all_pages(self):
+        sut, table = self.get_sut("slack_cache")
+        table.batch_writer.return_value = MagicMock()
+        writer = table.batch_writer.return_value.__enter__.return_value
+        slack = Mock()
+        slack.api_call.return_value.json.side_effect = [
+            dict(
+                ok=True,
+                members=[
+                    dict(id="U1", profile=dict(email="a@example.com")),
+                    dict(id="U2", profile=dict()),
+                ],
+                response_metadata=dict(next_cursor="next"),
+            ),
+            dict(
+                ok=True,
+                members=[dict(id="U3", deleted=True, profile=dict(email="c@example.com"))],
+                response_metadata=dict(next_cursor=""),
+            ),
+        ]
+
+        self.assertEqual(sut.warm_up(slack), 1)
+
+        slack.api_call.assert_called_with("users.list", data={"limit": 200, "cursor": "next"})
+        writer.put_item.assert_called_once()
+        self.assertEqual(sut.lookup(user_key("a@example.com"), Mock(), 60), "U1")
+
+
+if __name__ == "__main__":
+    unittest.main()
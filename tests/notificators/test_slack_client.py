@@ -0,0 +1,47 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from bin.notificators.slack_client import SlackClient
+
+
+class TestSlackClient(unittest.TestCase):
+
+    @staticmethod
+    def response(status_code, retry_after=None):
+        response = Mock()
+        response.status_code = status_code
+        response.headers = {"Retry-After": retry_after} if retry_after else {}
+        return response
+
+    @patch("bin.notificators.slack_client.time")
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_api_call_retries_rate_limited_calls(self, session, time):
+        config = Mock()
+        config.SLACK_BOT_TOKEN = "token"
+        session.post.side_effect = [self.response(429, "2"), self.response(200)]
+
+        response = SlackClient(config).api_call("chat.postMessage", json={"text": "text"})
+
+        self.assertEqual(response.status_code, 200)
+        time.sleep.assert_called_once_with(2.0)
+        session.post.assert_called_with(
+            "https://slack.com/api/chat.postMessage",
+            headers={"Authorization": "Bearer token"},
+            json={"text": "text"},
+            timeout=3,
+        )
+
+    @patch("bin.notificators.slack_client.time")
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_post_gives_up_when_retry_after_is_too_long(self, session, time):
+        session.post.return_value = self.response(429, "30")
+
+        response = SlackClient(Mock()).post("url", json={})
+
+        self.assertEqual(response.status_code, 429)
+        session.post.assert_called_once()
+        time.sleep.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
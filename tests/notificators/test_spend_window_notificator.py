@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from bin.notificators.slack_cache import SlackIdentityCache
+from bin.notificators.spend_window_notificator import SpendWindowNotificator
+from bin.spend_window_dao import WindowSpend
+from .. import utils
+from ..test_notification import NotificationTest
+
+
+class TestSpendWindowNotificator(unittest.TestCase):
+
+    def setUp(self):
+        SlackIdentityCache.clear()
+
+    @staticmethod
+    def get_sut(spends, alerted=True):
+        config = NotificationTest.get_mocked_config()
+        config.SPEND_WINDOW_THRESHOLDS = {86400: 10 * 1024**3, 3600: 3 * 1024**3}
+        config.SLACK_SPEND_WINDOW_MESSAGE = "{user} scanned {data_scanned_gb} GB in the last {window}"
+        sut = SpendWindowNotificator(config, dynamodb=Mock())
+        sut.dao = Mock()
+        sut.dao.add_spend.return_value = spends
+        sut.dao.mark_alerted.return_value = alerted
+        return sut
+
+    @patch("bin.notificators.spend_window_notificator.time")
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_notifies_when_window_threshold_is_crossed(self, session, time):
+        time.time.return_value = 7200
+        session.post.side_effect = NotificationTest.requests_side_effect
+        crossed = WindowSpend(length=3600, bucket_start=7200, current=3 * 1024**3, previous=0, added=329724698)
+        below = WindowSpend(length=86400, bucket_start=0, current=500, previous=0, added=329724698)
+        sut = self.get_sut([crossed, below])
+
+        sut.handle_single_event(utils.get_content("fixtures/notification_sqs_event.json"))
+
+        sut.dao.add_spend.assert_called_once_with(
+            "test", "2bae702c-85a4-4944-974a-551a0ba4cc33", 329724698, [3600, 86400], 7200
+        )
+        sut.dao.mark_alerted.assert_called_once_with("test", crossed)
+        session.post.assert_any_call(
+            "url", json={"text": "test scanned 3 GB in the last 1 h", "link_names": 1}, timeout=3
+        )
+        session.post.assert_any_call(
+            "https://slack.com/api/chat.postMessage",
+            headers={"Authorization": "Bearer token"},
+            json={"channel": "test_channel", "text": "test scanned 3 GB in the last 1 h"},
+            timeout=3,
+        )
+
+    @patch("bin.notificators.spend_window_notificator.time")
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_does_not_notify_again_above_threshold(self, session, time):
+        time.time.return_value = 7200
+        above = WindowSpend(length=3600, bucket_start=7200, current=4 * 1024**3, previous=0, added=10)
+        sut = self.get_sut([above])
+
+        sut.handle_single_event(utils.get_content("fixtures/notification_sqs_event.json"))
+
+        sut.dao.mark_alerted.assert_not_called()
+        session.post.assert_not_called()
+
+    @patch("bin.notificators.spend_window_notificator.time")
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_does_not_notify_when_already_alerted(self, session, time):
+        time.time.return_value = 7200
+        crossed = WindowSpend(length=3600, bucket_start=7200, current=3 * 1024**3, previous=0, added=329724698)
+        sut = self.get_sut([crossed], alerted=False)
+
+        sut.handle_single_event(utils.get_content("fixtures/notification_sqs_event.json"))
+
+        session.post.assert_not_called()
+
+    @patch("bin.notificators.slack_client.SlackClient.session")
+    def test_ignores_live_alerts_of_running_queries(self, session):
+        sut = self.get_sut([])
+        body = utils.get_content("fixtures/notification_sqs_event.json").replace("SUCCEEDED", "RUNNING")
+
+        sut.handle_single_event(body)
+
+        sut.dao.add_spend.assert_not_called()
+        session.post.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import Mock, patch
+
+from bin.athena_clients import AthenaClientPool
+
+# 2019-01-21 09:34:30 UTC
+NOW = 1548063270
+
+
+class AthenaClientPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        AthenaClientPool.clear()
+        self.athena = Mock()
+        self.sts = Mock()
+        self.sts.get_caller_identity.return_value = dict(Account="111111111111")
+        self.sts.assume_role.side_effect = lambda **kwargs: dict(
+            Credentials=dict(
+                AccessKeyId="key",
+                SecretAccessKey="secret",
+                SessionToken="token",
+                Expiration=datetime.fromtimestamp(NOW + 3600, timezone.utc),
+            )
+        )
+        environment = patch.dict("os.environ", AWS_REGION="us-east-1")
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.create_client_patch = patch.object(AthenaClientPool, "_create_client", side_effect=lambda *args: Mock())
+        self.create_client = self.create_client_patch.start()
+        self.addCleanup(patch.stopall)
+
+    def get_sut(self, role_name="athena_alerter_reader"):
+        config = Mock()
+        config.ATHENA_ROLE_NAME = role_name
+        return AthenaClientPool(config, self.athena, self.sts)
+
+    def test_own_account_and_region_use_own_client(self):
+        sut = self.get_sut()
+
+        self.assertIs(sut.client(), self.athena)
+        self.assertIs(sut.client("111111111111", "us-east-1"), self.athena)
+        self.sts.assume_role.assert_not_called()
+
+    def test_other_region_of_own_account(self):
+        sut = self.get_sut()
+
+        client = sut.client("111111111111", "eu-west-1")
+
+        self.assertIs(sut.client("111111111111", "eu-west-1"), client)
+        self.create_client.assert_called_once_with("eu-west-1", {})
+        self.sts.assume_role.assert_not_called()
+
+    @patch("bin.athena_clients.time")
+    def test_other_account_assumes_role_once_per_account(self, time):
+        time.time.return_value = NOW
+        sut = self.get_sut()
+
+        client = sut.client("222222222222", None)
+        self.assertIs(sut.client("222222222222", None), client)
+        sut.client("222222222222", "eu-west-1")
+
+        self.sts.assume_role.assert_called_once_with(
+            RoleArn="arn:aws:iam::222222222222:role/athena_alerter_reader",
+            RoleSessionName="athena_alerter",
+            DurationSeconds=3600,
+        )
+        self.create_client.assert_called_with(
+            "eu-west-1", dict(aws_access_key_id="key", aws_secret_access_key="secret", aws_session_token="token")
+        )
+
+    @patch("bin.athena_clients.time")
+    def test_credentials_are_refreshed_before_they_expire(self, time):
+        time.time.return_value = NOW
+        sut = self.get_sut()
+        client = sut.client("222222222222", None)
+
+        # 50 minutes later the credentials expire within the refresh margin
+        time.time.return_value = NOW + 3000
+        refreshed = sut.client("222222222222", None)
+
+        self.assertIsNot(refreshed, client)
+        self.assertEqual(self.sts.assume_role.call_count, 2)
+
+    def test_other_accounts_use_own_client_without_role(self):
+        sut = self.get_sut(role_name="")
+
+        self.assertIs(sut.client("222222222222", "us-east-1"), self.athena)
+        self.sts.assume_role.assert_not_called()
+        self.sts.get_caller_identity.assert_not_called()
+
+    def test_prepare_resolves_own_account(self):
+        sut = self.get_sut()
+
+        sut.prepare()
+        sut.client("111111111111", None)
+
+        self.sts.get_caller_identity.assert_called_once_with()
+
+    def test_create_client_uses_own_session(self):
+        self.create_client_patch.stop()
+        with patch("boto3.session.Session") as session:
+            client = AthenaClientPool._create_client("eu-west-1", dict(aws_session_token="token"))
+
+        session.return_value.client.assert_called_once_with(
+            "athena", region_name="eu-west-1", aws_session_token="token"
+        )
+        self.assertIs(client, session.return_value.client.return_value)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import gzip
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from . import utils
+from bin.backfill import Backfill, Checkpoint, list_logs
+
+
+class BackfillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        content = gzip.compress(utils.get_content("fixtures/query_write_cloudtrail.json").encode("utf-8"))
+        self.paths = []
+        for name in ("2019/01/17/a.json.gz", "2019/01/18/b.json.gz"):
+            path = os.path.join(self.directory.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(content)
+            self.paths.append(path)
+        with open(os.path.join(self.directory.name, "2019", "digest.json"), "w") as f:
+            f.write("{}")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_list_logs(self):
+        self.assertEqual(sorted(list_logs(self.directory.name)), self.paths)
+
+    def test_backfill(self):
+        query_dao = Mock()
+        query_dao.new_queries.side_effect = lambda queries: queries
+        updater = Mock()
+        updater.get_details.return_value = {
+            "fda9a497-05e8-4c76-9734-561118eb3623": dict(query_state="SUCCEEDED", data_scanned=10, query="select 1")
+        }
+        updater.apply_details.side_effect = lambda query, details: setattr(query, "query_state", details["query_state"])
+
+        for workers in (1, 2):
+            stats = Backfill(Mock(), query_dao, updater, workers=workers).run(self.paths)
+
+            self.assertEqual(stats, dict(logs=2, bytes=2 * os.path.getsize(self.paths[0]), queries=2, finalised=2))
+            queries = query_dao.insert_queries.call_args.args[0]
+            self.assertEqual(
+                [query.query_execution_id for query in queries], ["fda9a497-05e8-4c76-9734-561118eb3623"] * 2
+            )
+
+    def test_backfill_skips_existing_queries_before_applying_details(self):
+        query_dao = Mock()
+        query_dao.new_queries.return_value = []
+        updater = Mock()
+
+        stats = Backfill(Mock(), query_dao, updater, workers=1).run(self.paths)
+
+        self.assertEqual(stats["queries"], 2)
+        updater.get_details.assert_not_called()
+        updater.apply_details.assert_not_called()
+        query_dao.insert_queries.assert_called_with([])
+
+    def test_backfill_resumes_from_checkpoint(self):
+        checkpoint_path = os.path.join(self.directory.name, "checkpoint")
+        checkpoint = Checkpoint(checkpoint_path)
+        Backfill(Mock(), Mock(), checkpoint=checkpoint, workers=1).run(self.paths[:1])
+        checkpoint.close()
+
+        query_dao = Mock()
+        checkpoint = Checkpoint(checkpoint_path)
+        stats = Backfill(Mock(), query_dao, checkpoint=checkpoint, workers=1).run(self.paths)
+        checkpoint.close()
+
+        self.assertEqual(stats["logs"], 1)
+        with open(checkpoint_path) as f:
+            self.assertEqual(f.read().split(), self.paths)
+
+
+if __name__ == "__main__":
+    unittest.main()
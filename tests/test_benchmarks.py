@@ -0,0 +1,33 @@
+import unittest
+
+from benchmarks.pipeline import PipelineBenchmark
+
+
+class BenchmarksTest(unittest.TestCase):
+
+    def test_pipeline_benchmark(self):
+        results = PipelineBenchmark(files=2, records=300, athena_share=0.2).run()
+
+        self.assertEqual(results["ingest"]["records"], 600)
+        self.assertGreater(results["update"]["records"], 0)
+        self.assertEqual(results["notify"]["records"], results["update"]["records"])
+        self.assertEqual(results["api_calls"]["s3.GetObject"], 2)
+        self.assertEqual(results["api_calls"]["dynamodb.UpdateItem"], results["update"]["records"])
+
+    def test_pipeline_benchmark_with_sharded_keys(self):
+        unsharded = PipelineBenchmark(files=2, records=300, athena_share=0.2).run()
+        results = PipelineBenchmark(files=2, records=300, athena_share=0.2, shards=4).run()
+
+        self.assertEqual(results["update"]["records"], unsharded["update"]["records"])
+        self.assertEqual(results["notify"]["records"], results["update"]["records"])
+
+    def test_pipeline_benchmark_traces_memory_per_stage(self):
+        results = PipelineBenchmark(files=1, records=300, athena_share=0.2, trace_memory=True).run()
+
+        self.assertGreater(results["ingest"]["peak_allocated_mb"], 0)
+        self.assertIn("peak_allocated_mb", results["notify"])
+        self.assertGreater(results["peak_rss_mb"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
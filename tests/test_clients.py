@@ -0,0 +1,25 @@
+import unittest
+from unittest.mock import patch
+
+from bin import clients
+
+
+class ClientsTest(unittest.TestCase):
+
+    def setUp(self):
+        clients._clients.clear()
+        clients._resources.clear()
+
+    @patch("boto3.resource")
+    @patch("boto3.client")
+    def test_clients_are_created_once(self, client, resource):
+        self.assertIs(clients.client("sqs"), clients.client("sqs"))
+        self.assertIs(clients.resource("dynamodb"), clients.resource("dynamodb"))
+        clients.client("athena")
+
+        self.assertEqual(client.call_count, 2)
+        resource.assert_called_once_with("dynamodb")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,14 +2,19 @@ import unittest
 import os
 from unittest.mock import Mock
 import gzip
-from io import BytesIO
+from io import BytesIO, StringIO
 
 from bin.model import AthenaQuery
 from bin.cloudtrail_handler import CloudtrailHandler
+from bin.dedup import DedupStore, finished_key
+from bin.metrics import QUERIES_INSERTED, EmbeddedMetrics
 
 
 class CloudtrailHandlerTest(unittest.TestCase):
 
+    def setUp(self):
+        DedupStore.clear()
+
     def get_gziped_content(self, path):
         dir = os.path.dirname(os.path.abspath(__file__))
         with open(os.path.join(dir, path)) as fixture:
@@ -26,9 +31,9 @@ class CloudtrailHandlerTest(unittest.TestCase):
         dynamodb = Mock()
 
         s3 = Mock()
-        s3_object = Mock()
-        s3.Object.return_value.get.return_value = dict(Body=s3_object)
-        s3_object.read.return_value = self.get_gziped_content("fixtures/query_write_cloudtrail.json")
+        s3.Object.return_value.get.return_value = dict(
+            Body=BytesIO(self.get_gziped_content("fixtures/query_write_cloudtrail.json"))
+        )
 
         query_dao = Mock()
 
@@ -41,18 +46,93 @@ class CloudtrailHandlerTest(unittest.TestCase):
         # then
         s3.Object.assert_called_with("bucket", "key")
 
-        query_dao.insert_query.assert_called_with(
-            AthenaQuery(
-                start_date="2019-01-17",
-                start_timestamp="2019-01-17 11:57:30",
-                query_execution_id="fda9a497-05e8-4c76-9734-561118eb3623",
-                query_state="RUNNING",
-                executing_user="testUser",
-                data_scanned=0,
-                query_sql=None,
-            )
+        query_dao.insert_queries.assert_called_once_with(
+            [
+                AthenaQuery(
+                    start_date="2019-01-17",
+                    start_timestamp="2019-01-17 11:57:30",
+                    query_execution_id="fda9a497-05e8-4c76-9734-561118eb3623",
+                    query_state="RUNNING",
+                    executing_user="testUser",
+                    data_scanned=0,
+                    query_sql=None,
+                    account_id="XXX",
+                    region="us-east-1",
+                )
+            ],
+            skip_existing=True,
+        )
+
+    def test_process_log_counts_inserted_queries(self):
+        s3 = Mock()
+        s3.Object.return_value.get.return_value = dict(
+            Body=BytesIO(self.get_gziped_content("fixtures/query_write_cloudtrail.json"))
+        )
+        query_dao = Mock()
+        # the query is already in the table
+        query_dao.insert_queries.return_value = 0
+        metrics = EmbeddedMetrics("athena_alerter", dict(Function="test"), stream=StringIO())
+        event = dict(Records=[dict(s3=dict(bucket=dict(name="bucket"), object=dict(key="key")))])
+
+        sut = CloudtrailHandler(Mock(), s3, query_dao, metrics=metrics)
+        sut.process_log(event)
+
+        self.assertEqual(metrics.counters[QUERIES_INSERTED], 0)
+
+    def test_process_log_finalises_queries_finished_before_insert(self):
+        config = Mock()
+        config.DEDUP_TABLE = None
+        s3 = Mock()
+        s3.Object.return_value.get.return_value = dict(
+            Body=BytesIO(self.get_gziped_content("fixtures/query_write_cloudtrail.json"))
+        )
+        dedup = DedupStore(config)
+        dedup.mark(finished_key("fda9a497-05e8-4c76-9734-561118eb3623"))
+        finalise_queries = Mock()
+        event = dict(Records=[dict(s3=dict(bucket=dict(name="bucket"), object=dict(key="key")))])
+
+        sut = CloudtrailHandler(config, s3, Mock(), dedup=dedup, finalise_queries=finalise_queries)
+        sut.process_log(event)
+
+        finalise_queries.assert_called_once()
+        self.assertEqual(
+            [query.query_execution_id for query in finalise_queries.call_args[0][0]],
+            ["fda9a497-05e8-4c76-9734-561118eb3623"],
         )
 
+    def test_process_log_skips_logs_without_athena_events(self):
+        s3 = Mock()
+        content = BytesIO()
+        with gzip.GzipFile(None, "wb", fileobj=content) as file:
+            file.write(b'{"Records": [{"eventName": "GetObject", "eventSource": "s3.amazonaws.com"}]}')
+        s3.Object.return_value.get.return_value = dict(Body=BytesIO(content.getvalue()))
+        query_dao = Mock()
+
+        event = dict(Records=[dict(s3=dict(bucket=dict(name="bucket"), object=dict(key="key")))])
+
+        sut = CloudtrailHandler(Mock(), s3, query_dao)
+        sut.process_log(event)
+
+        query_dao.insert_queries.assert_not_called()
+
+    def test_process_log_skips_redelivered_logs(self):
+        DedupStore.clear()
+        config = Mock()
+        config.DEDUP_TABLE = None
+        s3 = Mock()
+        s3.Object.return_value.get.side_effect = lambda: dict(
+            Body=BytesIO(self.get_gziped_content("fixtures/query_write_cloudtrail.json"))
+        )
+        query_dao = Mock()
+        event = dict(Records=[dict(s3=dict(bucket=dict(name="bucket"), object=dict(key="key")))])
+
+        sut = CloudtrailHandler(config, s3, query_dao, dedup=DedupStore(config))
+        sut.process_log(event)
+        sut.process_log(event)
+
+        s3.Object.assert_called_once_with("bucket", "key")
+        query_dao.insert_queries.assert_called_once()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,77 @@
+import gzip
+import json
+import unittest
+from io import BytesIO
+
+from . import utils
+from bin.cloudtrail_reader import LogPrefilter, decompress, iter_records, read_chunks
+
+
+class CloudtrailReaderTest(unittest.TestCase):
+
+    def split(self, content, size):
+        return [content[i : i + size] for i in range(0, len(content), size)]
+
+    def test_iter_records_across_chunk_boundaries(self):
+        content = utils.get_content("fixtures/query_write_cloudtrail.json").encode("utf-8")
+        expected = json.loads(content)["Records"]
+
+        for size in (1, 7, 64, len(content)):
+            self.assertEqual(list(iter_records(self.split(content, size))), expected)
+
+    def test_iter_records_with_marker(self):
+        content = utils.get_content("fixtures/query_write_cloudtrail.json").encode("utf-8")
+
+        records = list(iter_records(self.split(content, 13), marker='"StartQueryExecution"'))
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["responseElements"]["queryExecutionId"], "fda9a497-05e8-4c76-9734-561118eb3623")
+
+    def test_iter_records_ignores_brackets_in_strings_and_other_keys(self):
+        content = json.dumps(
+            {"Other": [{"Records": [1]}], "Records": [{"q": 'a "}]" \\ ['}, {"q": "ż{"}], "Trailer": "]"}
+        ).encode("utf-8")
+
+        for size in (1, 5, len(content)):
+            self.assertEqual(list(iter_records(self.split(content, size))), [{"q": 'a "}]" \\ ['}, {"q": "ż{"}])
+
+    def test_iter_records_without_records(self):
+        self.assertEqual(list(iter_records([b'{"Digest": true}'])), [])
+
+    def test_iter_records_invalid_json(self):
+        for content in (b"", b"not a json", b'{"Records": [{"eventName": "x"}'):
+            with self.assertRaises(json.JSONDecodeError):
+                list(iter_records([content]))
+
+    def test_decompress_concatenated_members(self):
+        content = gzip.compress(b"first ") + gzip.compress(b"second")
+
+        chunks = decompress(read_chunks(BytesIO(content), chunk_size=5))
+
+        self.assertEqual(b"".join(chunks), b"first second")
+
+    def test_prefilter_passes_log_with_markers(self):
+        content = gzip.compress(utils.get_content("fixtures/query_write_cloudtrail.json").encode("utf-8"))
+        sut = LogPrefilter(spool_max_size=16)
+
+        chunks = sut.filter(read_chunks(BytesIO(content), chunk_size=32))
+
+        # all chunks are replayed, including the ones consumed while looking for the markers
+        self.assertEqual(b"".join(chunks), content)
+
+    def test_prefilter_skips_log_without_markers(self):
+        content = gzip.compress(json.dumps({"Records": [{"eventSource": "s3.amazonaws.com"}]}).encode("utf-8"))
+        sut = LogPrefilter()
+
+        self.assertIsNone(sut.filter(read_chunks(BytesIO(content))))
+
+    def test_prefilter_finds_markers_split_between_chunks(self):
+        sut = LogPrefilter(markers=(b'"marker"',))
+        content = gzip.compress(b'{"a": "mar", "b": "marker"}')
+
+        # the whole log is passed on, including the chunks read while looking for the marker
+        self.assertEqual(b"".join(sut.filter(read_chunks(BytesIO(content), chunk_size=1))), content)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from unittest.mock import Mock
+
+from bin.cloudwatch_metrics import CloudwatchMetrics
+
+
+class CloudwatchMetricsTest(unittest.TestCase):
+
+    @staticmethod
+    def get_mocked_config():
+        config = Mock()
+        config.CLOUDWATCH_METRIC_NAMESPACE = "athena_alerter"
+        config.CLOUDWATCH_METRIC_NAME = "athena_alerter_bytes_scanned_test"
+        return config
+
+    def test_flush_aggregates_values_per_user(self):
+        cloudwatch = Mock()
+
+        sut = CloudwatchMetrics(self.get_mocked_config(), cloudwatch)
+        sut.report_query_metric(300, "first")
+        sut.report_query_metric(100, "first")
+        sut.report_query_metric(300, "first")
+        sut.report_query_metric(100, "second")
+        sut.flush()
+
+        cloudwatch.put_metric_data.assert_called_once_with(
+            MetricData=[
+                {
+                    "MetricName": "athena_alerter_bytes_scanned_test",
+                    "Dimensions": [{"Name": "athena_user", "Value": "first"}],
+                    "Unit": "Bytes",
+                    "Values": [100, 300],
+                    "Counts": [1, 2],
+                },
+                {
+                    "MetricName": "athena_alerter_bytes_scanned_test",
+                    "Dimensions": [{"Name": "athena_user", "Value": "second"}],
+                    "Unit": "Bytes",
+                    "Values": [100],
+                    "Counts": [1],
+                },
+            ],
+            Namespace="athena_alerter",
+        )
+
+        sut.flush()
+        cloudwatch.put_metric_data.assert_called_once()
+
+    def test_flush_splits_metric_data_over_the_limits(self):
+        cloudwatch = Mock()
+
+        sut = CloudwatchMetrics(self.get_mocked_config(), cloudwatch)
+        for user in range(1001):
+            sut.report_query_metric(1, str(user))
+        for value in range(200):
+            sut.report_query_metric(value, "many")
+        sut.flush()
+
+        calls = cloudwatch.put_metric_data.call_args_list
+        self.assertEqual([len(call[1]["MetricData"]) for call in calls], [1000, 3])
+        self.assertEqual([len(metric["Values"]) for metric in calls[1][1]["MetricData"]], [1, 150, 50])
+
+
+if __name__ == "__main__":
+    unittest.main()
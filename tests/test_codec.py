@@ -0,0 +1,48 @@
+import json
+import unittest
+from decimal import Decimal
+
+from bin import codec
+from bin.model import AthenaQuery
+
+
+class CodecTest(unittest.TestCase):
+
+    query = AthenaQuery("2019-01-21", "2019-01-21 15:17:24", "1", "SUCCEEDED", "test", 329724698, "select 1")
+
+    def test_body_round_trip(self):
+        body = codec.to_body(self.query)
+
+        self.assertEqual(json.loads(body)["version"], codec.CODEC_VERSION)
+        self.assertEqual(codec.from_body(body), self.query)
+
+    def test_from_body_without_version_and_with_unknown_fields(self):
+        values = self.query.to_dict()
+        values["added_later"] = True
+        del values["query_sql"]
+
+        query = codec.from_body(json.dumps(values))
+
+        self.assertEqual(query.query_sql, None)
+        self.assertEqual(query.data_scanned, 329724698)
+
+    def test_item_round_trip(self):
+        running = AthenaQuery("2019-01-21", "2019-01-21 15:17:24", "1", "RUNNING", "test")
+
+        item = codec.to_item(running)
+
+        self.assertNotIn("query_sql", item)
+        self.assertEqual(codec.from_item(item), running)
+
+    def test_from_item_ignores_storage_attributes(self):
+        item = codec.to_item(self.query)
+        item.update(data_scanned=Decimal(329724698), in_flight="1")
+
+        query = codec.from_item(item)
+
+        self.assertEqual(query, self.query)
+        self.assertIs(type(query.data_scanned), int)
+
+
+if __name__ == "__main__":
+    unittest.main()
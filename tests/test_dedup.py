@@ -0,0 +1,102 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from botocore.exceptions import ClientError
+
+from bin import dedup
+from bin.dedup import NO_DEDUP, DedupStore
+
+
+class DedupStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        DedupStore.clear()
+
+    @staticmethod
+    def get_sut(table_name=None):
+        config = Mock()
+        config.DEDUP_TABLE = table_name
+        dynamodb = Mock()
+        return DedupStore(config, dynamodb), dynamodb.Table.return_value
+
+    def test_run_once_in_memory(self):
+        sut, _ = self.get_sut()
+        function = Mock()
+
+        self.assertTrue(sut.run_once("key", function))
+        self.assertFalse(sut.run_once("key", function))
+        self.assertTrue(sut.run_once("other", function))
+        self.assertEqual(function.call_count, 2)
+
+    def test_failed_work_is_released(self):
+        sut, table = self.get_sut("dedup")
+        function = Mock(side_effect=[ValueError("failed"), None])
+
+        with self.assertRaises(ValueError):
+            sut.run_once("key", function)
+        table.delete_item.assert_called_once_with(Key={"cache_key": "key"})
+        self.assertTrue(sut.run_once("key", function))
+        self.assertEqual(function.call_count, 2)
+
+    @patch("bin.dedup.time")
+    def test_claims_expire(self, time):
+        time.time.return_value = 1000
+        sut, _ = self.get_sut()
+        self.assertTrue(sut.claim("key"))
+        self.assertFalse(sut.claim("key"))
+
+        time.time.return_value = 1000 + dedup.CLAIM_TTL + 1
+        self.assertTrue(sut.claim("key"))
+
+    @patch("bin.dedup.time")
+    def test_persistent_tier(self, time):
+        time.time.return_value = 1000
+        sut, table = self.get_sut("dedup")
+
+        self.assertTrue(sut.run_once("key", Mock()))
+
+        table.put_item.assert_any_call(
+            Item={"cache_key": "key", "expires_at": 1000 + dedup.CLAIM_TTL},
+            ConditionExpression="attribute_not_exists(cache_key) OR expires_at < :now",
+            ExpressionAttributeValues={":now": 1000},
+        )
+        table.put_item.assert_called_with(Item={"cache_key": "key", "expires_at": 1000 + dedup.DONE_TTL})
+
+    def test_key_claimed_by_another_container_is_skipped(self):
+        sut, table = self.get_sut("dedup")
+        table.put_item.side_effect = ClientError(dict(Error=dict(Code="ConditionalCheckFailedException")), "PutItem")
+        function = Mock()
+
+        self.assertFalse(sut.run_once("key", function))
+        function.assert_not_called()
+
+    @patch("bin.dedup.time")
+    def test_marked_keys(self, time):
+        time.time.return_value = 1000
+        sut, table = self.get_sut("dedup")
+        table.name = "dedup"
+        sut.dynamodb.batch_get_item.return_value = dict(
+            Responses=dict(dedup=[dict(cache_key="remote", expires_at=2000), dict(cache_key="expired", expires_at=900)])
+        )
+
+        sut.mark("local")
+
+        table.put_item.assert_called_once_with(Item={"cache_key": "local", "expires_at": 1000 + dedup.MARK_TTL})
+        self.assertEqual(sut.marked(["local", "remote", "expired", "missing"]), {"local", "remote"})
+        sut.dynamodb.batch_get_item.assert_called_once_with(
+            RequestItems=dict(
+                dedup=dict(Keys=[dict(cache_key="remote"), dict(cache_key="expired"), dict(cache_key="missing")])
+            )
+        )
+
+    def test_no_dedup(self):
+        function = Mock()
+
+        self.assertTrue(NO_DEDUP.run_once("key", function))
+        self.assertTrue(NO_DEDUP.run_once("key", function))
+        self.assertEqual(function.call_count, 2)
+        self.assertEqual(NO_DEDUP.marked(["key"]), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+import csv
+import gzip
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from bin import codec, export
+from bin.export import CSV, PARQUET, QueryExport
+from bin.query_dao import QueryDao
+
+
+class QueryExportTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output = directory.name
+        self.dynamodb = Mock()
+        self.query_dao = QueryDao(SimpleNamespace(QUERIES_TABLE="queries", QUERIES_TABLE_SHARDS=2), self.dynamodb)
+
+    @staticmethod
+    def item(day, second):
+        return dict(
+            start_date=f"2019-01-{day:02}",
+            start_timestamp=f"2019-01-{day:02} 09:34:{second:02}",
+            query_execution_id=f"{day}-{second}",
+            query_state="SUCCEEDED",
+            executing_user="test",
+            data_scanned=10,
+            query_sql="select 1",
+        )
+
+    def read_partitions(self):
+        """Rows of all exported files by the date of their partition"""
+        rows = {}
+        for directory in sorted(os.listdir(self.output)):
+            for name in sorted(os.listdir(os.path.join(self.output, directory))):
+                with gzip.open(os.path.join(self.output, directory, name), "rt", newline="") as file:
+                    rows.setdefault(directory, []).extend(csv.DictReader(file))
+        return rows
+
+    def test_run_exports_all_segments_by_day(self):
+        pages = {
+            (0, None): dict(Items=[self.item(20, 0), self.item(21, 1)], LastEvaluatedKey="page"),
+            (0, "page"): dict(Items=[self.item(21, 2)]),
+            (1, None): dict(Items=[self.item(21, 3)]),
+        }
+        self.dynamodb.Table.return_value.scan.side_effect = lambda **kwargs: pages[
+            (kwargs["Segment"], kwargs.get("ExclusiveStartKey"))
+        ]
+
+        with patch.object(export, "MAX_BUFFERED_ROWS", 2):
+            stats = QueryExport(self.query_dao, self.output, CSV, segments=2).run()
+
+        self.assertEqual(stats, dict(rows=4, files=3, days=2))
+        partitions = self.read_partitions()
+        self.assertEqual(list(partitions), ["start_date=2019-01-20", "start_date=2019-01-21"])
+        self.assertEqual(
+            sorted(row["query_execution_id"] for row in partitions["start_date=2019-01-21"]), ["21-1", "21-2", "21-3"]
+        )
+        row = partitions["start_date=2019-01-20"][0]
+        self.assertNotIn("start_date", row)
+        self.assertEqual(row["data_scanned"], "10")
+        self.assertEqual(row["query_sql"], "select 1")
+        self.assertEqual(row["query_sql_ref"], "")
+
+    def test_incremental_export_replaces_recent_days(self):
+        for day in ("2019-01-18", "2019-01-19", "2019-01-20"):
+            os.makedirs(os.path.join(self.output, f"start_date={day}"))
+            open(os.path.join(self.output, f"start_date={day}", "part-0-00000.csv.gz"), "w").close()
+
+        def query(KeyConditionExpression):
+            date_shard = KeyConditionExpression.get_expression()["values"][0].get_expression()["values"][1]
+            day = int(date_shard[len("2019-01-") : len("2019-01-") + 2])
+            return dict(Items=[self.item(day, 0)] if date_shard.endswith("#0") else [])
+
+        self.dynamodb.Table.return_value.query.side_effect = query
+
+        sut = QueryExport(self.query_dao, self.output, CSV, segments=2)
+        since = sut.incremental_since()
+        stats = sut.run(since, until="2019-01-21")
+
+        self.assertEqual(since, "2019-01-18")
+        self.assertEqual(stats, dict(rows=4, files=4, days=4))
+        self.assertEqual(self.dynamodb.Table.return_value.query.call_count, 8)
+        partitions = self.read_partitions()
+        self.assertEqual(partitions["start_date=2019-01-18"][0]["query_execution_id"], "18-0")
+        self.assertEqual(partitions["start_date=2019-01-21"][0]["query_execution_id"], "21-0")
+        self.dynamodb.Table.return_value.scan.assert_not_called()
+
+    def test_failed_export_keeps_previous_partitions(self):
+        for day in ("2019-01-20", "2019-01-21"):
+            os.makedirs(os.path.join(self.output, f"start_date={day}"))
+            open(os.path.join(self.output, f"start_date={day}", "part-0-00000.csv.gz"), "w").close()
+        pages = {
+            (0, None): dict(Items=[self.item(20, 0)]),
+            (1, None): RuntimeError("throttled"),
+        }
+
+        def scan(**kwargs):
+            page = pages[(kwargs["Segment"], kwargs.get("ExclusiveStartKey"))]
+            if isinstance(page, Exception):
+                raise page
+            return page
+
+        self.dynamodb.Table.return_value.scan.side_effect = scan
+
+        with self.assertRaises(RuntimeError):
+            QueryExport(self.query_dao, self.output, CSV, segments=2).run()
+
+        # neither day has been replaced and nothing staged is left behind
+        self.assertEqual(sorted(os.listdir(self.output)), ["start_date=2019-01-20", "start_date=2019-01-21"])
+        self.assertEqual(os.listdir(os.path.join(self.output, "start_date=2019-01-20")), ["part-0-00000.csv.gz"])
+        self.assertEqual(os.path.getsize(os.path.join(self.output, "start_date=2019-01-20", "part-0-00000.csv.gz")), 0)
+
+    @patch.object(export, "pyarrow")
+    def test_write_parquet_types_columns(self, pyarrow):
+        pyarrow.int64.return_value, pyarrow.bool_.return_value, pyarrow.string.return_value = "int64", "bool", "string"
+        pyarrow.schema.side_effect = lambda fields: [SimpleNamespace(name=name, type=type) for name, type in fields]
+        queries = [codec.from_item(dict(self.item(20, 0), auto_cancelled=True)), codec.from_item(self.item(20, 1))]
+        rows = [tuple(getattr(query, name) for name in export.COLUMNS) for query in queries]
+
+        export.write_parquet("part.parquet", rows)
+
+        types = dict(pyarrow.schema.call_args.args[0])
+        self.assertEqual(types["data_scanned"], "int64")
+        self.assertEqual(types["auto_cancelled"], "bool")
+        self.assertEqual(types["query_sql"], "string")
+        arrays = {call.kwargs["type"]: call.args[0] for call in pyarrow.array.call_args_list}
+        self.assertEqual(arrays["bool"], (True, None))
+        self.assertEqual(arrays["int64"], (10, 10))
+        self.assertEqual(len(pyarrow.array.call_args_list), len(export.COLUMNS))
+        pyarrow.parquet.write_table.assert_called_once_with(
+            pyarrow.Table.from_arrays.return_value, "part.parquet", compression="snappy"
+        )
+
+    @unittest.skipIf(export.pyarrow is None, "pyarrow is not installed")
+    def test_parquet_columns_are_typed(self):
+        cancelled = dict(self.item(20, 0), auto_cancelled=True)
+        self.dynamodb.Table.return_value.scan.return_value = dict(Items=[cancelled, self.item(20, 1)])
+
+        QueryExport(self.query_dao, self.output, PARQUET, segments=1).run()
+
+        table = export.pyarrow.parquet.read_table(
+            os.path.join(self.output, "start_date=2019-01-20", "part-0-00000.parquet")
+        )
+        self.assertEqual(str(table.schema.field("data_scanned").type), "int64")
+        self.assertEqual(str(table.schema.field("auto_cancelled").type), "bool")
+        self.assertEqual(table.column("auto_cancelled").to_pylist(), [True, None])
+
+    def test_incremental_export_without_previous_export_exports_everything(self):
+        self.assertIsNone(QueryExport(self.query_dao, self.output, CSV).incremental_since())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from bin.fingerprint import fingerprint, normalise
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def test_normalise(self):
+        sql = """
+            -- dashboard: daily revenue
+            SELECT country, sum(revenue) AS "Revenue" /* per day */
+            FROM   sales.orders
+            WHERE  dt = '2019-01-21' AND amount > 10.5 AND shop_id IN (1, 2, 3)
+            GROUP BY country;
+        """
+
+        self.assertEqual(
+            normalise(sql),
+            'select country,sum(revenue)as "revenue" from sales.orders '
+            "where dt=? and amount>? and shop_id in(?)group by country",
+        )
+
+    def test_literals_and_formatting_dont_change_fingerprint(self):
+        first = "SELECT * FROM t WHERE dt = '2019-01-21' AND id IN (1, 2) LIMIT 10"
+        second = "select *\nfrom t -- yesterday\nwhere dt='2019-01-20' and id in (7, 8, 9, 10) limit 100;"
+
+        self.assertEqual(fingerprint(first), fingerprint(second))
+        self.assertEqual(len(fingerprint(first)), 16)
+
+    def test_different_queries_have_different_fingerprints(self):
+        self.assertNotEqual(fingerprint("select a from t"), fingerprint("select b from t"))
+        self.assertNotEqual(fingerprint("select * from t1"), fingerprint("select * from t2"))
+
+    def test_comment_markers_in_literals_are_kept(self):
+        self.assertEqual(normalise("select '--x', \"a--b\" from t"), 'select ?,"a--b" from t')
+        self.assertEqual(normalise("select 'it''s' from t"), "select ? from t")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+from decimal import Decimal
+from unittest.mock import Mock
+
+from bin.fingerprint_stats_dao import FingerprintStats, FingerprintStatsDao
+from bin.model import AthenaQuery
+
+
+class FingerprintStatsDaoTest(unittest.TestCase):
+
+    @staticmethod
+    def get_sut(table_name="fingerprints"):
+        config = Mock()
+        config.FINGERPRINT_STATS_TABLE = table_name
+        dynamodb = Mock()
+        return FingerprintStatsDao(config, dynamodb), dynamodb
+
+    @staticmethod
+    def get_query(query_fingerprint="abc"):
+        return AthenaQuery(
+            start_date="2019-01-21",
+            start_timestamp="2019-01-21 09:34:13",
+            query_execution_id="1",
+            query_state="SUCCEEDED",
+            executing_user="test",
+            data_scanned=1024,
+            query_fingerprint=query_fingerprint,
+        )
+
+    def test_add_query(self):
+        sut, dynamodb = self.get_sut()
+
+        sut.add_query(self.get_query())
+
+        dynamodb.Table.assert_called_once_with("fingerprints")
+        dynamodb.Table.return_value.update_item.assert_called_once_with(
+            Key=dict(start_date="2019-01-21", query_fingerprint="abc"),
+            UpdateExpression="ADD query_count :one, data_scanned :data_scanned, executing_users :users "
+            "SET sample_query_execution_id = if_not_exists(sample_query_execution_id, :id), expires_at = :expires_at",
+            ExpressionAttributeValues={
+                ":one": 1,
+                ":data_scanned": 1024,
+                ":users": {"test"},
+                ":id": "1",
+                # 2019-01-21 00:00:00 UTC + 90 days
+                ":expires_at": 1548028800 + 90 * 24 * 3600,
+            },
+        )
+
+    def test_add_query_skipped_without_table_or_fingerprint(self):
+        sut, dynamodb = self.get_sut(table_name="")
+        sut.add_query(self.get_query())
+
+        sut, dynamodb = self.get_sut()
+        sut.add_query(self.get_query(query_fingerprint=None))
+
+        dynamodb.Table.return_value.update_item.assert_not_called()
+
+    def test_get_top_sums_days(self):
+        sut, dynamodb = self.get_sut()
+
+        def item(query_fingerprint, count, scanned, users):
+            return dict(
+                start_date="2019-01-21",
+                query_fingerprint=query_fingerprint,
+                query_count=Decimal(count),
+                data_scanned=Decimal(scanned),
+                executing_users=set(users),
+                sample_query_execution_id=query_fingerprint + "-id",
+            )
+
+        dynamodb.Table.return_value.query.side_effect = [
+            dict(Items=[item("a", 80, 100, ["dashboard"]), item("b", 1, 500, ["analyst"])], LastEvaluatedKey="b"),
+            dict(Items=[item("c", 2, 10, ["analyst"])]),
+            dict(Items=[item("a", 70, 450, ["dashboard", "analyst"])]),
+        ]
+
+        top = sut.get_top(["2019-01-21", "2019-01-20"], limit=2)
+
+        self.assertEqual(
+            top,
+            [
+                FingerprintStats("a", 150, 550, {"dashboard", "analyst"}, "a-id"),
+                FingerprintStats("b", 1, 500, {"analyst"}, "b-id"),
+            ],
+        )
+        self.assertEqual(dynamodb.Table.return_value.query.call_args_list[1].kwargs["ExclusiveStartKey"], "b")
+        self.assertEqual(top[0].cost(price_per_tb=5.0), 550 / 1024**4 * 5.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
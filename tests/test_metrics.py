@@ -0,0 +1,92 @@
+import json
+import unittest
+from io import StringIO
+from unittest.mock import patch
+
+from bin.metrics import NOOP_METRICS, EmbeddedMetrics, MetricDefinition
+
+OUTER = MetricDefinition("Outer", "Milliseconds")
+INNER = MetricDefinition("Inner", "Milliseconds")
+EVENTS = MetricDefinition("Events", "Count")
+
+
+class MetricsTest(unittest.TestCase):
+
+    @patch("bin.metrics.time")
+    def test_flush_writes_embedded_metric_format(self, time):
+        time.time.return_value = 1548083844.0
+        stream = StringIO()
+        sut = EmbeddedMetrics("athena_alerter", dict(Function="test"), stream=stream)
+
+        sut.record(OUTER, 1.5)
+        sut.record(OUTER, 2.5)
+        sut.count(EVENTS)
+        sut.count(EVENTS, 2)
+        sut.flush()
+
+        self.assertEqual(
+            json.loads(stream.getvalue()),
+            {
+                "_aws": {
+                    "Timestamp": 1548083844000,
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": "athena_alerter",
+                            "Dimensions": [["Function"]],
+                            "Metrics": [
+                                {"Name": "Outer", "Unit": "Milliseconds"},
+                                {"Name": "Events", "Unit": "Count"},
+                            ],
+                        }
+                    ],
+                },
+                "Function": "test",
+                "Outer": [1.5, 2.5],
+                "Events": [3],
+            },
+        )
+
+    def test_flush_splits_values_over_the_emf_limit(self):
+        stream = StringIO()
+        sut = EmbeddedMetrics("athena_alerter", dict(Function="test"), stream=stream)
+
+        for i in range(150):
+            sut.record(OUTER, i)
+        sut.flush()
+        sut.flush()
+
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([len(line["Outer"]) for line in lines], [100, 50])
+
+    @patch("bin.metrics.time")
+    def test_timers_report_exclusive_time(self, time):
+        time.perf_counter.side_effect = [0.0, 1.0, 1.5, 4.0]
+        sut = EmbeddedMetrics("athena_alerter", dict(Function="test"))
+
+        with sut.timer(OUTER):
+            with sut.timer(INNER):
+                pass
+
+        self.assertEqual(sut.values, {INNER: [500.0], OUTER: [3500.0]})
+
+    @patch("bin.metrics.time")
+    def test_timed_reports_total_time_of_an_iterable(self, time):
+        time.perf_counter.side_effect = [0.0, 1.0, 2.0, 4.0, 5.0, 5.5]
+        sut = EmbeddedMetrics("athena_alerter", dict(Function="test"))
+
+        self.assertEqual(list(sut.timed(OUTER, [1, 2])), [1, 2])
+        self.assertEqual(sut.values, {OUTER: [3500.0]})
+
+    def test_noop_metrics(self):
+        @NOOP_METRICS.timer(OUTER)
+        def decorated():
+            return "result"
+
+        self.assertEqual(decorated(), "result")
+        self.assertEqual(list(NOOP_METRICS.timed(INNER, "ab")), ["a", "b"])
+        NOOP_METRICS.count(EVENTS)
+        NOOP_METRICS.flush()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from bin.migrate_table import TableMigration
+from bin.query_dao import QueryDao
+
+
+class TableMigrationTest(unittest.TestCase):
+
+    @staticmethod
+    def source_item(second, query_state="SUCCEEDED"):
+        return dict(
+            start_date="2019-01-21",
+            start_timestamp=f"2019-01-21 09:34:{second:02}",
+            query_execution_id=str(second),
+            query_state=query_state,
+            executing_user="test",
+            data_scanned=10,
+        )
+
+    @patch("bin.query_dao.time")
+    def test_run_copies_all_segments(self, time):
+        # 2019-01-21 09:35:00 UTC, the running query is still polled
+        time.time.return_value = 1548063300
+        pages = {
+            (0, None): dict(Items=[self.source_item(0), self.source_item(1)], LastEvaluatedKey="page"),
+            (0, "page"): dict(Items=[dict(self.source_item(2, "RUNNING"), live_alerted=True, in_flight="1")]),
+            (1, None): dict(Items=[self.source_item(3)]),
+        }
+        dynamodb = Mock()
+        dynamodb.Table.return_value.scan.side_effect = lambda **kwargs: pages[
+            (kwargs["Segment"], kwargs.get("ExclusiveStartKey"))
+        ]
+        # the query 3 has already been written to the target by the lambdas
+        dynamodb.batch_get_item.side_effect = lambda RequestItems: dict(
+            Responses=dict(
+                target=[
+                    dict(key, query_execution_id="3")
+                    for key in RequestItems["target"]["Keys"]
+                    if key["query_key"].endswith("#3")
+                ]
+            )
+        )
+        dynamodb.batch_write_item.return_value = {}
+        query_dao = QueryDao(SimpleNamespace(QUERIES_TABLE="target", QUERIES_TABLE_SHARDS=4), dynamodb)
+
+        stats = TableMigration(dynamodb, "source", query_dao, segments=2).run()
+
+        self.assertEqual(stats, dict(scanned=4, copied=3))
+        dynamodb.Table.assert_called_with("source")
+        self.assertEqual(
+            {call.kwargs["TotalSegments"] for call in dynamodb.Table.return_value.scan.call_args_list}, {2}
+        )
+        items = [
+            request["PutRequest"]["Item"]
+            for call in dynamodb.batch_write_item.call_args_list
+            for request in call.kwargs["RequestItems"]["target"]
+        ]
+        self.assertEqual(sorted(item["query_execution_id"] for item in items), ["0", "1", "2"])
+        running = [item for item in items if "in_flight" in item]
+        self.assertEqual([item["query_execution_id"] for item in running], ["2"])
+        # the live alert has already been sent from the source table
+        self.assertTrue(running[0]["live_alerted"])
+        self.assertEqual(len([item for item in items if "live_alerted" in item]), 1)
+        self.assertTrue(all(item["query_key"].startswith(item["start_timestamp"]) for item in items))
+
+
+if __name__ == "__main__":
+    unittest.main()
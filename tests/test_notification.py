@@ -1,19 +1,24 @@
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import requests
 
+from bin import notification
+from bin.dedup import DedupStore
 from bin.notificators.hard_threshold_notificator import HardThresholdNotificator
+from bin.notificators.spend_window_notificator import SpendWindowNotificator
 
 
 class NotificationTest(unittest.TestCase):
 
     @staticmethod
-    def requests_side_effect(url, json, headers=None):
+    def requests_side_effect(url, json, headers=None, timeout=None):
         response_mock = Mock()
         response_mock.status_code = requests.codes.ok
         if url == "https://slack.com/api/conversations.open":
             response_mock.json.return_value = dict(channel=dict(id="test_channel"))
+        else:
+            response_mock.json.return_value = dict(ok=True)
 
         return response_mock
 
@@ -29,11 +34,93 @@ class NotificationTest(unittest.TestCase):
         config.SLACK_HARD_THRESHOLD_MESSAGE_ADDITIONAL_PRIVATE_MESSAGE = "text message private user"
         config.SLACK_WEBHOOK_URL = "url"
         config.SLACK_BOT_TOKEN = "token"
+        config.SLACK_CACHE_TABLE = None
         config.CLOUDWATCH_METRIC_NAMESPACE = "athena_alerter"
         config.CLOUDWATCH_METRIC_NAME = "athena_alerter_bytes_scanned_test"
         config.ATHENA_PRICE_PER_TB = 5.0
         return config
 
 
+class NotificationHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        notification._notificators = ()
+        DedupStore.clear()
+
+    @staticmethod
+    def sqs_record(message_id, body=None):
+        body = body or f'{{"query_execution_id": "{message_id}"}}'
+        return dict(messageId=message_id, body=body, eventSourceARN="arn:aws:sqs:us-east-1:123:athena-queries")
+
+    @staticmethod
+    def notificator_class(spec=HardThresholdNotificator):
+        notificator_class = Mock()
+        notificator_class.return_value = Mock(spec=spec)
+        notificator_class.return_value.event_id.side_effect = lambda body: body
+        return notificator_class
+
+    @patch("bin.notification.EmbeddedMetrics")
+    @patch("bin.notification.settings")
+    def test_lambda_handler_reports_failed_records(self, settings, metrics):
+        settings.DEDUP_TABLE = None
+        notificator_class = self.notificator_class()
+        notificator = notificator_class.return_value
+        notificator.is_record_type_handled.side_effect = lambda record: record["body"] != "unknown"
+        notificator.handle_single_event.side_effect = [None, ValueError("slack is down")]
+        settings.NOTIFICATORS = [notificator_class]
+        event = dict(Records=[self.sqs_record("1"), self.sqs_record("2"), self.sqs_record("3", "unknown")])
+
+        result = notification.lambda_handler(event, None)
+
+        self.assertEqual(result, dict(batchItemFailures=[dict(itemIdentifier="2"), dict(itemIdentifier="3")]))
+        metrics.return_value.flush.assert_called_once()
+
+    @patch("bin.notification.EmbeddedMetrics")
+    @patch("bin.notification.settings")
+    def test_lambda_handler_reuses_notificators(self, settings, metrics):
+        settings.DEDUP_TABLE = None
+        notificator_class = self.notificator_class()
+        settings.NOTIFICATORS = [notificator_class]
+
+        self.assertEqual(
+            notification.lambda_handler(dict(Records=[self.sqs_record("1")]), None), dict(batchItemFailures=[])
+        )
+        self.assertEqual(
+            notification.lambda_handler(dict(Records=[self.sqs_record("2")]), None), dict(batchItemFailures=[])
+        )
+
+        notificator_class.assert_called_once_with(config=settings, metrics=metrics.return_value)
+        self.assertEqual(notificator_class.return_value.handle_single_event.call_count, 2)
+
+    @patch("bin.notification.EmbeddedMetrics")
+    @patch("bin.notification.settings")
+    def test_lambda_handler_passes_records_to_all_notificators(self, settings, metrics):
+        settings.DEDUP_TABLE = None
+        first, second = self.notificator_class(), self.notificator_class(SpendWindowNotificator)
+        settings.NOTIFICATORS = [first, second]
+
+        notification.lambda_handler(dict(Records=[self.sqs_record("1", "{}")]), None)
+
+        first.return_value.handle_single_event.assert_called_once_with(body="{}")
+        second.return_value.handle_single_event.assert_called_once_with(body="{}")
+
+    @patch("bin.notification.EmbeddedMetrics")
+    @patch("bin.notification.settings")
+    def test_lambda_handler_drops_duplicated_events(self, settings, metrics):
+        settings.DEDUP_TABLE = None
+        first, second = self.notificator_class(), self.notificator_class(SpendWindowNotificator)
+        second.return_value.handle_single_event.side_effect = [ValueError("slack is down"), None]
+        settings.NOTIFICATORS = [first, second]
+        record = self.sqs_record("1")
+
+        # the same message delivered twice in a batch, then redelivered after the failure of the second notificator
+        result = notification.lambda_handler(dict(Records=[record, record]), None)
+        self.assertEqual(result, dict(batchItemFailures=[dict(itemIdentifier="1")]))
+        self.assertEqual(notification.lambda_handler(dict(Records=[record]), None), dict(batchItemFailures=[]))
+
+        first.return_value.handle_single_event.assert_called_once_with(body=record["body"])
+        self.assertEqual(second.return_value.handle_single_event.call_count, 2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from bin import poll_schedule
+from bin.model import AthenaQuery
+from bin.poll_schedule import first_check_at, next_check_at, start_time
+
+QUERY = AthenaQuery("2019-01-17", "2019-01-17 11:57:30", "1", "RUNNING", "test")
+
+
+class PollScheduleTest(unittest.TestCase):
+
+    def test_start_time(self):
+        self.assertEqual(start_time(QUERY), 1547726250)
+
+    def test_delay_grows_with_age(self):
+        start = start_time(QUERY)
+
+        self.assertEqual(next_check_at(QUERY, start + 10), start + 10 + poll_schedule.MIN_POLL_DELAY)
+        self.assertEqual(next_check_at(QUERY, start + 600), start + 600 + 300)
+        self.assertEqual(next_check_at(QUERY, start + 6 * 3600), start + 6 * 3600 + poll_schedule.MAX_POLL_DELAY)
+
+    def test_delay_is_capped_below_budget(self):
+        start = start_time(QUERY)
+        query = AthenaQuery("2019-01-17", "2019-01-17 11:57:30", "1", "RUNNING", "test", data_scanned=2 * 1024**4)
+
+        # running for 2 hours at 1 TB an hour, too slow to reach the budget within the capped delay
+        now = start + 2 * 3600
+        self.assertEqual(next_check_at(query, now, budget=100 * 1024**4), now + poll_schedule.BUDGET_POLL_DELAY)
+        # at 1 TB an hour reaching the budget 100 GB later in 6 minutes
+        self.assertEqual(next_check_at(query, now, budget=2.1 * 1024**4), now + 180)
+        # already over the budget
+        self.assertEqual(next_check_at(query, now, budget=1024**4), now + poll_schedule.MIN_POLL_DELAY)
+
+    def test_inserted_queries_are_due_immediately(self):
+        # inserted after a cloudtrail delivery delay of 10 minutes
+        now = start_time(QUERY) + 600
+
+        self.assertEqual(first_check_at(QUERY, now), now)
+
+    def test_old_queries_are_not_polled(self):
+        self.assertIsNone(first_check_at(QUERY, start_time(QUERY) + poll_schedule.MAX_POLL_AGE + 1))
+        self.assertIsNone(next_check_at(QUERY, start_time(QUERY) + poll_schedule.MAX_POLL_AGE + 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
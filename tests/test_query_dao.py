@@ -1,16 +1,22 @@
 import unittest
-from datetime import datetime, date
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
 from . import utils
-from bin.query_dao import QueryDao
-from bin.model import AthenaQuery
+from bin.query_dao import QueryDao, ShardedKeySchema
+from bin.model import AthenaQuery, UnprocessedItemsException
+
+# 2019-01-21 09:34:30 UTC
+NOW = 1548063270
 
 
 class QueryDaoTest(unittest.TestCase):
     def test_update_query(self):
         config = Mock()
         config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
 
         dynamodb = Mock()
 
@@ -30,18 +36,40 @@ class QueryDaoTest(unittest.TestCase):
         dynamodb.Table.return_value.update_item.assert_called_with(
             Key={"start_date": "2019-01-21", "start_timestamp": "2019-01-21 09:34:13"},
             UpdateExpression="set query_state = :query_state, data_scanned = :data_scanned, "
-            "executing_user = :executing_user, query_sql = :query_sql",
+            "executing_user = :executing_user, query_sql = :query_sql, "
+            "query_sql_ref = :query_sql_ref, query_sql_hash = :query_sql_hash, "
+            "query_fingerprint = :query_fingerprint remove in_flight, next_check_at",
             ExpressionAttributeValues={
                 ":query_state": "SUCCEEDED",
                 ":executing_user": "test",
                 ":data_scanned": 29944425990,
                 ":query_sql": "select * from foo.bar",
+                ":query_sql_ref": None,
+                ":query_sql_hash": None,
+                ":query_fingerprint": None,
+                ":queued": "QUEUED",
+                ":running": "RUNNING",
             },
+            ConditionExpression="query_state IN (:queued, :running)",
         )
 
+    def test_update_query_skips_finalised_queries(self):
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+        dynamodb = Mock()
+        error = ClientError(dict(Error=dict(Code="ConditionalCheckFailedException")), "UpdateItem")
+        dynamodb.Table.return_value.update_item.side_effect = error
+
+        sut = QueryDao(config, dynamodb)
+        query = AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "1", "SUCCEEDED", "test", 29944425990)
+
+        self.assertFalse(sut.update_query(query))
+
     def test_insert_query(self):
         config = Mock()
         config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
 
         dynamodb = Mock()
 
@@ -67,32 +95,313 @@ class QueryDaoTest(unittest.TestCase):
                 query_state="SUCCEEDED",
                 executing_user="test",
                 data_scanned=29944425990,
+            ),
+            ConditionExpression="attribute_not_exists(query_execution_id) OR query_execution_id <> :id",
+            ExpressionAttributeValues={":id": "1"},
+        )
+
+    def test_insert_query_skips_existing_query(self):
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+        dynamodb = Mock()
+        error = ClientError(dict(Error=dict(Code="ConditionalCheckFailedException")), "PutItem")
+        dynamodb.Table.return_value.put_item.side_effect = error
+
+        sut = QueryDao(config, dynamodb)
+
+        self.assertFalse(sut.insert_query(AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "1", "RUNNING", "test")))
+
+    @patch("bin.query_dao.time")
+    @patch("bin.retry.time")
+    def test_insert_queries(self, time, dao_time):
+        dao_time.time.return_value = NOW
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+
+        dynamodb = Mock()
+        unprocessed = dict(PutRequest=dict(Item=dict(start_date="2019-01-21", start_timestamp="2019-01-21 09:34:29")))
+        dynamodb.batch_write_item.side_effect = [
+            dict(UnprocessedItems=dict(test_table=[unprocessed])),
+            dict(UnprocessedItems={}),
+            dict(),
+        ]
+
+        queries = [
+            AthenaQuery(
+                start_date="2019-01-21",
+                start_timestamp=f"2019-01-21 09:34:{second:02}",
+                query_execution_id=str(second),
+                query_state="RUNNING",
+                executing_user="test",
             )
+            for second in range(30)
+        ]
+
+        sut = QueryDao(config, dynamodb)
+        sut.insert_queries(queries)
+
+        calls = dynamodb.batch_write_item.call_args_list
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(calls[0][1]["RequestItems"]["test_table"]), 25)
+        self.assertEqual(calls[1][1]["RequestItems"]["test_table"], [unprocessed])
+        self.assertEqual(len(calls[2][1]["RequestItems"]["test_table"]), 5)
+        self.assertEqual(
+            calls[0][1]["RequestItems"]["test_table"][0],
+            dict(
+                PutRequest=dict(
+                    Item=dict(
+                        start_date="2019-01-21",
+                        start_timestamp="2019-01-21 09:34:00",
+                        query_execution_id="0",
+                        query_state="RUNNING",
+                        executing_user="test",
+                        data_scanned=0,
+                        in_flight="1",
+                        # due on the next usage update run
+                        next_check_at=NOW,
+                    )
+                )
+            ),
         )
+        time.sleep.assert_called_once()
 
-    def test_get_running_queries(self):
+    @patch("bin.retry.time")
+    def test_insert_queries_gives_up_on_unprocessed_items(self, time):
         config = Mock()
         config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
 
         dynamodb = Mock()
-        dynamodb.Table.return_value.query.return_value = utils.get_json_content(
-            "fixtures/query_dao_dynamodb_queries.json"
+        dynamodb.batch_write_item.side_effect = lambda RequestItems: dict(UnprocessedItems=RequestItems)
+
+        sut = QueryDao(config, dynamodb)
+        with self.assertRaises(UnprocessedItemsException):
+            sut.insert_queries(
+                [AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "1", "RUNNING", "test")],
+            )
+
+    def test_insert_queries_skips_existing(self):
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+
+        dynamodb = Mock()
+        existing = [
+            dict(start_date="2019-01-21", start_timestamp="2019-01-21 09:34:13", query_execution_id="1"),
+            # another query started in the same second
+            dict(start_date="2019-01-21", start_timestamp="2019-01-21 09:34:15", query_execution_id="other"),
+        ]
+        dynamodb.batch_get_item.return_value = dict(Responses=dict(test_table=existing))
+        dynamodb.batch_write_item.return_value = dict(UnprocessedItems={})
+
+        sut = QueryDao(config, dynamodb)
+        written = sut.insert_queries(
+            [
+                AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "1", "RUNNING", "test"),
+                AthenaQuery("2019-01-21", "2019-01-21 09:34:14", "2", "RUNNING", "test"),
+                AthenaQuery("2019-01-21", "2019-01-21 09:34:15", "3", "RUNNING", "test"),
+            ],
+            skip_existing=True,
         )
 
+        self.assertEqual(written, 2)
+        request = dynamodb.batch_get_item.call_args.kwargs["RequestItems"]["test_table"]
+        self.assertEqual(len(request["Keys"]), 3)
+        self.assertEqual(request["ProjectionExpression"], "start_date, start_timestamp, query_execution_id")
+        items = dynamodb.batch_write_item.call_args.kwargs["RequestItems"]["test_table"]
+        self.assertEqual([item["PutRequest"]["Item"]["query_execution_id"] for item in items], ["2"])
+        put = dynamodb.Table.return_value.put_item.call_args.kwargs
+        self.assertEqual(put["Item"]["query_execution_id"], "3")
+        self.assertEqual(put["ExpressionAttributeValues"], {":id": "3"})
+
+    def test_new_queries(self):
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+
+        dynamodb = Mock()
+        existing = [
+            dict(start_date="2019-01-21", start_timestamp="2019-01-21 09:34:13", query_execution_id="1"),
+            dict(start_date="2019-01-21", start_timestamp="2019-01-21 09:34:15", query_execution_id="other"),
+        ]
+        dynamodb.batch_get_item.return_value = dict(Responses=dict(test_table=existing))
+
         sut = QueryDao(config, dynamodb)
-        queries = sut.get_running_queries(
-            partition_timestamp=date(2019, 1, 21), start_timestamp=datetime(2019, 1, 21, 9, 34, 13)
+        queries = sut.new_queries(
+            [
+                AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "1", "RUNNING", "test"),
+                AthenaQuery("2019-01-21", "2019-01-21 09:34:14", "2", "RUNNING", "test"),
+                AthenaQuery("2019-01-21", "2019-01-21 09:34:15", "3", "RUNNING", "test"),
+            ]
         )
 
-        self.assertEqual(len(queries), 1)
-        query = queries[0]
-        self.assertEqual(query.start_date, "2019-01-21")
+        self.assertEqual([query.query_execution_id for query in queries], ["2", "3"])
+        dynamodb.batch_write_item.assert_not_called()
+
+    def test_get_query(self):
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+
+        dynamodb = Mock()
+        dynamodb.Table.return_value.query.side_effect = [
+            utils.get_json_content("fixtures/query_dao_dynamodb_queries.json"),
+            dict(Items=[]),
+        ]
+
+        sut = QueryDao(config, dynamodb)
+        query = sut.get_query("6acb55b1-fddd-4608-bef8-ed206e1262de")
+
         self.assertEqual(query.start_timestamp, "2019-01-21 09:34:13")
-        self.assertEqual(query.query_execution_id, "6acb55b1-fddd-4608-bef8-ed206e1262de")
-        self.assertEqual(query.query_state, "RUNNING")
-        self.assertEqual(query.executing_user, "test")
-        self.assertEqual(query.data_scanned, 0)
-        self.assertEqual(query.query_sql, "")
+        self.assertEqual(dynamodb.Table.return_value.query.call_args[1]["IndexName"], "query_execution_id_index")
+        self.assertIsNone(sut.get_query("unknown"))
+
+    def test_get_due_queries(self):
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+
+        item = utils.get_json_content("fixtures/query_dao_dynamodb_queries.json")["Items"][0]
+        item["in_flight"] = "1"
+        dynamodb = Mock()
+        dynamodb.Table.return_value.query.side_effect = [
+            dict(Items=[item], LastEvaluatedKey=dict(start_date="2019-01-21")),
+            dict(Items=[dict(item, query_execution_id="2")]),
+        ]
+
+        sut = QueryDao(config, dynamodb)
+        queries = sut.get_due_queries(NOW)
+
+        self.assertEqual([query.query_execution_id for query in queries], [item["query_execution_id"], "2"])
+        calls = dynamodb.Table.return_value.query.call_args_list
+        self.assertEqual(calls[0][1]["IndexName"], "in_flight_next_check_index")
+        self.assertEqual(
+            calls[0][1]["KeyConditionExpression"], Key("in_flight").eq("1") & Key("next_check_at").lte(NOW)
+        )
+        self.assertNotIn("ExclusiveStartKey", calls[0][1])
+        self.assertEqual(calls[1][1]["ExclusiveStartKey"], dict(start_date="2019-01-21"))
+
+    @patch("bin.query_dao.time")
+    def test_insert_queries_with_sharded_keys(self, time):
+        time.time.return_value = NOW
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = 4
+
+        dynamodb = Mock()
+        dynamodb.batch_write_item.return_value = dict(UnprocessedItems={})
+
+        sut = QueryDao(config, dynamodb)
+        # queries started in the same second don't overwrite each other
+        written = sut.insert_queries(
+            [
+                AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "1", "RUNNING", "test"),
+                AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "2", "RUNNING", "test"),
+            ]
+        )
+
+        self.assertEqual(written, 2)
+        items = [
+            request["PutRequest"]["Item"]
+            for request in dynamodb.batch_write_item.call_args.kwargs["RequestItems"]["test_table"]
+        ]
+        shard = ShardedKeySchema(4).shard("1")
+        self.assertEqual(items[0]["date_shard"], f"2019-01-21#{shard}")
+        self.assertEqual(items[0]["query_key"], "2019-01-21 09:34:13#1")
+        self.assertEqual(items[0]["in_flight"], str(shard))
+        self.assertEqual(items[1]["query_key"], "2019-01-21 09:34:13#2")
+
+    def test_sharded_keys_spread_queries(self):
+        schema = ShardedKeySchema(8)
+
+        shards = {schema.shard(f"6acb55b1-fddd-4608-bef8-{i:012}") for i in range(200)}
+
+        self.assertEqual(shards, set(range(8)))
+        self.assertEqual(schema.shard("1"), schema.shard("1"))
+
+    def test_get_due_queries_reads_all_shards(self):
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = 4
+
+        item = utils.get_json_content("fixtures/query_dao_dynamodb_queries.json")["Items"][0]
+        dynamodb = Mock()
+        dynamodb.Table.return_value.query.side_effect = lambda **kwargs: dict(Items=[item])
+
+        sut = QueryDao(config, dynamodb)
+        queries = sut.get_due_queries(NOW)
+
+        self.assertEqual(len(queries), 4)
+        calls = dynamodb.Table.return_value.query.call_args_list
+        self.assertEqual(len(calls), 4)
+        partitions = {
+            call.kwargs["KeyConditionExpression"].get_expression()["values"][0].get_expression()["values"][1]
+            for call in calls
+        }
+        self.assertEqual(partitions, {"0", "1", "2", "3"})
+
+    @patch("bin.query_dao.time")
+    def test_old_queries_are_not_scheduled(self, time):
+        time.time.return_value = NOW
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+        dynamodb = Mock()
+        dynamodb.batch_write_item.return_value = dict(UnprocessedItems={})
+
+        sut = QueryDao(config, dynamodb)
+        sut.insert_queries([AthenaQuery("2019-01-01", "2019-01-01 09:34:13", "1", "RUNNING", "test")])
+
+        item = dynamodb.batch_write_item.call_args.kwargs["RequestItems"]["test_table"][0]["PutRequest"]["Item"]
+        self.assertNotIn("in_flight", item)
+        self.assertNotIn("next_check_at", item)
+
+    def test_schedule_check(self):
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+        dynamodb = Mock()
+        query = AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "1", "RUNNING", "test")
+
+        query.data_scanned = 1024
+        sut = QueryDao(config, dynamodb)
+        sut.schedule_check(query, NOW + 60)
+        sut.schedule_check(query, None)
+
+        update_item = dynamodb.Table.return_value.update_item
+        self.assertEqual(
+            update_item.call_args_list[0].kwargs,
+            dict(
+                Key=dict(start_date="2019-01-21", start_timestamp="2019-01-21 09:34:13"),
+                UpdateExpression="set data_scanned = :data_scanned, next_check_at = :next_check_at",
+                ExpressionAttributeValues={":data_scanned": 1024, ":next_check_at": NOW + 60},
+                ConditionExpression="attribute_exists(in_flight)",
+            ),
+        )
+        self.assertEqual(
+            update_item.call_args_list[1].kwargs["UpdateExpression"],
+            "set data_scanned = :data_scanned remove in_flight, next_check_at",
+        )
+
+    def test_mark_live_alerted_once(self):
+        config = Mock()
+        config.QUERIES_TABLE = "test_table"
+        config.QUERIES_TABLE_SHARDS = None
+        dynamodb = Mock()
+        error = ClientError(dict(Error=dict(Code="ConditionalCheckFailedException")), "UpdateItem")
+        dynamodb.Table.return_value.update_item.side_effect = [None, error]
+        query = AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "1", "RUNNING", "test")
+
+        sut = QueryDao(config, dynamodb)
+
+        self.assertTrue(sut.mark_live_alerted(query))
+        self.assertFalse(sut.mark_live_alerted(query))
+        self.assertEqual(
+            dynamodb.Table.return_value.update_item.call_args.kwargs["ConditionExpression"],
+            "attribute_exists(in_flight) AND attribute_not_exists(live_alerted)",
+        )
 
 
 if __name__ == "__main__":
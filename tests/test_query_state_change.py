@@ -0,0 +1,144 @@
+import json
+import unittest
+from unittest.mock import Mock
+
+from . import utils
+from bin.dedup import DedupStore, finished_key
+from bin.fingerprint import fingerprint
+from bin.model import AthenaQuery
+from bin.query_state_change import QueryStateChangeHandler
+from bin.usage_update import UsageUpdater
+
+
+class QueryStateChangeHandlerTest(unittest.TestCase):
+
+    @staticmethod
+    def get_running_query():
+        return AthenaQuery(
+            start_date="2019-01-17",
+            start_timestamp="2019-01-17 11:57:30",
+            query_execution_id="6acb55b1-fddd-4608-bef8-ed206e1262de",
+            query_state="RUNNING",
+            executing_user="testUser",
+        )
+
+    def setUp(self):
+        DedupStore.clear()
+
+    def get_sut(self, query_dao, athena, sqs, dedup=None):
+        config = Mock()
+        config.SQS_QUEUE_URL = "url"
+        config.USER_MAPPING_FUNCTION = lambda user: None
+        config.DEDUP_TABLE = None
+        updater = UsageUpdater(config, query_dao, athena, sqs)
+        return QueryStateChangeHandler(query_dao, updater, dedup or DedupStore(config))
+
+    def test_process_event_finalises_query(self):
+        event = utils.get_json_content("fixtures/athena_query_state_change_event.json")
+
+        query_dao = Mock()
+        query_dao.get_query.return_value = self.get_running_query()
+        athena = Mock()
+        athena.batch_get_query_execution.return_value = utils.get_json_content(
+            "fixtures/usage_update_athena_queries.json"
+        )
+        sqs = Mock()
+        sqs.send_message_batch.return_value = {}
+
+        self.get_sut(query_dao, athena, sqs).process_event(event)
+
+        query_dao.get_query.assert_called_once_with("6acb55b1-fddd-4608-bef8-ed206e1262de")
+        athena.batch_get_query_execution.assert_called_once_with(
+            QueryExecutionIds=["6acb55b1-fddd-4608-bef8-ed206e1262de"]
+        )
+        query_dao.update_query.assert_called_once_with(
+            AthenaQuery(
+                start_date="2019-01-17",
+                start_timestamp="2019-01-17 11:57:30",
+                query_execution_id="6acb55b1-fddd-4608-bef8-ed206e1262de",
+                query_state="SUCCEEDED",
+                executing_user="testUser",
+                data_scanned=29944425990,
+                query_sql="select * from foo.bar",
+                query_fingerprint=fingerprint("select * from foo.bar"),
+            )
+        )
+        entries = sqs.send_message_batch.call_args[1]["Entries"]
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(json.loads(entries[0]["MessageBody"])["query_state"], "SUCCEEDED")
+
+    def test_process_event_ignores_non_terminal_states(self):
+        event = utils.get_json_content("fixtures/athena_query_state_change_event.json")
+        event["detail"]["currentState"] = "RUNNING"
+        query_dao = Mock()
+
+        self.get_sut(query_dao, Mock(), Mock()).process_event(event)
+
+        query_dao.get_query.assert_not_called()
+
+    def test_process_event_ignores_unknown_and_finalised_queries(self):
+        event = utils.get_json_content("fixtures/athena_query_state_change_event.json")
+        finalised_query = self.get_running_query()
+        finalised_query.query_state = "SUCCEEDED"
+
+        for query in (None, finalised_query):
+            query_dao = Mock()
+            query_dao.get_query.return_value = query
+            athena = Mock()
+            sqs = Mock()
+
+            self.get_sut(query_dao, athena, sqs).process_event(event)
+
+            athena.batch_get_query_execution.assert_not_called()
+            query_dao.update_query.assert_not_called()
+            sqs.send_message_batch.assert_not_called()
+
+    def test_process_event_skips_event_of_query_finalised_concurrently(self):
+        event = utils.get_json_content("fixtures/athena_query_state_change_event.json")
+        query_dao = Mock()
+        query_dao.get_query.return_value = self.get_running_query()
+        # finalised by the reconciliation sweep after it has been read here
+        query_dao.update_query.return_value = False
+        athena = Mock()
+        athena.batch_get_query_execution.return_value = utils.get_json_content(
+            "fixtures/usage_update_athena_queries.json"
+        )
+        sqs = Mock()
+
+        self.get_sut(query_dao, athena, sqs).process_event(event)
+
+        query_dao.update_query.assert_called_once()
+        sqs.send_message_batch.assert_not_called()
+
+    def test_process_event_marks_queries_not_inserted_yet(self):
+        event = utils.get_json_content("fixtures/athena_query_state_change_event.json")
+        query_dao = Mock()
+        query_dao.get_query.return_value = None
+        dedup = Mock()
+
+        self.get_sut(query_dao, Mock(), Mock(), dedup).process_event(event)
+
+        dedup.mark.assert_called_once_with(finished_key("6acb55b1-fddd-4608-bef8-ed206e1262de"))
+        # looked up again in case it has been inserted before the marker was there
+        self.assertEqual(query_dao.get_query.call_count, 2)
+
+    def test_finalise_queries_finalises_marked_queries_once_inserted(self):
+        query_dao = Mock()
+        athena = Mock()
+        athena.batch_get_query_execution.return_value = utils.get_json_content(
+            "fixtures/usage_update_athena_queries.json"
+        )
+        sqs = Mock()
+        sqs.send_message_batch.return_value = {}
+        dedup = DedupStore(Mock(DEDUP_TABLE=None))
+        dedup.mark(finished_key("6acb55b1-fddd-4608-bef8-ed206e1262de"))
+
+        self.get_sut(query_dao, athena, sqs, dedup).finalise_queries([self.get_running_query()])
+
+        self.assertEqual(query_dao.update_query.call_args[0][0].query_state, "SUCCEEDED")
+        self.assertEqual(sqs.send_message_batch.call_count, 1)
+        self.assertEqual(dedup.marked([finished_key("6acb55b1-fddd-4608-bef8-ed206e1262de")]), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from unittest.mock import Mock
+
+from botocore.exceptions import ClientError
+
+from bin.spend_window_dao import SpendWindowDao, WindowSpend
+
+
+class SpendWindowDaoTest(unittest.TestCase):
+
+    @staticmethod
+    def get_sut():
+        config = Mock()
+        config.SPEND_WINDOWS_TABLE = "spend"
+        dynamodb = Mock()
+        return SpendWindowDao(config, dynamodb), dynamodb
+
+    def test_add_spend(self):
+        sut, dynamodb = self.get_sut()
+        dynamodb.batch_get_item.return_value = dict(
+            Responses=dict(
+                spend=[
+                    dict(bucket="3600#7200", data_scanned=150),
+                    dict(bucket="86400#0", data_scanned=400),
+                    dict(bucket="3600#3600", data_scanned=80),
+                ]
+            )
+        )
+
+        spends = sut.add_spend("test", "1", 50, [3600, 86400], now=7300)
+
+        self.assertEqual(
+            spends,
+            [
+                WindowSpend(length=3600, bucket_start=7200, current=150, previous=80, added=50),
+                WindowSpend(length=86400, bucket_start=0, current=400, previous=0, added=50),
+            ],
+        )
+        items = dynamodb.meta.client.transact_write_items.call_args.kwargs["TransactItems"]
+        self.assertEqual(len(items), 3)
+        self.assertEqual(
+            items[0]["Put"]["Item"],
+            dict(user=dict(S="test"), bucket=dict(S="query#1"), expires_at=dict(N=str(7300 + 2 * 86400 + 3600))),
+        )
+        self.assertEqual(items[0]["Put"]["ConditionExpression"], "attribute_not_exists(#bucket)")
+        self.assertEqual(
+            items[1]["Update"],
+            dict(
+                TableName="spend",
+                Key=dict(user=dict(S="test"), bucket=dict(S="3600#7200")),
+                UpdateExpression="ADD data_scanned :data_scanned, query_count :one SET expires_at = :expires_at",
+                ExpressionAttributeValues={
+                    ":data_scanned": dict(N="50"),
+                    ":one": dict(N="1"),
+                    ":expires_at": dict(N=str(7200 + 7200 + 3600)),
+                },
+            ),
+        )
+        request = dynamodb.batch_get_item.call_args.kwargs["RequestItems"]["spend"]
+        self.assertTrue(request["ConsistentRead"])
+        self.assertEqual(
+            [key["bucket"] for key in request["Keys"]], ["3600#7200", "86400#0", "3600#3600", "86400#-86400"]
+        )
+
+    def test_add_spend_of_redelivered_query_only_reads_buckets(self):
+        sut, dynamodb = self.get_sut()
+        dynamodb.meta.client.transact_write_items.side_effect = ClientError(
+            dict(
+                Error=dict(Code="TransactionCanceledException", Message="Transaction cancelled"),
+                CancellationReasons=[dict(Code="ConditionalCheckFailed"), dict(Code="None"), dict(Code="None")],
+            ),
+            "TransactWriteItems",
+        )
+        dynamodb.batch_get_item.return_value = dict(Responses=dict(spend=[dict(bucket="3600#7200", data_scanned=150)]))
+
+        spends = sut.add_spend("test", "1", 50, [3600], now=7300)
+
+        self.assertEqual(spends, [WindowSpend(length=3600, bucket_start=7200, current=150, previous=0, added=50)])
+
+    def test_add_spend_raises_other_transaction_errors(self):
+        sut, dynamodb = self.get_sut()
+        dynamodb.meta.client.transact_write_items.side_effect = ClientError(
+            dict(
+                Error=dict(
+                    Code="TransactionCanceledException",
+                    Message="Transaction cancelled, please refer cancellation reasons for specific reasons "
+                    "[None, TransactionConflict]",
+                )
+            ),
+            "TransactWriteItems",
+        )
+
+        with self.assertRaises(ClientError):
+            sut.add_spend("test", "1", 50, [3600], now=7300)
+
+    def test_estimate_weights_previous_bucket(self):
+        spend = WindowSpend(length=3600, bucket_start=7200, current=100, previous=400, added=100)
+
+        self.assertEqual(spend.estimate(7200), 500)
+        self.assertEqual(spend.estimate(8100), 400)
+        self.assertEqual(spend.estimate_before(8100), 300)
+        self.assertEqual(spend.estimate(10800), 100)
+
+    def test_mark_alerted_once(self):
+        sut, dynamodb = self.get_sut()
+        spend = WindowSpend(length=3600, bucket_start=7200, current=100, previous=0, added=100)
+        error = ClientError(dict(Error=dict(Code="ConditionalCheckFailedException")), "UpdateItem")
+        dynamodb.Table.return_value.update_item.side_effect = [None, error]
+
+        self.assertTrue(sut.mark_alerted("test", spend))
+        self.assertFalse(sut.mark_alerted("test", spend))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import gzip
+import unittest
+from collections import Counter
+from unittest.mock import Mock
+
+from benchmarks.fakes import FakeS3
+from bin import codec
+from bin.model import AthenaQuery, SqlIntegrityException
+from bin.sql_store import SqlStore, sql_hash
+
+LONG_SQL = "SELECT " + ", ".join(f"column_{i}" for i in range(2000)) + " FROM foo.bar"
+
+
+class SqlStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        SqlStore.clear()
+        self.calls = Counter()
+        self.s3 = FakeS3(self.calls)
+
+    def get_sut(self, bucket="sql-bucket"):
+        config = Mock()
+        config.QUERY_SQL_BUCKET = bucket
+        config.QUERY_SQL_INLINE_LIMIT = 1024
+        return SqlStore(config, self.s3)
+
+    @staticmethod
+    def query(sql):
+        return AthenaQuery("2019-01-21", "2019-01-21 09:34:13", "1", "SUCCEEDED", "test", 10, sql)
+
+    def test_short_texts_stay_inline(self):
+        query = self.query("select 1")
+
+        self.get_sut().offload(query)
+
+        self.assertEqual(query.query_sql, "select 1")
+        self.assertIsNone(query.query_sql_ref)
+        self.assertEqual(self.calls, Counter())
+
+    def test_long_texts_are_offloaded_and_fetched_lazily(self):
+        query = self.query(LONG_SQL)
+
+        self.get_sut().offload(query)
+
+        digest = sql_hash(LONG_SQL)
+        self.assertIsNone(query.query_sql)
+        self.assertEqual(query.query_sql_hash, digest)
+        self.assertEqual(query.query_sql_ref, f"s3://sql-bucket/query_sql/{digest}.sql.gz")
+        stored = self.s3.objects[("sql-bucket", f"query_sql/{digest}.sql.gz")]
+        self.assertLess(len(stored), len(LONG_SQL) / 4)
+        self.assertLess(len(codec.to_body(query)), 1024)
+
+        # a consumer in another container reads the query from a message body
+        SqlStore.clear()
+        received = codec.from_body(codec.to_body(query))
+        sut = self.get_sut()
+        self.assertEqual(sut.get_sql(received), LONG_SQL)
+        self.assertEqual(sut.get_sql(received), LONG_SQL)
+        self.assertEqual(self.calls["s3.GetObject"], 1)
+
+    def test_texts_are_stored_once_per_container(self):
+        sut = self.get_sut()
+
+        for _ in range(3):
+            sut.offload(self.query(LONG_SQL))
+
+        self.assertEqual(self.calls["s3.PutObject"], 1)
+
+    def test_nothing_is_offloaded_without_bucket(self):
+        query = self.query(LONG_SQL)
+
+        self.get_sut(bucket=None).offload(query)
+
+        self.assertEqual(query.query_sql, LONG_SQL)
+        self.assertEqual(self.get_sut(bucket=None).get_sql(query), LONG_SQL)
+
+    def test_get_sql_verifies_hash(self):
+        query = self.query(LONG_SQL)
+        self.get_sut().offload(query)
+        SqlStore.clear()
+        self.s3.put("sql-bucket", query.query_sql_ref.split("/", 3)[3], gzip.compress(b"select 2"))
+
+        with self.assertRaises(SqlIntegrityException):
+            self.get_sut().get_sql(query)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from unittest.mock import Mock, patch
+
+from bin.model import MessagesNotSentException
+from bin.sqs_publisher import SqsBatchPublisher
+
+
+class SqsBatchPublisherTest(unittest.TestCase):
+
+    def test_publish_in_batches(self):
+        sqs = Mock()
+        sqs.send_message_batch.return_value = {}
+
+        with SqsBatchPublisher(sqs, "url") as sut:
+            for i in range(12):
+                sut.publish(f"message {i}")
+            # a message which would exceed the batch size limit starts a new batch
+            sut.publish("x" * (256 * 1024 - 10))
+
+        calls = sqs.send_message_batch.call_args_list
+        self.assertEqual([len(call[1]["Entries"]) for call in calls], [10, 2, 1])
+        self.assertEqual(calls[0][1]["Entries"][0], dict(Id="0", MessageBody="message 0"))
+        self.assertEqual(calls[1][1]["Entries"][1], dict(Id="1", MessageBody="message 11"))
+
+    @patch("bin.retry.time")
+    def test_flush_retries_failed_entries_only(self, time):
+        sqs = Mock()
+        sqs.send_message_batch.side_effect = [
+            dict(Failed=[dict(Id="1", SenderFault=False, Code="InternalError")]),
+            dict(Successful=[dict(Id="1")]),
+        ]
+
+        sut = SqsBatchPublisher(sqs, "url")
+        sut.publish("first")
+        sut.publish("second")
+        sut.flush()
+
+        sqs.send_message_batch.assert_called_with(QueueUrl="url", Entries=[dict(Id="1", MessageBody="second")])
+        self.assertEqual(sqs.send_message_batch.call_count, 2)
+
+    def test_flush_raises_on_sender_fault(self):
+        sqs = Mock()
+        sqs.send_message_batch.return_value = dict(Failed=[dict(Id="0", SenderFault=True, Code="InvalidMessage")])
+
+        sut = SqsBatchPublisher(sqs, "url")
+        sut.publish("first")
+
+        with self.assertRaises(MessagesNotSentException):
+            sut.flush()
+
+    def test_flush_without_messages(self):
+        sqs = Mock()
+
+        SqsBatchPublisher(sqs, "url").flush()
+
+        sqs.send_message_batch.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,18 @@
+import json
 import unittest
-from datetime import datetime, date
 from unittest.mock import Mock, patch
 
+from botocore.exceptions import ClientError
+
 from . import utils
 from bin.usage_update import UsageUpdater
+from bin.fingerprint import fingerprint
 from bin.model import AthenaQuery
 
 
 def mocked_get_now():
-    return datetime(2019, 1, 1, 0, 10, 10)
+    # 2019-01-17 12:07:31 UTC
+    return 1547726851
 
 
 class UsageUpdaterTest(unittest.TestCase):
@@ -21,9 +25,11 @@ class UsageUpdaterTest(unittest.TestCase):
         config.QUERIES_TABLE = "test_table"
         config.SQS_QUEUE_URL = "url"
         config.USER_MAPPING_FUNCTION = lambda user: None
+        config.LIVE_ALERT_DATA_THRESHOLD = None
+        config.AUTO_CANCEL_DATA_THRESHOLD = None
 
         query_dao = Mock()
-        query_dao.get_running_queries.return_value = [
+        query_dao.get_due_queries.return_value = [
             AthenaQuery(
                 start_date="2019-01-17",
                 start_timestamp="2019-01-17 11:57:30",
@@ -32,22 +38,36 @@ class UsageUpdaterTest(unittest.TestCase):
                 executing_user="testUser",
                 data_scanned=0,
                 query_sql="",
-            )
+            ),
+            AthenaQuery(
+                start_date="2019-01-17",
+                start_timestamp="2019-01-17 11:57:31",
+                query_execution_id="0e4a3f23-1c1e-4f7d-a0a0-1ad36ea9f5a2",
+                query_state="RUNNING",
+                executing_user="testUser",
+                data_scanned=0,
+                query_sql="",
+            ),
         ]
 
         athena = Mock()
-        athena.get_query_execution.return_value = utils.get_json_content("fixtures/usage_update_athena_queries.json")
+        athena.batch_get_query_execution.return_value = utils.get_json_content(
+            "fixtures/usage_update_athena_queries.json"
+        )
 
         sqs = Mock()
+        sqs.send_message_batch.return_value = {}
+        cloudwatch_metrics = Mock()
 
-        sut = UsageUpdater(config, query_dao, athena, sqs)
+        sut = UsageUpdater(config, query_dao, athena, sqs, cloudwatch_metrics=cloudwatch_metrics)
         sut.update_query_usage()
 
-        athena.get_query_execution.assert_called_with(QueryExecutionId=query_execution_id)
+        athena.batch_get_query_execution.assert_called_once_with(
+            QueryExecutionIds=[query_execution_id, "0e4a3f23-1c1e-4f7d-a0a0-1ad36ea9f5a2"]
+        )
 
-        query_dao.get_running_queries.assert_any_call(date(2019, 1, 1), datetime(2018, 12, 31, 23, 10, 10))
-        query_dao.get_running_queries.assert_any_call(date(2018, 12, 31), datetime(2018, 12, 31, 23, 10, 10))
-        query_dao.update_query.assert_called_with(
+        query_dao.get_due_queries.assert_called_once_with(1547726851)
+        query_dao.update_query.assert_called_once_with(
             AthenaQuery(
                 start_date="2019-01-17",
                 start_timestamp="2019-01-17 11:57:30",
@@ -56,15 +76,218 @@ class UsageUpdaterTest(unittest.TestCase):
                 executing_user="testUser",
                 data_scanned=29944425990,
                 query_sql="select * from foo.bar",
+                query_fingerprint=fingerprint("select * from foo.bar"),
             )
         )
 
-        sqs.send_message.assert_called_with(
-            QueueUrl="url",
-            MessageBody='{"start_date": "2019-01-17", "start_timestamp": "2019-01-17 11:57:30", '
-            '"query_execution_id": "6acb55b1-fddd-4608-bef8-ed206e1262de", "query_state": "SUCCEEDED", '
-            '"executing_user": "testUser", "data_scanned": 29944425990, "query_sql": "select * from foo.bar"}',
+        entries = sqs.send_message_batch.call_args.kwargs["Entries"]
+        self.assertEqual(sqs.send_message_batch.call_args.kwargs["QueueUrl"], "url")
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(
+            json.loads(entries[0]["MessageBody"]),
+            {
+                "start_date": "2019-01-17",
+                "start_timestamp": "2019-01-17 11:57:30",
+                "query_execution_id": "6acb55b1-fddd-4608-bef8-ed206e1262de",
+                "query_state": "SUCCEEDED",
+                "executing_user": "testUser",
+                "data_scanned": 29944425990,
+                "query_sql": "select * from foo.bar",
+                "query_sql_ref": None,
+                "query_sql_hash": None,
+                "query_fingerprint": fingerprint("select * from foo.bar"),
+                "account_id": None,
+                "region": None,
+                "auto_cancelled": None,
+                "version": 5,
+            },
+        )
+        cloudwatch_metrics.report_query_metric.assert_called_once_with(29944425990, "testUser")
+        cloudwatch_metrics.flush.assert_called_once()
+        # the query still running has been running for 10 minutes, so it's checked again in 5
+        query_dao.schedule_check.assert_called_once()
+        self.assertEqual(
+            query_dao.schedule_check.call_args[0][0].query_execution_id, "0e4a3f23-1c1e-4f7d-a0a0-1ad36ea9f5a2"
+        )
+        self.assertEqual(query_dao.schedule_check.call_args[0][1], 1547726851 + 300)
+        self.assertEqual(query_dao.schedule_check.call_args[0][0].data_scanned, 1024)
+        athena.stop_query_execution.assert_not_called()
+
+    @patch("bin.usage_update.UsageUpdater.now", side_effect=mocked_get_now)
+    def test_update_query_usage_alerts_about_and_cancels_running_queries(self, mock_obj):
+        config = Mock()
+        config.SQS_QUEUE_URL = "url"
+        config.USER_MAPPING_FUNCTION = lambda user: None
+        config.LIVE_ALERT_DATA_THRESHOLD = 512
+        config.AUTO_CANCEL_DATA_THRESHOLD = 1000
+        config.AUTO_CANCEL_ALLOWED_WORKGROUPS = ["primary"]
+        running = AthenaQuery(
+            "2019-01-17", "2019-01-17 11:57:31", "0e4a3f23-1c1e-4f7d-a0a0-1ad36ea9f5a2", "RUNNING", "u"
+        )
+        query_dao = Mock()
+        query_dao.get_due_queries.return_value = [running]
+        query_dao.mark_live_alerted.return_value = True
+        athena = Mock()
+        response = utils.get_json_content("fixtures/usage_update_athena_queries.json")
+        athena.batch_get_query_execution.return_value = dict(QueryExecutions=response["QueryExecutions"][1:])
+        sqs = Mock()
+        sqs.send_message_batch.return_value = {}
+
+        sut = UsageUpdater(config, query_dao, athena, sqs)
+        sut.update_query_usage()
+
+        athena.stop_query_execution.assert_called_once_with(QueryExecutionId="0e4a3f23-1c1e-4f7d-a0a0-1ad36ea9f5a2")
+        query_dao.mark_auto_cancelled.assert_called_once_with(running)
+        query_dao.mark_live_alerted.assert_called_once_with(running)
+        entries = sqs.send_message_batch.call_args.kwargs["Entries"]
+        self.assertEqual(len(entries), 1)
+        body = json.loads(entries[0]["MessageBody"])
+        self.assertEqual((body["query_state"], body["data_scanned"], body["auto_cancelled"]), ("RUNNING", 1024, True))
+        query_dao.update_query.assert_not_called()
+
+        # queries of other workgroups are only alerted about
+        config.AUTO_CANCEL_ALLOWED_WORKGROUPS = ["etl"]
+        running.auto_cancelled = None
+        query_dao.mark_live_alerted.return_value = False
+        UsageUpdater(config, query_dao, athena, sqs).update_query_usage()
+
+        athena.stop_query_execution.assert_called_once()
+        self.assertEqual(sqs.send_message_batch.call_count, 1)
+
+    @patch("bin.usage_update.UsageUpdater.now", side_effect=mocked_get_now)
+    def test_update_query_usage_polls_queries_below_live_thresholds_more_often(self, mock_obj):
+        config = Mock()
+        config.LIVE_ALERT_DATA_THRESHOLD = 1024**4
+        config.AUTO_CANCEL_DATA_THRESHOLD = None
+        config.AUTO_CANCEL_ALLOWED_WORKGROUPS = []
+        # running for 2 hours, checked once an hour without live thresholds
+        running = AthenaQuery(
+            "2019-01-17", "2019-01-17 10:07:31", "0e4a3f23-1c1e-4f7d-a0a0-1ad36ea9f5a2", "RUNNING", "u"
         )
+        query_dao = Mock()
+        query_dao.get_due_queries.return_value = [running]
+        athena = Mock()
+        response = utils.get_json_content("fixtures/usage_update_athena_queries.json")
+        athena.batch_get_query_execution.return_value = dict(QueryExecutions=response["QueryExecutions"][1:])
+
+        UsageUpdater(config, query_dao, athena, Mock()).update_query_usage()
+
+        self.assertEqual(query_dao.schedule_check.call_args[0][1], 1547726851 + 300)
+
+    @patch("bin.retry.time")
+    def test_get_queries_details_retries_throttled_and_unprocessed_ids(self, time):
+        ids = [str(i) for i in range(60)]
+        throttling = ClientError(dict(Error=dict(Code="ThrottlingException")), "BatchGetQueryExecution")
+
+        def execution(query_execution_id):
+            return dict(QueryExecutionId=query_execution_id, Query="select 1", Status=dict(State="SUCCEEDED"))
+
+        athena = Mock()
+        athena.batch_get_query_execution.side_effect = [
+            dict(
+                QueryExecutions=[execution(i) for i in ids[:48]],
+                UnprocessedQueryExecutionIds=[
+                    dict(QueryExecutionId="48", ErrorCode="ThrottlingException"),
+                    dict(QueryExecutionId="49", ErrorCode="INVALID_INPUT"),
+                ],
+            ),
+            throttling,
+            dict(QueryExecutions=[execution("48")] + [execution(i) for i in ids[50:]]),
+        ]
+
+        sut = UsageUpdater(Mock(), Mock(), athena, Mock())
+        details = sut.get_queries_details(ids)
+
+        self.assertEqual(set(details), set(ids) - {"49"})
+        self.assertEqual(details["0"], dict(query_state="SUCCEEDED", data_scanned=0, query="select 1", workgroup=None))
+        calls = athena.batch_get_query_execution.call_args_list
+        self.assertEqual(calls[0][1]["QueryExecutionIds"], ids[:50])
+        self.assertEqual(calls[1][1]["QueryExecutionIds"], ids[50:])
+        self.assertEqual(calls[2][1]["QueryExecutionIds"], ["48"] + ids[50:])
+
+    def test_get_details_groups_queries_by_account_and_region(self):
+        def athena(state):
+            client = Mock()
+            client.batch_get_query_execution.side_effect = lambda QueryExecutionIds: dict(
+                QueryExecutions=[
+                    dict(QueryExecutionId=i, Query="select 1", Status=dict(State=state)) for i in QueryExecutionIds
+                ]
+            )
+            return client
+
+        clients = {(None, None): athena("SUCCEEDED"), ("222222222222", "eu-west-1"): athena("FAILED")}
+
+        def client(account_id, region):
+            if (account_id, region) not in clients:
+                raise ClientError(dict(Error=dict(Code="AccessDenied")), "AssumeRole")
+            return clients[(account_id, region)]
+
+        athena_clients = Mock()
+        athena_clients.client.side_effect = client
+        queries = [
+            AthenaQuery("2019-01-17", "2019-01-17 11:57:30", "1", "RUNNING", "testUser"),
+            AthenaQuery("2019-01-17", "2019-01-17 11:57:31", "2", "RUNNING", "testUser", account_id="222222222222"),
+            AthenaQuery("2019-01-17", "2019-01-17 11:57:32", "3", "RUNNING", "testUser", account_id="333333333333"),
+        ]
+        for query in queries[1:]:
+            query.region = "eu-west-1"
+
+        sut = UsageUpdater(Mock(), Mock(), Mock(), Mock(), athena_clients=athena_clients)
+        details = sut.get_details(queries)
+
+        # queries of an account without the role are left for the next run
+        self.assertEqual({i: value["query_state"] for i, value in details.items()}, {"1": "SUCCEEDED", "2": "FAILED"})
+        athena_clients.prepare.assert_called_once_with()
+        clients[(None, None)].batch_get_query_execution.assert_called_once_with(QueryExecutionIds=["1"])
+
+    def test_get_details_skips_accounts_whose_athena_calls_fail(self):
+        allowed = Mock()
+        allowed.batch_get_query_execution.return_value = dict(
+            QueryExecutions=[dict(QueryExecutionId="1", Query="select 1", Status=dict(State="SUCCEEDED"))]
+        )
+        denied = Mock()
+        denied.batch_get_query_execution.side_effect = ClientError(
+            dict(Error=dict(Code="AccessDeniedException")), "BatchGetQueryExecution"
+        )
+        athena_clients = Mock()
+        athena_clients.client.side_effect = lambda account_id, region: denied if account_id else allowed
+        queries = [
+            AthenaQuery("2019-01-17", "2019-01-17 11:57:30", "1", "RUNNING", "testUser"),
+            AthenaQuery("2019-01-17", "2019-01-17 11:57:31", "2", "RUNNING", "testUser", account_id="222222222222"),
+        ]
+
+        sut = UsageUpdater(Mock(), Mock(), Mock(), Mock(), athena_clients=athena_clients)
+        details = sut.get_details(queries)
+
+        self.assertEqual(list(details), ["1"])
+        denied.batch_get_query_execution.assert_called_once_with(QueryExecutionIds=["2"])
+
+    def test_apply_details_offloads_query_text(self):
+        config = Mock(spec=["SQS_QUEUE_URL"])
+        sql_store = Mock()
+        query = AthenaQuery("2019-01-17", "2019-01-17 11:57:30", "1", "RUNNING", "testUser")
+
+        sut = UsageUpdater(config, Mock(), Mock(), Mock(), sql_store=sql_store)
+        sut.apply_details(query, dict(query_state="SUCCEEDED", data_scanned=10, query="select 1"))
+
+        self.assertEqual(query.query_sql, "select 1")
+        self.assertEqual(query.query_fingerprint, fingerprint("select 1"))
+        sql_store.offload.assert_called_once_with(query)
+
+    def test_finalise_query_adds_fingerprint_stats(self):
+        config = Mock(spec=["SQS_QUEUE_URL"])
+        query_dao = Mock()
+        query_dao.update_query.side_effect = [True, False]
+        fingerprint_stats = Mock()
+        query = AthenaQuery("2019-01-17", "2019-01-17 11:57:30", "1", "RUNNING", "testUser")
+        details = dict(query_state="SUCCEEDED", data_scanned=10, query="select 1")
+
+        sut = UsageUpdater(config, query_dao, Mock(), Mock(), fingerprint_stats=fingerprint_stats)
+        sut.finalise_query(query, details)
+        # a query finalised again, e.g. by both the sweep and the state change handler, is counted once
+        sut.finalise_query(query, details)
+
+        fingerprint_stats.add_query.assert_called_once_with(query)
 
 
 if __name__ == "__main__":